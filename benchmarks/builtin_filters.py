@@ -0,0 +1,135 @@
+"""Compare ImageMagick's own operators, as wrapped by the built-in filters,
+against the same operations written as `image_filter`s.
+
+    python benchmarks/builtin_filters.py [SIZE]
+
+The equivalents are as close as is practical, not exact; e.g. the blur only
+looks two pixels out.  Modulate has no compiled equivalent, so it runs in
+Python and is measured on a smaller image.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import math
+import sys
+import time
+import warnings
+
+from sanpera.color import HSLColor
+from sanpera.color import RGBColor
+from sanpera.filters import Blur
+from sanpera.filters import ContrastStretch
+from sanpera.filters import Gamma
+from sanpera.filters import Level
+from sanpera.filters import Modulate
+from sanpera.filters import Negate
+from sanpera.filters import Sharpen
+from sanpera.filters import image_filter
+from sanpera.image import Image
+
+
+def _gaussian(state, sigma, radius):
+    weights = {}
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            weights[dx, dy] = math.exp(-(dx * dx + dy * dy) / (2 * sigma * sigma))
+    total = sum(weights.values())
+
+    result = 0
+    for (dx, dy), weight in sorted(weights.items()):
+        result = result + state.at(dx, dy).color * (weight / total)
+    return result
+
+
+@image_filter
+def blur(state):
+    return _gaussian(state, 1.0, 2)
+
+
+@image_filter
+def sharpen(state):
+    return (state.color * 2 - _gaussian(state, 1.0, 2)).clamped()
+
+
+@image_filter
+def level(state):
+    return ((state.color - 0.1) / 0.8).clamped() ** (1 / 1.2)
+
+
+@image_filter
+def gamma(state):
+    return state.color ** (1 / 1.5)
+
+
+@image_filter
+def negate(state):
+    return 1 - state.color
+
+
+with warnings.catch_warnings():
+    # It's supposed to fall back to Python
+    warnings.simplefilter('ignore')
+
+    @image_filter
+    def modulate(state):
+        hsl = state.color.hsl()
+        return HSLColor(
+            hsl.hue, min(1., hsl.saturation * 0.5), min(1., hsl.lightness * 1.2),
+        ).rgb()
+
+
+def contrast_stretch(frame):
+    # Find the points to stretch between first, as ImageMagick does
+    pixels = frame.pixels.get_region()
+    count = len(pixels) // 4
+    black = []
+    white = []
+    for lane in range(3):
+        values = sorted(pixels[lane::4])
+        black.append(values[int(count * 0.02)])
+        white.append(values[count - 1 - int(count * 0.01)])
+
+    black = RGBColor(*black)
+    scale = RGBColor(*[1 / max(w - b, 1e-6) for b, w in zip(black._array, white)])
+    return image_filter(
+        lambda state: ((state.color - black) * scale).clamped())(frame)
+
+
+BENCHMARKS = [
+    ('blur', Blur(1.0, 2), blur),
+    ('sharpen', Sharpen(1.0, 2), sharpen),
+    ('level', Level(0.1, 0.9, 1.2), level),
+    ('gamma', Gamma(1.5), gamma),
+    ('negate', Negate(), negate),
+    ('contrast-stretch', ContrastStretch(0.02, 0.01), contrast_stretch),
+    ('modulate', Modulate(1.2, 0.5), modulate),
+]
+
+
+def main(argv):
+    if len(argv) > 1:
+        size = int(argv[1])
+    else:
+        size = 1000
+
+    for name, builtin, equivalent in BENCHMARKS:
+        if name == 'modulate':
+            img_size = min(size, 200)
+        else:
+            img_size = size
+        img = Image.new((img_size, img_size), fill=RGBColor(0.25, 0.5, 0.75))
+
+        timings = []
+        for f in (builtin, equivalent):
+            start = time.time()
+            f(*img)
+            timings.append(time.time() - start)
+
+        print("{0:>16}: {1:8.1f} ms built-in, {2:8.1f} ms filter, "
+            "{3:.1f}x for {4}x{4}".format(
+                name, timings[0] * 1000, timings[1] * 1000,
+                timings[1] / timings[0], img_size))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,52 @@
+"""Compare running several compiled filters one after another against running
+them as a fused chain.
+
+    python benchmarks/filter_chain.py [SIZE]
+"""
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+from sanpera.color import RGBColor
+from sanpera.filters import chain
+from sanpera.filters import compiled_image_filter
+from sanpera.image import Image
+
+
+filters = [
+    compiled_image_filter(lambda state: state.color * 0.8 + RGBColor(0.2, 0.1, 0.)),
+    compiled_image_filter(lambda state: state.color ** 0.8),
+    compiled_image_filter(lambda state: state.color.clamped()),
+]
+
+
+def staged(*frames):
+    for f in filters:
+        frames = tuple(f(*frames))
+    return frames
+
+
+def main(argv):
+    if len(argv) > 1:
+        size = int(argv[1])
+    else:
+        size = 2000
+
+    img = Image.new((size, size), fill=RGBColor(0.25, 0.5, 0.75))
+    fused = chain(*filters)
+
+    timings = {}
+    for name, f in (('staged', staged), ('fused', fused)):
+        start = time.time()
+        f(*img)
+        timings[name] = elapsed = time.time() - start
+        print("{0:>6}: {1:8.1f} ms for {2}x{2}".format(
+            name, elapsed * 1000, size))
+
+    print("speedup: {0:.1f}x".format(timings['staged'] / timings['fused']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,43 @@
+"""Compare running a pointwise compiled filter through its lookup table against
+running the VM for every pixel.
+
+    python benchmarks/filter_lut.py [SIZE]
+"""
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+from sanpera.color import RGBColor
+from sanpera.filters import compiled_image_filter
+from sanpera.image import Image
+
+
+@compiled_image_filter
+def curves(state):
+    levels = (state.color - 0.1) / 0.8
+    return (levels ** RGBColor(0.8, 1.0, 1.2)).clamped()
+
+
+def main(argv):
+    if len(argv) > 1:
+        size = int(argv[1])
+    else:
+        size = 2000
+
+    img = Image.new((size, size), fill=RGBColor(0.25, 0.5, 0.75))
+
+    timings = {}
+    for use_lut in (False, True):
+        start = time.time()
+        curves(*img, threads=1, lut=use_lut)
+        timings[use_lut] = elapsed = time.time() - start
+        print("{0:>6}: {1:8.1f} ms for {2}x{2}".format(
+            'lut' if use_lut else 'vm', elapsed * 1000, size))
+
+    print("speedup: {0:.1f}x".format(timings[False] / timings[True]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,65 @@
+"""Compare a compiled filter run by the VM, as native code, and the equivalent
+``-fx`` expression run by ImageMagick.
+
+    python benchmarks/filter_native.py [SIZE]
+
+Everything runs on as many threads as ImageMagick would use for ``-fx``.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+from sanpera._api import ffi, lib
+from sanpera.color import RGBColor
+from sanpera.exception import magick_try
+from sanpera.filters import compiled_image_filter
+from sanpera.image import Image
+
+
+def impl(state):
+    return (state.color * state.color * 0.75 + state.color.luma * 0.25).clamped()
+
+FX_EXPRESSION = b"u * u * 0.75 + u.luma * 0.25"
+
+
+def run_fx(frame):
+    with magick_try() as exc:
+        ptr = lib.FxImage(frame._frame, FX_EXPRESSION, exc.ptr)
+        exc.check(ptr == ffi.NULL)
+    return Image(ptr)
+
+
+def main(argv):
+    if len(argv) > 1:
+        size = int(argv[1])
+    else:
+        size = 2000
+
+    img = Image.new((size, size), fill=RGBColor(0.25, 0.5, 0.75))
+
+    vm = compiled_image_filter(impl)
+    start = time.time()
+    native = compiled_image_filter(impl, backend='native')
+    print("native build (or cache load): {0:8.1f} ms".format(
+        (time.time() - start) * 1000))
+
+    # FxImage uses ImageMagick's thread limit, so match it
+    threads = max(1, int(lib.GetMagickResourceLimit(lib.ThreadResource)))
+    print("threads: {0}".format(threads))
+
+    runs = [
+        ('vm', lambda: vm(*img, threads=threads, lut=False)),
+        ('native', lambda: native(*img, threads=threads, lut=False)),
+        ('-fx', lambda: run_fx(img[0])),
+    ]
+    for name, run in runs:
+        start = time.time()
+        run()
+        print("{0:>7}: {1:8.1f} ms for {2}x{2}".format(
+            name, (time.time() - start) * 1000, size))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,53 @@
+"""Time each compiled filter op on its own, with and without the optimizer.
+
+    python benchmarks/filter_ops.py [SIZE]
+
+Most of these are pointwise, so they'd normally run through a lookup table;
+that's turned off here to measure the VM itself.  See filter_lut.py.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+from sanpera.color import RGBColor
+from sanpera.filters import compiled_image_filter
+from sanpera.image import Image
+
+
+PROGRAMS = [
+    ('load', lambda state: state.color),
+    ('add', lambda state: state.color + state.color),
+    ('multiply', lambda state: state.color * state.color),
+    ('add constant', lambda state: state.color + 0.25),
+    ('multiply constant', lambda state: state.color * 0.5),
+    ('multiply-add', lambda state: state.color * state.color + state.color),
+    ('multiply-add constant', lambda state: state.color * 0.5 + 0.25),
+    ('color', lambda state: state.color * RGBColor(1., 0.5, 0.25)),
+    ('clamp', lambda state: state.color.clamped()),
+    ('foldable', lambda state: (state.color - 0) * 1 + 0),
+]
+
+
+def main(argv):
+    if len(argv) > 1:
+        size = int(argv[1])
+    else:
+        size = 2000
+
+    img = Image.new((size, size))
+    for name, impl in PROGRAMS:
+        timings = []
+        for optimize in (False, True):
+            f = compiled_image_filter(impl, optimize=optimize)
+            start = time.time()
+            f(*img, threads=1, lut=False)
+            timings.append(time.time() - start)
+
+        print("{0:>22}: {1:8.1f} ms naive, {2:8.1f} ms optimized".format(
+            name, timings[0] * 1000, timings[1] * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,50 @@
+"""Time a compiled filter on a large image with increasing numbers of threads.
+
+    python benchmarks/filter_threads.py [MAX_THREADS]
+
+The lookup table is turned off, so this measures the VM running in parallel
+bands; see filter_lut.py for the table.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+from sanpera import imagemagick
+from sanpera.filters import compiled_image_filter
+from sanpera.image import Image
+
+
+SIZE = (4000, 4000)
+
+
+@compiled_image_filter
+def halve_and_brighten(state):
+    return (state.color * 0.5 + 0.25).clamped()
+
+
+def main(argv):
+    if len(argv) > 1:
+        max_threads = int(argv[1])
+    else:
+        max_threads = 8
+
+    img = Image.new(SIZE)
+    print("OpenMP: {0}".format(imagemagick.HAS_OPENMP))
+
+    baseline = None
+    threads = 1
+    while threads <= max_threads:
+        start = time.time()
+        halve_and_brighten(*img, threads=threads, lut=False)
+        elapsed = time.time() - start
+        if baseline is None:
+            baseline = elapsed
+        print("{0:>3} threads: {1:8.1f} ms, {2:.1f}x".format(
+            threads, elapsed * 1000, baseline / elapsed))
+        threads *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv)
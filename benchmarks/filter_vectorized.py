@@ -0,0 +1,55 @@
+"""Compare a Python filter called once per pixel against the same filter called
+once per row.
+
+    python benchmarks/filter_vectorized.py [SIZE]
+"""
+from __future__ import division
+from __future__ import print_function
+
+import array
+import sys
+import time
+
+from sanpera.color import RGBColor
+from sanpera.filters import python_image_filter
+from sanpera.filters import vectorized_image_filter
+from sanpera.image import Image
+
+
+@python_image_filter
+def per_pixel(state):
+    color = state.color
+    return RGBColor(1 - color.red, 1 - color.green, 1 - color.blue, color.alpha)
+
+
+@vectorized_image_filter
+def per_row(row):
+    if isinstance(row, array.array):
+        # No NumPy
+        return array.array('d', (
+            value if i % 4 == 3 else 1 - value for i, value in enumerate(row)))
+    row[:, :3] = 1 - row[:, :3]
+    return row
+
+
+def main(argv):
+    if len(argv) > 1:
+        size = int(argv[1])
+    else:
+        size = 300
+
+    img = Image.new((size, size), fill=RGBColor(0.25, 0.5, 0.75))
+
+    timings = {}
+    for name, f in (('pixel', per_pixel), ('row', per_row)):
+        start = time.time()
+        f(*img)
+        timings[name] = elapsed = time.time() - start
+        print("{0:>6}: {1:8.1f} ms for {2}x{2}".format(
+            name, elapsed * 1000, size))
+
+    print("speedup: {0:.1f}x".format(timings['pixel'] / timings['row']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
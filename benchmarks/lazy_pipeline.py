@@ -0,0 +1,46 @@
+"""Compare resizing a large image and then cropping out the middle, run eagerly
+and through `Image.lazy`, which crops first.  Uses a ``'box'`` resize, since
+crops are only moved ahead of resizes that don't blend neighboring pixels.
+
+    python benchmarks/lazy_pipeline.py [SIZE]
+"""
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+from sanpera.color import RGBColor
+from sanpera.geometry import Size
+from sanpera.image import Image
+
+
+def main(argv):
+    if len(argv) > 1:
+        size = int(argv[1])
+    else:
+        size = 2000
+
+    img = Image.new((size, size), fill=RGBColor(0.25, 0.5, 0.75))
+    target = Size(size * 2, size * 2)
+    rect = Size(size // 2, size // 2).at((size // 2, size // 2))
+
+    def eager():
+        return img.resized(target, filter='box').cropped(rect)
+
+    def lazy():
+        return img.lazy().resized(target, filter='box').cropped(rect).collect()
+
+    timings = {}
+    for name, f in (('eager', eager), ('lazy', lazy)):
+        start = time.time()
+        f()
+        timings[name] = elapsed = time.time() - start
+        print("{0:>6}: {1:8.1f} ms for {2}x{2}".format(
+            name, elapsed * 1000, size))
+
+    print("speedup: {0:.1f}x".format(timings['eager'] / timings['lazy']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,57 @@
+"""Compare setting scattered pixels one at a time against batching them.
+
+    python benchmarks/pixel_batch.py [POINTS]
+"""
+from __future__ import division
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from sanpera.color import RGBColor
+from sanpera.image import Image
+
+
+SIZE = (1000, 1000)
+
+
+def set_individually(frame, points, color):
+    pixels = frame.pixels
+    for point in points:
+        pixels[point] = color
+
+
+def set_batched(frame, points, color):
+    with frame.pixels.batch() as pixels:
+        for point in points:
+            pixels[point] = color
+
+
+def main(argv):
+    if len(argv) > 1:
+        count = int(argv[1])
+    else:
+        count = 10000
+
+    rng = random.Random(0)
+    points = [
+        (rng.randrange(SIZE[0]), rng.randrange(SIZE[1]))
+        for _ in range(count)]
+    color = RGBColor(1., 0., 0.)
+
+    timings = {}
+    for func in (set_individually, set_batched):
+        frame = Image.new(SIZE)[0]
+        start = time.time()
+        func(frame, points, color)
+        timings[func.__name__] = elapsed = time.time() - start
+        print("{0:>17}: {1:8.1f} ms for {2} points on {3}x{4}".format(
+            func.__name__, elapsed * 1000, count, *SIZE))
+
+    print("speedup: {0:.1f}x".format(
+        timings['set_individually'] / timings['set_batched']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
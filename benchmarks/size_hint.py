@@ -0,0 +1,61 @@
+"""Compare reading a large JPEG and then shrinking it against reading it with a
+`size_hint`.
+
+    python benchmarks/size_hint.py photo.jpg [WIDTHxHEIGHT]
+
+Each variant runs in its own subprocess, so the peak RSS reported for one isn't
+polluted by the other.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import resource
+import subprocess
+import sys
+import time
+
+from sanpera.geometry import Size
+from sanpera.image import Image
+
+
+ROUNDS = 10
+
+
+def run_variant(variant, filename, target):
+    if variant == 'resized':
+        read = lambda: Image.read(filename)
+    else:
+        read = lambda: Image.read(filename, size_hint=target)
+
+    start = time.time()
+    for _ in range(ROUNDS):
+        img = read()
+        img = img.resized(img.size.fit_inside(target))
+    elapsed = (time.time() - start) / ROUNDS
+
+    # ru_maxrss is in kilobytes on Linux, but bytes on OS X; close enough
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{0:>10}: {1:8.1f} ms/read, peak RSS {2:8d} KiB, result {3}x{4}".format(
+        variant, elapsed * 1000, peak, img.size.width, img.size.height))
+
+
+def main(argv):
+    filename = argv[1]
+    if len(argv) > 2:
+        target = Size(*map(int, argv[2].split('x')))
+    else:
+        target = Size(200, 200)
+
+    for variant in ('resized', 'size_hint'):
+        subprocess.check_call([
+            sys.executable, __file__, '--variant', variant, filename,
+            '{0}x{1}'.format(*target)])
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--variant':
+        run_variant(
+            sys.argv[2], sys.argv[3],
+            Size(*map(int, sys.argv[4].split('x'))))
+    else:
+        main(sys.argv)
@@ -4,6 +4,7 @@
 // stdlib
 
 FILE *fdopen(int fd, const char *mode);
+int fclose(FILE *);
 
 
 // =============================================================================
@@ -387,10 +388,21 @@ typedef struct {
     ...;
 } PixelPacket;
 
+typedef enum {
+    UndefinedPixel,
+    CharPixel,
+    DoublePixel,
+    FloatPixel,
+    IntegerPixel,
+    LongPixel,
+    QuantumPixel,
+    ShortPixel
+} StorageType;
+
 MagickPixelPacket *CloneMagickPixelPacket(const MagickPixelPacket *);
 //MagickRealType DecodePixelGamma(const MagickRealType);
 //MagickRealType EncodePixelGamma(const MagickRealType);
-//MagickBooleanType ExportImagePixels(const Image *, const ssize_t, const ssize_t, const size_t, const size_t, const char *, const StorageType, void *, ExceptionInfo *);
+MagickBooleanType ExportImagePixels(const Image *, const ssize_t, const ssize_t, const size_t, const size_t, const char *, const StorageType, void *, ExceptionInfo *);
 void GetMagickPixelPacket(const Image *, MagickPixelPacket *);
 //MagickRealType GetPixelIntensity(const Image *image, const PixelPacket *);
 //MagickBooleanType ImportImagePixels(Image *, const ssize_t, const ssize_t, const size_t, const size_t, const char *, const StorageType, const void *);
@@ -584,6 +596,7 @@ struct _Image {
 struct _ImageInfo {
 
     MagickBooleanType adjoin;
+    MagickBooleanType affirm;
 
     FILE *file;
 
@@ -602,6 +615,25 @@ Image *ReferenceImage(Image *);
 Image *DestroyImage(Image *);
 
 
+// -----------------------------------------------------------------------------
+// resource_.h
+
+typedef enum {
+    UndefinedResource,
+    ThreadResource,
+    ...
+} ResourceType;
+
+MagickSizeType GetMagickResourceLimit(const ResourceType);
+
+// -----------------------------------------------------------------------------
+// option.h
+// (not done)
+
+const char *GetImageOption(const ImageInfo *, const char *);
+MagickBooleanType SetImageOption(ImageInfo *, const char *, const char *);
+
+
 // -----------------------------------------------------------------------------
 // list.h
 // (done)
@@ -813,6 +845,32 @@ MagickBooleanType TextureImage(Image *,const Image *);
 // (not done)
 
 Image *ColorizeImage(const Image *, const char *, const PixelPacket, ExceptionInfo *);
+Image *FxImage(const Image *, const char *, ExceptionInfo *);
+
+
+// -----------------------------------------------------------------------------
+// effect.h
+// (not done)
+
+Image *BlurImage(const Image *, const double, const double, ExceptionInfo *);
+Image *BlurImageChannel(const Image *, const ChannelType, const double, const double, ExceptionInfo *);
+Image *SharpenImage(const Image *, const double, const double, ExceptionInfo *);
+Image *SharpenImageChannel(const Image *, const ChannelType, const double, const double, ExceptionInfo *);
+
+
+// -----------------------------------------------------------------------------
+// enhance.h
+// (not done)
+
+MagickBooleanType ContrastStretchImage(Image *, const char *);
+MagickBooleanType ContrastStretchImageChannel(Image *, const ChannelType, const double, const double);
+MagickBooleanType GammaImage(Image *, const char *);
+MagickBooleanType GammaImageChannel(Image *, const ChannelType, const double);
+MagickBooleanType LevelImage(Image *, const char *);
+MagickBooleanType LevelImageChannel(Image *, const ChannelType, const double, const double, const double);
+MagickBooleanType ModulateImage(Image *, const char *);
+MagickBooleanType NegateImage(Image *, const MagickBooleanType);
+MagickBooleanType NegateImageChannel(Image *, const ChannelType, const MagickBooleanType);
 
 
 // -----------------------------------------------------------------------------
@@ -1142,17 +1200,6 @@ void SetBlobExempt(Image *, const MagickBooleanType);
 // -----------------------------------------------------------------------------
 // constitute.h
 
-typedef enum {
-    UndefinedPixel,
-    CharPixel,
-    DoublePixel,
-    FloatPixel,
-    IntegerPixel,
-    LongPixel,
-    QuantumPixel,
-    ShortPixel
-} StorageType;
-
 MagickBooleanType ConstituteComponentGenesis();
 void ConstituteComponentTerminus();
 Image *ConstituteImage(const size_t, const size_t, const char *, const StorageType, const void *, ExceptionInfo *);
@@ -1173,10 +1220,25 @@ Quantum sanpera_to_quantum(long double);
 void sanpera_pixel_to_doubles(PixelPacket *, double[]);
 void sanpera_pixel_from_doubles(PixelPacket *, double[]);
 void sanpera_pixel_from_doubles_channel(PixelPacket *, double[], ChannelType);
+void sanpera_pixels_to_doubles(const PixelPacket *, size_t, double *);
+void sanpera_pixels_from_doubles(PixelPacket *, size_t, const double *);
+void sanpera_pixels_from_doubles_channel(PixelPacket *, size_t, const double *, ChannelType);
+void sanpera_pixels_to_bytes(const PixelPacket *, size_t, unsigned char *);
+void sanpera_pixels_from_bytes(PixelPacket *, size_t, const unsigned char *);
+void sanpera_pixels_scatter_doubles(PixelPacket *, size_t, const size_t *, const double *);
+size_t sanpera_pixel_packet_layout(size_t[]);
 void sanpera_magick_pixel_to_doubles(MagickPixelPacket *, double[]);
 void sanpera_magick_pixel_from_doubles(MagickPixelPacket *, double[]);
 void sanpera_magick_pixel_from_doubles_channel(MagickPixelPacket *, double[], ChannelType);
 
+// FILE* wrappers around Python file-like objects; the callbacks live in
+// image.py
+static const int SANPERA_HAVE_FOPENCOOKIE;
+FILE *sanpera_fopen_python(void *, const char *);
+extern "Python" ssize_t sanpera_python_read(void *, char *, size_t);
+extern "Python" ssize_t sanpera_python_write(void *, const char *, size_t);
+extern "Python" int sanpera_python_seek(void *, int64_t *, int);
+
 typedef enum {
     SANPERA_OP_LOAD_SOURCE_COLOR,
     SANPERA_OP_LOAD_COLOR,
@@ -1184,13 +1246,44 @@ typedef enum {
     SANPERA_OP_ADD,
     SANPERA_OP_MULTIPLY,
     SANPERA_OP_CLAMP,
+    SANPERA_OP_SUBTRACT,
+    SANPERA_OP_DIVIDE,
+    SANPERA_OP_MIN,
+    SANPERA_OP_MAX,
+    SANPERA_OP_POW,
+    SANPERA_OP_ABS,
+    SANPERA_OP_NEGATE,
+    SANPERA_OP_LESS,
+    SANPERA_OP_LESS_EQUAL,
+    SANPERA_OP_GREATER,
+    SANPERA_OP_GREATER_EQUAL,
+    SANPERA_OP_SELECT,
+    SANPERA_OP_SWIZZLE,
+    SANPERA_OP_COMBINE,
+    SANPERA_OP_LUMA,
+    SANPERA_OP_HSL,
+    SANPERA_OP_ADD_CONSTANT,
+    SANPERA_OP_MULTIPLY_CONSTANT,
+    SANPERA_OP_MULTIPLY_ADD,
+    SANPERA_OP_MULTIPLY_ADD_CONSTANT,
     SANPERA_OP_DONE
 } sanpera_evaluate_op;
 
 typedef struct {
     sanpera_evaluate_op op;
-    PixelPacket *color;
-    double number;
+    double value[4];
+    double addend[4];
+    ssize_t dx;
+    ssize_t dy;
+    size_t frame;
 } sanpera_evaluate_step;
 
-Image *sanpera_evaluate_filter(Image **, sanpera_evaluate_step[], ChannelType, ExceptionInfo *);
+static const int SANPERA_HAVE_OPENMP;
+Image *sanpera_evaluate_filter_destination(Image **, ChannelType, ExceptionInfo *);
+size_t sanpera_filter_lut_length(void);
+size_t sanpera_filter_lut_size(void);
+void sanpera_filter_lut_build(sanpera_evaluate_step[], double[][4], void *);
+typedef void (*sanpera_filter_fetch)(const void *, size_t, ssize_t, ssize_t, double *);
+typedef void (*sanpera_filter_kernel)(const double *, sanpera_filter_fetch, const void *, double *);
+MagickBooleanType sanpera_evaluate_filter_band(Image **, Image *, ssize_t, ssize_t, sanpera_evaluate_step[], size_t, size_t, sanpera_filter_kernel, const void *, ChannelType, ExceptionInfo *);
+Image *sanpera_evaluate_filter(Image **, sanpera_evaluate_step[], size_t, size_t, sanpera_filter_kernel, const void *, ChannelType, size_t, ExceptionInfo *);
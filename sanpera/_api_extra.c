@@ -1,6 +1,15 @@
 // Extra C code, not part of the ImageMagick API, but handy for interoperating
 // with it.
 
+// fopencookie is a GNU extension.  Python.h normally defines this already,
+// but better safe than sorry
+#ifndef _GNU_SOURCE
+#define _GNU_SOURCE
+#endif
+
+#include <stddef.h>
+#include <stdint.h>
+#include <math.h>
 #include <stdio.h>
 #include <magick/MagickCore.h>
 
@@ -59,6 +68,93 @@ void sanpera_pixel_from_doubles_channel(
         SetPixelAlpha(pixel, ClampToQuantum(in[3] * QuantumRange));
 }
 
+// Bulk versions of the above, for moving entire blocks of pixels in one call.
+// Colors are packed RGBA, as either doubles in [0.0, 1.0] or bytes in [0, 255].
+void sanpera_pixels_to_doubles(const PixelPacket *pixels, size_t count, double *out) {
+    size_t i;
+    for (i = 0; i < count; i++, pixels++, out += 4) {
+        out[0] = (double)(GetPixelRed(pixels)) / QuantumRange;
+        out[1] = (double)(GetPixelGreen(pixels)) / QuantumRange;
+        out[2] = (double)(GetPixelBlue(pixels)) / QuantumRange;
+        out[3] = (double)(GetPixelAlpha(pixels)) / QuantumRange;
+    }
+}
+
+void sanpera_pixels_from_doubles(PixelPacket *pixels, size_t count, const double *in) {
+    size_t i;
+    for (i = 0; i < count; i++, pixels++, in += 4) {
+        SetPixelRed(pixels, ClampToQuantum(in[0] * QuantumRange));
+        SetPixelGreen(pixels, ClampToQuantum(in[1] * QuantumRange));
+        SetPixelBlue(pixels, ClampToQuantum(in[2] * QuantumRange));
+        SetPixelAlpha(pixels, ClampToQuantum(in[3] * QuantumRange));
+    }
+}
+
+void sanpera_pixels_from_doubles_channel(
+        PixelPacket *pixels, size_t count, const double *in, ChannelType channels)
+{
+    size_t i;
+    for (i = 0; i < count; i++, pixels++, in += 4) {
+        if (channels & RedChannel)
+            SetPixelRed(pixels, ClampToQuantum(in[0] * QuantumRange));
+        if (channels & GreenChannel)
+            SetPixelGreen(pixels, ClampToQuantum(in[1] * QuantumRange));
+        if (channels & BlueChannel)
+            SetPixelBlue(pixels, ClampToQuantum(in[2] * QuantumRange));
+        if (channels & AlphaChannel)
+            SetPixelAlpha(pixels, ClampToQuantum(in[3] * QuantumRange));
+    }
+}
+
+void sanpera_pixels_to_bytes(const PixelPacket *pixels, size_t count, unsigned char *out) {
+    size_t i;
+    for (i = 0; i < count; i++, pixels++, out += 4) {
+        out[0] = ScaleQuantumToChar(GetPixelRed(pixels));
+        out[1] = ScaleQuantumToChar(GetPixelGreen(pixels));
+        out[2] = ScaleQuantumToChar(GetPixelBlue(pixels));
+        out[3] = ScaleQuantumToChar(GetPixelAlpha(pixels));
+    }
+}
+
+void sanpera_pixels_from_bytes(PixelPacket *pixels, size_t count, const unsigned char *in) {
+    size_t i;
+    for (i = 0; i < count; i++, pixels++, in += 4) {
+        SetPixelRed(pixels, ScaleCharToQuantum(in[0]));
+        SetPixelGreen(pixels, ScaleCharToQuantum(in[1]));
+        SetPixelBlue(pixels, ScaleCharToQuantum(in[2]));
+        SetPixelAlpha(pixels, ScaleCharToQuantum(in[3]));
+    }
+}
+
+// Scatters packed RGBA doubles into arbitrary pixels within a row (or any
+// other contiguous block), given as offsets from the start of it
+void sanpera_pixels_scatter_doubles(
+        PixelPacket *pixels, size_t count, const size_t *offsets, const double *in)
+{
+    size_t i;
+    PixelPacket *pixel;
+    for (i = 0; i < count; i++, in += 4) {
+        pixel = pixels + offsets[i];
+        SetPixelRed(pixel, ClampToQuantum(in[0] * QuantumRange));
+        SetPixelGreen(pixel, ClampToQuantum(in[1] * QuantumRange));
+        SetPixelBlue(pixel, ClampToQuantum(in[2] * QuantumRange));
+        SetPixelAlpha(pixel, ClampToQuantum(in[3] * QuantumRange));
+    }
+}
+
+// PixelPacket's channel order depends on endianness, and its channels are
+// Quantums, whose size depends on how ImageMagick was built.  For the sake of
+// exposing the pixel cache directly, this returns the size of a channel, and
+// populates the index of each channel within a pixel, in the order red, green,
+// blue, opacity.
+size_t sanpera_pixel_packet_layout(size_t indices[static 4]) {
+    indices[0] = offsetof(PixelPacket, red) / sizeof(Quantum);
+    indices[1] = offsetof(PixelPacket, green) / sizeof(Quantum);
+    indices[2] = offsetof(PixelPacket, blue) / sizeof(Quantum);
+    indices[3] = offsetof(PixelPacket, opacity) / sizeof(Quantum);
+    return sizeof(Quantum);
+}
+
 
 // Same story for MagickPixelPacket, which is different in ways beyond my
 // understanding
@@ -94,6 +190,55 @@ void sanpera_magick_pixel_from_doubles_channel(
 
 
 
+// -----------------------------------------------------------------------------
+// FILE* wrappers around Python file-like objects
+
+// ImageMagick only knows how to read from a FILE* or a complete blob, but
+// glibc can build a FILE* that defers to callbacks, which can defer in turn to
+// Python.  On other platforms this returns NULL, and callers should fall back
+// to buffering the whole thing.
+// The callbacks are `extern "Python"`, implemented in image.py; cffi defines
+// them further down, so they need declaring here first.
+static ssize_t sanpera_python_read(void *, char *, size_t);
+static ssize_t sanpera_python_write(void *, const char *, size_t);
+static int sanpera_python_seek(void *, int64_t *, int);
+
+#if defined(__GLIBC__)
+#define SANPERA_HAVE_FOPENCOOKIE 1
+
+static ssize_t sanpera_cookie_read(void *cookie, char *buf, size_t size) {
+    return sanpera_python_read(cookie, buf, size);
+}
+
+static ssize_t sanpera_cookie_write(void *cookie, const char *buf, size_t size) {
+    return sanpera_python_write(cookie, buf, size);
+}
+
+static int sanpera_cookie_seek(void *cookie, off64_t *offset, int whence) {
+    int64_t position = *offset;
+    int ret = sanpera_python_seek(cookie, &position, whence);
+    *offset = position;
+    return ret;
+}
+
+FILE *sanpera_fopen_python(void *handle, const char *mode) {
+    cookie_io_functions_t funcs = {
+        sanpera_cookie_read,
+        sanpera_cookie_write,
+        sanpera_cookie_seek,
+        NULL,
+    };
+    return fopencookie(handle, mode, funcs);
+}
+#else
+#define SANPERA_HAVE_FOPENCOOKIE 0
+
+FILE *sanpera_fopen_python(void *handle, const char *mode) {
+    return NULL;
+}
+#endif
+
+
 typedef enum {
     SANPERA_OP_LOAD_SOURCE_COLOR,
     SANPERA_OP_LOAD_COLOR,
@@ -101,73 +246,384 @@ typedef enum {
     SANPERA_OP_ADD,
     SANPERA_OP_MULTIPLY,
     SANPERA_OP_CLAMP,
+    SANPERA_OP_SUBTRACT,
+    SANPERA_OP_DIVIDE,
+    SANPERA_OP_MIN,
+    SANPERA_OP_MAX,
+    SANPERA_OP_POW,
+    SANPERA_OP_ABS,
+    SANPERA_OP_NEGATE,
+    SANPERA_OP_LESS,
+    SANPERA_OP_LESS_EQUAL,
+    SANPERA_OP_GREATER,
+    SANPERA_OP_GREATER_EQUAL,
+    SANPERA_OP_SELECT,
+    SANPERA_OP_SWIZZLE,
+    SANPERA_OP_COMBINE,
+    SANPERA_OP_LUMA,
+    SANPERA_OP_HSL,
+    // Superinstructions, only produced by the optimizer
+    SANPERA_OP_ADD_CONSTANT,
+    SANPERA_OP_MULTIPLY_CONSTANT,
+    SANPERA_OP_MULTIPLY_ADD,
+    SANPERA_OP_MULTIPLY_ADD_CONSTANT,
     SANPERA_OP_DONE
 } sanpera_evaluate_op;
 
+// Every value the program works with is four lanes wide: red, green, blue, and
+// alpha, in [0.0, 1.0] (where alpha 1.0 is opaque).  Constants carry all four
+// lanes in `value`; a number is just broadcast to every lane.  `addend` is
+// the second constant for MULTIPLY_ADD_CONSTANT.  `frame` is which input
+// frame LOAD_SOURCE_COLOR reads, and `dx` and `dy` are the offset of the pixel
+// it reads, relative to the current one.
 typedef struct {
     sanpera_evaluate_op op;
-    PixelPacket *color;
-    double number;
+    double value[4];
+    double addend[4];
+    ssize_t dx;
+    ssize_t dy;
+    size_t frame;
 } sanpera_evaluate_step;
 
-Quantum sanpera_evaluate_filter_once(sanpera_evaluate_step steps[], Quantum value, ChannelType channel);
+// The neighborhood of the current pixel in one input frame: `center` points at
+// it within a block of pixels fetched from that frame, and `stride` is the
+// width of that block.  Filters that only look at the current pixel get a
+// block one row high.  There's one window per input frame.
+typedef struct {
+    const PixelPacket *center;
+    ssize_t stride;
+} sanpera_filter_window;
 
-// TODO this should use a cache view i guess
-Image *sanpera_evaluate_filter(
-        Image **frames, sanpera_evaluate_step steps[], ChannelType channels, ExceptionInfo *exception)
+static inline void sanpera_window_fetch(
+        const sanpera_filter_window *window, ssize_t dx, ssize_t dy, double out[4])
+{
+    const PixelPacket *p = window->center + dy * window->stride + dx;
+    out[0] = (double)(GetPixelRed(p)) / QuantumRange;
+    out[1] = (double)(GetPixelGreen(p)) / QuantumRange;
+    out[2] = (double)(GetPixelBlue(p)) / QuantumRange;
+    out[3] = (double)(GetPixelAlpha(p)) / QuantumRange;
+}
+
+// Same as the above, for native kernels, which can't see ImageMagick's types.
+// `windows` is the whole array of windows.
+typedef void (*sanpera_filter_fetch)(const void *, size_t, ssize_t, ssize_t, double *);
+
+void sanpera_filter_window_fetch(
+        const void *windows, size_t frame, ssize_t dx, ssize_t dy, double out[4])
+{
+    sanpera_window_fetch(
+        (const sanpera_filter_window *) windows + frame, dx, dy, out);
+}
+
+// A compiled filter program turned into native code by _filter_native.py.
+// Does the same thing as sanpera_evaluate_filter_pixel for one particular
+// program; other pixels are read by calling the fetch function with the
+// windows.
+typedef void (*sanpera_filter_kernel)(
+    const double *, sanpera_filter_fetch, const void *, double *);
+
+// Evaluates a compiled filter program against a single pixel, all channels at
+// once.  `source` is the current pixel of the first frame, already converted;
+// `windows` is where any other pixels come from, one per input frame, and may
+// be NULL if the program reads nothing else.  `stack` must have room for at
+// least as many values as the program ever pushes at once, which
+// FilterCompiler works out ahead of time.
+void sanpera_evaluate_filter_pixel(
+        sanpera_evaluate_step steps[], double stack[][4],
+        const double source[4], const sanpera_filter_window windows[],
+        double out[4]);
+
+// Whether this module was built with OpenMP, in which case
+// sanpera_evaluate_filter splits its work across threads by itself.  This
+// follows ImageMagick's own build flags, so it's generally the same as
+// whether ImageMagick has OpenMP.
+#if defined(_OPENMP)
+#define SANPERA_HAVE_OPENMP 1
+#else
+#define SANPERA_HAVE_OPENMP 0
+#endif
+
+// Lookup tables for pointwise programs, i.e. ones where each output channel
+// depends only on the same input channel.  Those only ever see as many
+// distinct inputs as there are Quantum values, so for big enough images it's
+// cheaper to run the program once per possible value ahead of time.
+// Integral quantums up to 16 bits get a table entry for every value, which
+// gives exactly the same results as the VM.  HDRI (or huge) quantums get a
+// dense sampled table that's interpolated between, and anything outside
+// [0, QuantumRange] still goes through the VM.
+#if !defined(MAGICKCORE_HDRI_SUPPORT) && (MAGICKCORE_QUANTUM_DEPTH <= 16)
+#define SANPERA_LUT_EXACT 1
+#define SANPERA_LUT_LENGTH ((size_t) QuantumRange + 1)
+#else
+#define SANPERA_LUT_EXACT 0
+#define SANPERA_LUT_LENGTH ((size_t) 65536)
+#endif
+
+typedef Quantum sanpera_lut_entry[4];
+
+size_t sanpera_filter_lut_length(void) {
+    return SANPERA_LUT_LENGTH;
+}
+
+size_t sanpera_filter_lut_size(void) {
+    return SANPERA_LUT_LENGTH * sizeof(sanpera_lut_entry);
+}
+
+// Fills `table`, which must be sanpera_filter_lut_size() bytes, by running the
+// program on every value it covers.
+void sanpera_filter_lut_build(
+        sanpera_evaluate_step steps[], double stack[][4], void *table)
+{
+    sanpera_lut_entry *entries = (sanpera_lut_entry *) table;
+    double in[4], out[4];
+    size_t i;
+    int lane;
+
+    for (i = 0; i < SANPERA_LUT_LENGTH; i++) {
+        for (lane = 0; lane < 4; lane++)
+            in[lane] = (double) i / (SANPERA_LUT_LENGTH - 1);
+        sanpera_evaluate_filter_pixel(steps, stack, in, NULL, out);
+        for (lane = 0; lane < 4; lane++)
+            entries[i][lane] = ClampToQuantum(QuantumRange * out[lane]);
+    }
+}
+
+static inline MagickBooleanType sanpera_lut_lookup(
+        const sanpera_lut_entry *lut, Quantum value, int lane, Quantum *out)
+{
+#if SANPERA_LUT_EXACT
+    *out = lut[(size_t) value][lane];
+    return MagickTrue;
+#else
+    double position;
+    size_t index;
+
+    // Written this way round so NaN fails too
+    if (! (value >= 0 && value <= QuantumRange))
+        return MagickFalse;
+
+    position = (double) value / QuantumRange * (SANPERA_LUT_LENGTH - 1);
+    index = (size_t) position;
+    if (index >= SANPERA_LUT_LENGTH - 1) {
+        *out = lut[SANPERA_LUT_LENGTH - 1][lane];
+        return MagickTrue;
+    }
+    position -= index;
+    *out = (Quantum) (lut[index][lane] + position * (lut[index + 1][lane] - lut[index][lane]));
+    return MagickTrue;
+#endif
+}
+
+// Applies a table to one pixel.  Returns MagickFalse, without touching `q`, if
+// the pixel has to go through the VM instead.
+static MagickBooleanType sanpera_lut_apply(
+        const sanpera_lut_entry *lut, const PixelPacket *p, PixelPacket *q,
+        ChannelType channels)
+{
+    const ChannelType masks[4] = {RedChannel, GreenChannel, BlueChannel, AlphaChannel};
+    Quantum in[4], out[4];
+    int lane;
+
+    in[0] = GetPixelRed(p);
+    in[1] = GetPixelGreen(p);
+    in[2] = GetPixelBlue(p);
+    in[3] = GetPixelAlpha(p);
+    for (lane = 0; lane < 4; lane++) {
+        if ((channels & masks[lane]) &&
+                sanpera_lut_lookup(lut, in[lane], lane, &out[lane]) == MagickFalse)
+            return MagickFalse;
+    }
+
+    *q = *p;
+    if (channels & RedChannel)
+        SetPixelRed(q, out[0]);
+    if (channels & GreenChannel)
+        SetPixelGreen(q, out[1]);
+    if (channels & BlueChannel)
+        SetPixelBlue(q, out[2]);
+    if (channels & AlphaChannel)
+        SetPixelAlpha(q, out[3]);
+    return MagickTrue;
+}
+
+// Creates the image a compiled filter writes into: a copy of the first frame,
+// with its pixel cache ready to go, so that bands don't race to allocate it.
+Image *sanpera_evaluate_filter_destination(
+        Image **frames, ChannelType channels, ExceptionInfo *exception)
+{
+    Image *source = frames[0];
+    Image *destination;
+
+    destination = CloneImage(source, source->columns, source->rows, MagickTrue, exception);
+    if (destination == (Image *) NULL)
+        return NULL;
+
+    // Every pixel's alpha gets written when alpha is asked for, so there's no
+    // need to initialize the channel first
+    if (channels & AlphaChannel)
+        destination->matte = MagickTrue;
+
+    if (SyncImagePixelCache(destination, exception) == MagickFalse) {
+        DestroyImage(destination);
+        return NULL;
+    }
+
+    return destination;
+}
+
+// Evaluates a compiled filter for rows [y_start, y_end) of `destination`,
+// which must come from sanpera_evaluate_filter_destination.  Every band gets
+// its own stack and its own cache views (which each have their own buffers),
+// so any number of bands of the same destination can run at once, as long as
+// they don't overlap.
+// `frames` is NULL-terminated, and should only hold the frames the program
+// actually reads.  The output is the size of the first frame; other frames
+// are read at the same coordinates, so any part of them outside the first is
+// ignored, and any part of the first they don't cover comes from their
+// virtual pixel method.
+// `radius` is the furthest the program looks from the current pixel, in
+// either direction.  `kernel` is either NULL or a native version of the same
+// program, to run instead of the VM.  `lut` is either NULL or a table from
+// sanpera_filter_lut_build for the same program.
+MagickBooleanType sanpera_evaluate_filter_band(
+        Image **frames, Image *destination, ssize_t y_start, ssize_t y_end,
+        sanpera_evaluate_step steps[], size_t stack_depth, size_t radius,
+        sanpera_filter_kernel kernel, const void *lut,
+        ChannelType channels, ExceptionInfo *exception)
 {
     const PixelPacket *p;
     PixelPacket *q;
     ssize_t x, y;
+    size_t frame, frame_count;
     Image *source = frames[0];
-    Image *destination = CloneImage(source,source->columns,source->rows,MagickTrue, exception);
+    CacheView **source_views, *destination_view;
+    sanpera_filter_window *windows;
+    double (*stack)[4];
+    double in[4], out[4];
+    MagickBooleanType status = MagickTrue;
+    // The block of source pixels fetched for each row covers the whole
+    // neighborhood of every pixel in it
+    ssize_t r = (ssize_t) radius;
+    size_t block_width = source->columns + 2 * radius;
+
+    for (frame_count = 0; frames[frame_count] != (Image *) NULL; frame_count++);
+
+    stack = (double (*)[4]) AcquireQuantumMemory(stack_depth, sizeof(*stack));
+    source_views = (CacheView **) AcquireQuantumMemory(frame_count, sizeof(*source_views));
+    windows = (sanpera_filter_window *) AcquireQuantumMemory(frame_count, sizeof(*windows));
+    if (stack == (double (*)[4]) NULL || source_views == (CacheView **) NULL
+            || windows == (sanpera_filter_window *) NULL) {
+        if (stack != (double (*)[4]) NULL)
+            RelinquishMagickMemory(stack);
+        if (source_views != (CacheView **) NULL)
+            RelinquishMagickMemory(source_views);
+        if (windows != (sanpera_filter_window *) NULL)
+            RelinquishMagickMemory(windows);
+        (void) ThrowMagickException(exception, GetMagickModule(),
+            ResourceLimitError, "MemoryAllocationFailed", "`%s'", source->filename);
+        return MagickFalse;
+    }
 
-    if (destination == (Image *) NULL) { return NULL; }
-    for (y=0; y < (ssize_t) source->rows; y++) {
-        p = GetVirtualPixels(source,0,y,source->columns,1,exception);
-        q = GetAuthenticPixels(destination,0,y,destination->columns,1,exception);
+    for (frame = 0; frame < frame_count; frame++) {
+        source_views[frame] = AcquireVirtualCacheView(frames[frame], exception);
+        windows[frame].stride = (ssize_t) block_width;
+    }
+    destination_view = AcquireAuthenticCacheView(destination, exception);
+    for (y = y_start; y < y_end; y++) {
+        // Pixels beyond the edges come from the virtual pixel method
+        for (frame = 0; frame < frame_count; frame++) {
+            p = GetCacheViewVirtualPixels(source_views[frame],
+                -r, y - r, block_width, 2 * radius + 1, exception);
+            if (p == (const PixelPacket *) NULL) {
+                status = MagickFalse;
+                break;
+            }
+            // Skip to the first real pixel of the middle row
+            windows[frame].center = p + r * block_width + r;
+        }
+        // Every pixel is overwritten, so there's no need to fetch them first
+        q = QueueCacheViewAuthenticPixels(destination_view, 0, y, destination->columns, 1, exception);
 
-        if ((p == (const PixelPacket *) NULL) || (q == (PixelPacket *) NULL))
+        if (status == MagickFalse || q == (PixelPacket *) NULL)
             break;
 
         for (x=0; x < (ssize_t) source->columns; x++) {
-            // TODO would be lovely if this ran once per /pixel/ then extracted
-            // the resulting channels
-            if (channels & RedChannel) {
-                SetPixelRed(q, sanpera_evaluate_filter_once(steps, p->red, RedChannel));
-            }
-            else {
-                SetPixelRed(q, p->red);
-            }
-
-            if (channels & GreenChannel) {
-                SetPixelGreen(q, sanpera_evaluate_filter_once(steps, p->green, GreenChannel));
-            }
-            else {
-                SetPixelGreen(q, p->green);
-            }
-
-            if (channels & BlueChannel) {
-                SetPixelBlue(q, sanpera_evaluate_filter_once(steps, p->blue, BlueChannel));
-            }
-            else {
-                SetPixelBlue(q, p->blue);
-            }
-
-            if (channels & AlphaChannel) {
-                SetPixelOpacity(q,90*p->opacity/100);
-            }
-            else {
-                SetPixelOpacity(q, p->opacity);
+            p = windows[0].center;
+            if (lut == NULL || sanpera_lut_apply(
+                    (const sanpera_lut_entry *) lut, p, q, channels) == MagickFalse) {
+                in[0] = (double)(GetPixelRed(p)) / QuantumRange;
+                in[1] = (double)(GetPixelGreen(p)) / QuantumRange;
+                in[2] = (double)(GetPixelBlue(p)) / QuantumRange;
+                in[3] = (double)(GetPixelAlpha(p)) / QuantumRange;
+                if (kernel != NULL)
+                    kernel(in, sanpera_filter_window_fetch, windows, out);
+                else
+                    sanpera_evaluate_filter_pixel(steps, stack, in, windows, out);
+
+                // Channels that weren't asked for are copied through untouched
+                *q = *p;
+                if (channels & RedChannel)
+                    SetPixelRed(q, ClampToQuantum(QuantumRange * out[0]));
+                if (channels & GreenChannel)
+                    SetPixelGreen(q, ClampToQuantum(QuantumRange * out[1]));
+                if (channels & BlueChannel)
+                    SetPixelBlue(q, ClampToQuantum(QuantumRange * out[2]));
+                if (channels & AlphaChannel)
+                    SetPixelAlpha(q, ClampToQuantum(QuantumRange * out[3]));
             }
 
-            p++;
+            for (frame = 0; frame < frame_count; frame++)
+                windows[frame].center++;
             q++;
         }
-        if (SyncAuthenticPixels(destination,exception) == MagickFalse)
+        if (SyncCacheViewAuthenticPixels(destination_view, exception) == MagickFalse)
             break;
     }
-    if (y < (ssize_t) source->rows) {
+    destination_view = DestroyCacheView(destination_view);
+    for (frame = 0; frame < frame_count; frame++)
+        DestroyCacheView(source_views[frame]);
+    source_views = (CacheView **) RelinquishMagickMemory(source_views);
+    windows = (sanpera_filter_window *) RelinquishMagickMemory(windows);
+    stack = (double (*)[4]) RelinquishMagickMemory(stack);
+
+    return (y < y_end) ? MagickFalse : MagickTrue;
+}
+
+// Evaluates a compiled filter over a whole image, split into `bands` bands of
+// rows.  With OpenMP, the bands run in parallel; without it, they run one
+// after another, and the caller should use several threads of its own with
+// sanpera_evaluate_filter_band instead.
+Image *sanpera_evaluate_filter(
+        Image **frames, sanpera_evaluate_step steps[], size_t stack_depth,
+        size_t radius, sanpera_filter_kernel kernel, const void *lut,
+        ChannelType channels, size_t bands, ExceptionInfo *exception)
+{
+    ssize_t band;
+    Image *source = frames[0];
+    Image *destination;
+    MagickBooleanType status = MagickTrue;
+
+    destination = sanpera_evaluate_filter_destination(frames, channels, exception);
+    if (destination == (Image *) NULL)
+        return NULL;
+
+    if (bands < 1)
+        bands = 1;
+    if (bands > source->rows)
+        bands = source->rows;
+
+#if defined(_OPENMP)
+    #pragma omp parallel for schedule(static, 1) num_threads(bands) shared(status)
+#endif
+    for (band = 0; band < (ssize_t) bands; band++) {
+        ssize_t y_start = (ssize_t) (source->rows * band / bands);
+        ssize_t y_end = (ssize_t) (source->rows * (band + 1) / bands);
+        if (sanpera_evaluate_filter_band(frames, destination, y_start, y_end,
+                steps, stack_depth, radius, kernel, lut, channels, exception) == MagickFalse)
+            status = MagickFalse;
+    }
+
+    if (status == MagickFalse) {
         DestroyImage(destination);
         return NULL;
     }
@@ -175,68 +631,264 @@ Image *sanpera_evaluate_filter(
     return destination;
 }
 
-#define SANPERA_STACK_SIZE 256
-static double stack[SANPERA_STACK_SIZE];
+// Converts RGB lanes to hue, saturation, and lightness in place, the same way
+// RGBColor.hsl() does: clamped first, except in HDRI builds, then as Python's
+// colorsys does.  Alpha is left alone.
+#define SANPERA_CLAMP_UNIT(value) ((value) < 0. ? 0. : ((value) > 1. ? 1. : (value)))
+static void sanpera_rgb_to_hsl(double lanes[4])
+{
+#ifdef MAGICKCORE_HDRI_SUPPORT
+    double red = lanes[0], green = lanes[1], blue = lanes[2];
+#else
+    double red = SANPERA_CLAMP_UNIT(lanes[0]);
+    double green = SANPERA_CLAMP_UNIT(lanes[1]);
+    double blue = SANPERA_CLAMP_UNIT(lanes[2]);
+#endif
+    double max = MagickMax(red, MagickMax(green, blue));
+    double min = MagickMin(red, MagickMin(green, blue));
+    double delta = max - min;
+    double hue, saturation, lightness;
+
+    lightness = (max + min) / 2.;
+    if (delta == 0.) {
+        lanes[0] = lanes[1] = 0.;
+        lanes[2] = lightness;
+        return;
+    }
 
-Quantum sanpera_evaluate_filter_once(sanpera_evaluate_step steps[], Quantum value, ChannelType channel) {
-    int i;
-    sanpera_evaluate_op op;
-    Quantum pixel_channel;
+    if (lightness <= 0.5)
+        saturation = delta / (max + min);
+    else
+        saturation = delta / (2. - max - min);
+
+    if (red == max)
+        hue = (green - blue) / delta;
+    else if (green == max)
+        hue = 2. + (blue - red) / delta;
+    else
+        hue = 4. + (red - green) / delta;
+    hue = hue / 6.;
+    hue -= floor(hue);
+
+    lanes[0] = hue;
+    lanes[1] = saturation;
+    lanes[2] = lightness;
+}
+
+void sanpera_evaluate_filter_pixel(
+        sanpera_evaluate_step steps[], double stack[][4],
+        const double source[4], const sanpera_filter_window windows[],
+        double out[4])
+{
+    int i, lane;
     int stack_pos = -1;
+    double *top;
+    double scratch[4];
+
     for (i = 0;; i++) {
-        op = steps[i].op;
-        switch (op) {
+        switch (steps[i].op) {
             case SANPERA_OP_LOAD_SOURCE_COLOR:
                 stack_pos++;
-                stack[stack_pos] = (double)(value) / QuantumRange;
-                break;
-
-            case SANPERA_OP_LOAD_COLOR:
-                // TODO...?
-                // TODO how does this interact with quantum anyway
-                stack_pos++;
-                if (channel == RedChannel) {
-                    pixel_channel = GetPixelRed(steps[i].color);
-                }
-                else if (channel == GreenChannel) {
-                    pixel_channel = GetPixelGreen(steps[i].color);
-                }
-                else if (channel == BlueChannel) {
-                    pixel_channel = GetPixelBlue(steps[i].color);
+                top = stack[stack_pos];
+                if (steps[i].frame == 0 && steps[i].dx == 0 && steps[i].dy == 0) {
+                    for (lane = 0; lane < 4; lane++)
+                        top[lane] = source[lane];
                 }
                 else {
-                    // XXX not sure how to handle errors really
-                    pixel_channel = 0.0;
+                    sanpera_window_fetch(
+                        &windows[steps[i].frame], steps[i].dx, steps[i].dy, top);
                 }
-                stack[stack_pos] = (double)(pixel_channel) / QuantumRange;
                 break;
 
+            case SANPERA_OP_LOAD_COLOR:
             case SANPERA_OP_LOAD_NUMBER:
                 stack_pos++;
-                stack[stack_pos] = steps[i].number;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = steps[i].value[lane];
                 break;
 
             case SANPERA_OP_ADD:
                 stack_pos--;
-                stack[stack_pos] = stack[stack_pos] + stack[stack_pos + 1];
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] += stack[stack_pos + 1][lane];
                 break;
 
             case SANPERA_OP_MULTIPLY:
                 stack_pos--;
-                stack[stack_pos] = stack[stack_pos] * stack[stack_pos + 1];
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] *= stack[stack_pos + 1][lane];
+                break;
+
+            case SANPERA_OP_ADD_CONSTANT:
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] += steps[i].value[lane];
+                break;
+
+            case SANPERA_OP_MULTIPLY_CONSTANT:
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] *= steps[i].value[lane];
+                break;
+
+            case SANPERA_OP_MULTIPLY_ADD:
+                // a b c -> a * b + c
+                stack_pos -= 2;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = top[lane] * stack[stack_pos + 1][lane] + stack[stack_pos + 2][lane];
+                break;
+
+            case SANPERA_OP_MULTIPLY_ADD_CONSTANT:
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = top[lane] * steps[i].value[lane] + steps[i].addend[lane];
                 break;
 
             case SANPERA_OP_CLAMP:
-                if (stack[stack_pos] < 0.) {
-                    stack[stack_pos] = 0.;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++) {
+                    if (top[lane] < 0.)
+                        top[lane] = 0.;
+                    else if (top[lane] > 1.)
+                        top[lane] = 1.;
                 }
-                else if (stack[stack_pos] > 1.) {
-                    stack[stack_pos] = 1.;
+                break;
+
+            case SANPERA_OP_SUBTRACT:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] -= stack[stack_pos + 1][lane];
+                break;
+
+            case SANPERA_OP_DIVIDE:
+                // Dividing by zero gives zero, rather than poisoning the
+                // pixel with an infinity
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++) {
+                    if (stack[stack_pos + 1][lane] == 0.)
+                        top[lane] = 0.;
+                    else
+                        top[lane] /= stack[stack_pos + 1][lane];
+                }
+                break;
+
+            case SANPERA_OP_MIN:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++) {
+                    if (stack[stack_pos + 1][lane] < top[lane])
+                        top[lane] = stack[stack_pos + 1][lane];
+                }
+                break;
+
+            case SANPERA_OP_MAX:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++) {
+                    if (stack[stack_pos + 1][lane] > top[lane])
+                        top[lane] = stack[stack_pos + 1][lane];
                 }
                 break;
 
+            case SANPERA_OP_POW:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = pow(top[lane], stack[stack_pos + 1][lane]);
+                break;
+
+            case SANPERA_OP_ABS:
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = fabs(top[lane]);
+                break;
+
+            case SANPERA_OP_NEGATE:
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = -top[lane];
+                break;
+
+            // Comparisons give 1.0 for true and 0.0 for false
+            case SANPERA_OP_LESS:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = (top[lane] < stack[stack_pos + 1][lane]) ? 1. : 0.;
+                break;
+
+            case SANPERA_OP_LESS_EQUAL:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = (top[lane] <= stack[stack_pos + 1][lane]) ? 1. : 0.;
+                break;
+
+            case SANPERA_OP_GREATER:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = (top[lane] > stack[stack_pos + 1][lane]) ? 1. : 0.;
+                break;
+
+            case SANPERA_OP_GREATER_EQUAL:
+                stack_pos--;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = (top[lane] >= stack[stack_pos + 1][lane]) ? 1. : 0.;
+                break;
+
+            case SANPERA_OP_SELECT:
+                // condition a b -> a where the condition is nonzero, else b
+                stack_pos -= 2;
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = stack[stack_pos + (top[lane] != 0. ? 1 : 2)][lane];
+                break;
+
+            case SANPERA_OP_SWIZZLE:
+                // Each lane of `value` says which lane to take
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    scratch[lane] = top[(int) steps[i].value[lane]];
+                for (lane = 0; lane < 4; lane++)
+                    top[lane] = scratch[lane];
+                break;
+
+            case SANPERA_OP_COMBINE:
+                // r g b a -> the red lane of r, green lane of g, etc.
+                stack_pos -= 3;
+                top = stack[stack_pos];
+                for (lane = 1; lane < 4; lane++)
+                    top[lane] = stack[stack_pos + lane][lane];
+                break;
+
+            case SANPERA_OP_LUMA:
+                // Same coefficients as -fx's luma.  Alpha is a channel of its
+                // own, so it's left alone
+                top = stack[stack_pos];
+                top[0] = top[1] = top[2] =
+                    0.212656 * top[0] + 0.715158 * top[1] + 0.072186 * top[2];
+                break;
+
+            case SANPERA_OP_HSL:
+                top = stack[stack_pos];
+                sanpera_rgb_to_hsl(top);
+                break;
+
             case SANPERA_OP_DONE:
-                return ClampToQuantum(stack[stack_pos] * QuantumRange);
+                // NaN (e.g., from pow) has no sensible pixel value, and
+                // ClampToQuantum doesn't know what to do with it either
+                top = stack[stack_pos];
+                for (lane = 0; lane < 4; lane++)
+                    out[lane] = (top[lane] != top[lane]) ? 0. : top[lane];
+                return;
         }
     }
 }
@@ -0,0 +1,296 @@
+"""Native code generation for compiled filters.
+
+Turns a compiled filter program into straight-line C, builds it with cffi, and
+hands back a function pointer that the band loop in _api_extra.c can call
+instead of interpreting the program.  Stack slots become local arrays, since
+the depth at every step is known ahead of time, so there's no dispatch and no
+stack traffic left.
+
+Built modules are cached on disk, so each program only has to be compiled
+once per machine.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import math
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+from sanpera._api import ffi, lib
+from sanpera.imagemagick import HAS_HDRI
+
+
+# Bump this whenever the generated code changes, so stale modules in the cache
+# aren't reused
+_CODEGEN_VERSION = 5
+
+# Per-lane C for each op.  {r} is the result; {a}, {b}, {c} are the arguments,
+# in the order they were pushed; {v} and {w} are the step's value and addend.
+# All of these must behave exactly like sanpera_evaluate_filter_pixel.
+_LANE_TEMPLATES = {
+    lib.SANPERA_OP_LOAD_SOURCE_COLOR: "{r} = in[{lane}];",
+    lib.SANPERA_OP_LOAD_COLOR: "{r} = {v};",
+    lib.SANPERA_OP_LOAD_NUMBER: "{r} = {v};",
+    lib.SANPERA_OP_ADD: "{r} = {a} + {b};",
+    lib.SANPERA_OP_MULTIPLY: "{r} = {a} * {b};",
+    lib.SANPERA_OP_CLAMP: "{r} = {a} < 0. ? 0. : ({a} > 1. ? 1. : {a});",
+    lib.SANPERA_OP_SUBTRACT: "{r} = {a} - {b};",
+    lib.SANPERA_OP_DIVIDE: "{r} = {b} == 0. ? 0. : {a} / {b};",
+    lib.SANPERA_OP_MIN: "{r} = {b} < {a} ? {b} : {a};",
+    lib.SANPERA_OP_MAX: "{r} = {b} > {a} ? {b} : {a};",
+    lib.SANPERA_OP_POW: "{r} = pow({a}, {b});",
+    lib.SANPERA_OP_ABS: "{r} = fabs({a});",
+    lib.SANPERA_OP_NEGATE: "{r} = -{a};",
+    lib.SANPERA_OP_LESS: "{r} = {a} < {b} ? 1. : 0.;",
+    lib.SANPERA_OP_LESS_EQUAL: "{r} = {a} <= {b} ? 1. : 0.;",
+    lib.SANPERA_OP_GREATER: "{r} = {a} > {b} ? 1. : 0.;",
+    lib.SANPERA_OP_GREATER_EQUAL: "{r} = {a} >= {b} ? 1. : 0.;",
+    lib.SANPERA_OP_SELECT: "{r} = {a} != 0. ? {b} : {c};",
+    lib.SANPERA_OP_ADD_CONSTANT: "{r} = {a} + {v};",
+    lib.SANPERA_OP_MULTIPLY_CONSTANT: "{r} = {a} * {v};",
+    lib.SANPERA_OP_MULTIPLY_ADD: "{r} = {a} * {b} + {c};",
+    lib.SANPERA_OP_MULTIPLY_ADD_CONSTANT: "{r} = {a} * {v} + {w};",
+    lib.SANPERA_OP_DONE: "out[{lane}] = {a} != {a} ? 0. : {a};",
+}
+
+# Copies of sanpera_filter_fetch and sanpera_rgb_to_hsl from _api_extra.c; keep
+# them in sync
+_PREAMBLE = """
+#include <math.h>
+#include <sys/types.h>
+
+typedef void (*sanpera_filter_fetch)(const void *, size_t, ssize_t, ssize_t, double *);
+
+#define SANPERA_CLAMP_UNIT(value) ((value) < 0. ? 0. : ((value) > 1. ? 1. : (value)))
+static void sanpera_rgb_to_hsl(double lanes[4])
+{
+#ifdef SANPERA_HDRI
+    double red = lanes[0], green = lanes[1], blue = lanes[2];
+#else
+    double red = SANPERA_CLAMP_UNIT(lanes[0]);
+    double green = SANPERA_CLAMP_UNIT(lanes[1]);
+    double blue = SANPERA_CLAMP_UNIT(lanes[2]);
+#endif
+    double max = red > green ? (red > blue ? red : blue) : (green > blue ? green : blue);
+    double min = red < green ? (red < blue ? red : blue) : (green < blue ? green : blue);
+    double delta = max - min;
+    double hue, saturation, lightness;
+
+    lightness = (max + min) / 2.;
+    if (delta == 0.) {
+        lanes[0] = lanes[1] = 0.;
+        lanes[2] = lightness;
+        return;
+    }
+
+    if (lightness <= 0.5)
+        saturation = delta / (max + min);
+    else
+        saturation = delta / (2. - max - min);
+
+    if (red == max)
+        hue = (green - blue) / delta;
+    else if (green == max)
+        hue = 2. + (blue - red) / delta;
+    else
+        hue = 4. + (red - green) / delta;
+    hue = hue / 6.;
+    hue -= floor(hue);
+
+    lanes[0] = hue;
+    lanes[1] = saturation;
+    lanes[2] = lightness;
+}
+"""
+
+
+_KERNEL_SIGNATURE = (
+    "void sanpera_native_kernel(const double in[4], "
+    "sanpera_filter_fetch fetch, const void *windows, double out[4])")
+
+
+def _c_double(value):
+    # Hex float literals are exact, so constants don't drift on the way through
+    value = float(value)
+    if math.isnan(value):
+        return "NAN"
+    if math.isinf(value):
+        return "HUGE_VAL" if value > 0 else "-HUGE_VAL"
+    return value.hex()
+
+
+def generate_source(steps, arity):
+    """Return C source for a kernel that runs the given compiled program.
+
+    `arity` maps each op to how many values it pops, as in `filters._ARITY`.
+    """
+    lines = []
+    depth = 0
+    max_depth = 1
+    for step in steps:
+        op = step['op']
+        base = depth - arity[op]
+        args = ["s{0}".format(base + n) for n in range(arity[op])]
+        result = "s{0}".format(base)
+
+        if op == lib.SANPERA_OP_LOAD_SOURCE_COLOR and (
+                step['frame'] or step['dx'] or step['dy']):
+            lines.append("    fetch(windows, {0}, {1}, {2}, {3});".format(
+                step['frame'], step['dx'], step['dy'], result))
+        elif op == lib.SANPERA_OP_SWIZZLE:
+            lanes = [int(lane) for lane in step['value']]
+            lines.append("    {{ double t[4] = {{{0}}};".format(
+                ", ".join("{0}[{1}]".format(result, lane) for lane in lanes)))
+            lines.append("      {0}[0] = t[0]; {0}[1] = t[1]; {0}[2] = t[2]; {0}[3] = t[3]; }}".format(result))
+        elif op == lib.SANPERA_OP_COMBINE:
+            for lane in range(1, 4):
+                lines.append("    {0}[{1}] = {2}[{1}];".format(result, lane, args[lane]))
+        elif op == lib.SANPERA_OP_LUMA:
+            lines.append(
+                "    {0}[0] = {0}[1] = {0}[2] = "
+                "0.212656 * {0}[0] + 0.715158 * {0}[1] + 0.072186 * {0}[2];".format(result))
+        elif op == lib.SANPERA_OP_HSL:
+            lines.append("    sanpera_rgb_to_hsl({0});".format(result))
+        else:
+            template = _LANE_TEMPLATES[op]
+            for lane in range(4):
+                names = dict(
+                    lane=lane,
+                    r="{0}[{1}]".format(result, lane),
+                    v=_c_double(step['value'][lane]),
+                    w=_c_double(step['addend'][lane]),
+                )
+                for name, arg in zip('abc', args):
+                    names[name] = "{0}[{1}]".format(arg, lane)
+                lines.append("    " + template.format(**names))
+
+        if op != lib.SANPERA_OP_DONE:
+            depth = base + 1
+            max_depth = max(max_depth, depth)
+
+    declarations = ["    double {0};".format(
+        ", ".join("s{0}[4]".format(n) for n in range(max_depth)))]
+    # HSL conversion only clamps in non-HDRI builds, like RGBColor.hsl()
+    config = ["#define SANPERA_HDRI 1"] if HAS_HDRI else []
+    return "\n".join(
+        config + [_PREAMBLE,
+        _KERNEL_SIGNATURE,
+        "{"] + declarations + lines + ["}", ""])
+
+
+def _quantum_config():
+    depth = ffi.new("size_t *")
+    lib.GetMagickQuantumDepth(depth)
+    return "Q{0}{1}".format(depth[0], "-HDRI" if HAS_HDRI else "")
+
+
+def cache_dir():
+    """Where built kernels live.  Set ``SANPERA_CACHE_DIR`` to override."""
+    path = os.environ.get('SANPERA_CACHE_DIR')
+    if path:
+        return path
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sanpera', 'filters')
+
+
+def _extension_suffixes():
+    try:
+        from importlib.machinery import EXTENSION_SUFFIXES
+    except ImportError:
+        # Python 2
+        return ['.so', '.pyd']
+    return EXTENSION_SUFFIXES
+
+
+def _load_extension(module_name, path):
+    try:
+        from importlib.machinery import ExtensionFileLoader
+        from importlib.util import module_from_spec
+        from importlib.util import spec_from_file_location
+    except ImportError:
+        # Python 2
+        import imp
+        return imp.load_dynamic(module_name, path)
+
+    loader = ExtensionFileLoader(module_name, path)
+    spec = spec_from_file_location(module_name, path, loader=loader)
+    module = module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def _find_built(directory, module_name):
+    for suffix in _extension_suffixes():
+        path = os.path.join(directory, module_name + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+# Modules already loaded by this process, by name
+_loaded = {}
+_lock = threading.Lock()
+
+
+def load_kernel(steps, arity):
+    """Return ``(module, kernel)`` for a compiled program, building it first if
+    it's not in the cache.  `kernel` is a ``sanpera_filter_kernel`` pointer
+    that's only valid as long as `module` is alive.
+    """
+    source = generate_source(steps, arity)
+    key = hashlib.sha1("\n".join([
+        str(_CODEGEN_VERSION), _quantum_config(), source,
+    ]).encode('utf8')).hexdigest()
+    module_name = "_sanpera_filter_" + key[:20]
+
+    with _lock:
+        module = _loaded.get(module_name)
+        if module is None:
+            directory = cache_dir()
+            path = _find_built(directory, module_name)
+            if path is None:
+                path = _build(directory, module_name, source)
+            module = _loaded[module_name] = _load_extension(module_name, path)
+
+    address = int(module.ffi.cast(
+        "uintptr_t", module.ffi.addressof(module.lib, "sanpera_native_kernel")))
+    return module, ffi.cast("sanpera_filter_kernel", address)
+
+
+def _build(directory, module_name, source):
+    # Lazy import; cffi's build machinery isn't needed unless something
+    # actually gets built
+    import cffi
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process got there first
+            if not os.path.isdir(directory):
+                raise
+
+    builder = cffi.FFI()
+    builder.cdef(
+        "typedef void (*sanpera_filter_fetch)(const void *, size_t, ssize_t, ssize_t, double *);\n"
+        "void sanpera_native_kernel(const double *, sanpera_filter_fetch, const void *, double *);")
+    builder.set_source(module_name, source)
+
+    # Build somewhere private, then move the result into place in one go, so
+    # other processes never see a half-written module
+    tmpdir = tempfile.mkdtemp(prefix=module_name, dir=directory)
+    try:
+        built = builder.compile(tmpdir=tmpdir)
+        path = os.path.join(directory, os.path.basename(built))
+        os.rename(built, path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return path
@@ -307,6 +307,11 @@ class RGBColor(BaseColor):
     def alpha(self):
         return self._opacity
 
+    @property
+    def luma(self):
+        """Perceived brightness, using the same weights as ``-fx``."""
+        return 0.212656 * self._red + 0.715158 * self._green + 0.072186 * self._blue
+
     def rgb(self):
         return self
 
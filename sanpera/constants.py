@@ -31,3 +31,4 @@ class Channel(CEnum):
     red = 'RedChannel'
     blue = 'BlueChannel'
     green = 'GreenChannel'
+    alpha = 'AlphaChannel'
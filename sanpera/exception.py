@@ -98,6 +98,13 @@ class MissingFormatError(SanperaError):
 class EmptyImageError(SanperaError):
     message = "Can't write an image that has zero frames"
 
+class FilterCompileError(SanperaError):
+    """A filter does something that can't be compiled, and has to run in
+    Python instead.
+    """
+
+class FilterCompileWarning(SanperaWarning): pass
+
 ### Translations of ImageMagick errors
 class GenericMagickWarning(SanperaWarning): pass
 class GenericMagickError(SanperaError): pass
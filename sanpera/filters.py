@@ -31,28 +31,40 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from collections import OrderedDict
+from collections import namedtuple
 from functools import partial
+import math
+import operator
+import array
+import threading
+import types
+import warnings
 
 from sanpera._api import ffi, lib
 from sanpera.color import BaseColor
+from sanpera.color import RGBColor
+from sanpera.exception import FilterCompileError
+from sanpera.exception import FilterCompileWarning
+from sanpera.exception import MagickExceptionContext
+from sanpera.exception import magick_raise
 from sanpera.exception import magick_try
 from sanpera.image import Image
 from sanpera.image import ImageFrame
+from sanpera.imagemagick import HAS_HDRI
+
+try:
+    _number_types = (int, long, float)
+except NameError:
+    # Python 3
+    _number_types = (int, float)
 
 # TODO, some major remaining issues:
 # - need wrappers for more imagemagick filters
-# - be more sure that compiled filters won't, say, segfault.  for one, detect
-#   when the stack can overflow!
+# - be more sure that compiled filters won't, say, segfault
 # - need to expand the acceleration more, and more delicately auto-detect when
 #   it should work -- probably be more strict when guessing and kinda lax when
 #   asked explicitly?
-# - accelerated filters are a bit stupid with multiple channels and that would
-#   be nice to fix
-# - implement more of the -fx API:
-#   - neighborhood pixels (TODO how to restrict the range...?)
-#   - support multiple input frames
-#   - math operations
-#   - channel hijinks?
 # - unclear exactly what the output should be, especially when doing only one
 #   channel.  probably a color.
 # - write some example python implementations of existing filters, e.g. simple
@@ -105,14 +117,167 @@ class Colorize(object):
             return lib.ColorizeImage(frame._frame, opacity, color[0], exc.ptr)
 
 
+def _in_place(frame, func, *args):
+    """Run an ImageMagick function that modifies an image in place on a copy of
+    the given frame, and return the copy.
+    """
+    with magick_try() as exc:
+        new_frame = lib.CloneImage(frame._frame, 0, 0, lib.MagickTrue, exc.ptr)
+        exc.check(new_frame == ffi.NULL)
+
+    # These report problems on the image itself
+    try:
+        ok = func(new_frame, *args)
+        magick_raise(new_frame.exception, force=not ok)
+    except Exception:
+        lib.DestroyImage(new_frame)
+        raise
+
+    return new_frame
+
+
+class Blur(object):
+    """Gaussian blur.  `sigma` is the standard deviation, in pixels; `radius`
+    is how far out to look, or 0 to pick something suitable for `sigma`.
+    """
+    def __init__(self, sigma, radius=0.):
+        self._sigma = sigma
+        self._radius = radius
+
+    @_builtin_image_filter
+    def __call__(self, frame, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+        with magick_try() as exc:
+            new_frame = lib.BlurImageChannel(
+                frame._frame, channel, self._radius, self._sigma, exc.ptr)
+            exc.check(new_frame == ffi.NULL)
+        return new_frame
+
+
+class Sharpen(object):
+    """Sharpen, by way of a Gaussian; arguments are as for `Blur`."""
+    def __init__(self, sigma, radius=0.):
+        self._sigma = sigma
+        self._radius = radius
+
+    @_builtin_image_filter
+    def __call__(self, frame, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+        with magick_try() as exc:
+            new_frame = lib.SharpenImageChannel(
+                frame._frame, channel, self._radius, self._sigma, exc.ptr)
+            exc.check(new_frame == ffi.NULL)
+        return new_frame
+
+
+class Level(object):
+    """Stretch the range from `black` to `white` (both in [0.0, 1.0]) to cover
+    the full range, then apply `gamma`.  Like ``-level``.
+    """
+    def __init__(self, black=0., white=1., gamma=1.):
+        self._black = black
+        self._white = white
+        self._gamma = gamma
+
+    @_builtin_image_filter
+    def __call__(self, frame, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+        return _in_place(
+            frame, lib.LevelImageChannel, channel,
+            self._black * lib.QuantumRange, self._white * lib.QuantumRange,
+            self._gamma)
+
+
+class Gamma(object):
+    """Gamma correction, like ``-gamma``: values above 1 brighten."""
+    def __init__(self, gamma):
+        self._gamma = gamma
+
+    @_builtin_image_filter
+    def __call__(self, frame, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+        return _in_place(frame, lib.GammaImageChannel, channel, self._gamma)
+
+
+class Modulate(object):
+    """Scale brightness and saturation, and rotate hue, like ``-modulate``.
+    All three are factors, so 1.0 means no change; a `hue` of 0.0 or 2.0
+    rotates it by 180 degrees.
+
+    ImageMagick always modulates all three color channels together, so this
+    ignores ``channel``.
+    """
+    def __init__(self, brightness=1., saturation=1., hue=1.):
+        self._brightness = brightness
+        self._saturation = saturation
+        self._hue = hue
+
+    @_builtin_image_filter
+    def __call__(self, frame, **kwargs):
+        modulate = "{0!r},{1!r},{2!r}".format(
+            self._brightness * 100., self._saturation * 100., self._hue * 100.)
+        return _in_place(frame, lib.ModulateImage, modulate.encode('ascii'))
+
+
+class Negate(object):
+    """Invert colors.  With `grayscale`, only gray pixels are inverted."""
+    def __init__(self, grayscale=False):
+        self._grayscale = grayscale
+
+    @_builtin_image_filter
+    def __call__(self, frame, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+        return _in_place(
+            frame, lib.NegateImageChannel, channel,
+            lib.MagickTrue if self._grayscale else lib.MagickFalse)
+
+
+class ContrastStretch(object):
+    """Stretch contrast so the darkest `black` and brightest `white` fractions
+    of pixels become pure black and white, like ``-contrast-stretch``.
+    """
+    def __init__(self, black=0., white=0.):
+        self._black = black
+        self._white = white
+
+    @_builtin_image_filter
+    def __call__(self, frame, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+        # ImageMagick wants pixel counts, and the white point counted from
+        # the bottom
+        pixels = frame._frame.columns * frame._frame.rows
+        return _in_place(
+            frame, lib.ContrastStretchImageChannel, channel,
+            self._black * pixels, pixels - self._white * pixels)
+
+
 # ------------------------------------------------------------------------------
 # DWIM filter compiler: tries C, falls back to Python if it doesn't compile.
 
-def image_filter(impl):
+def image_filter(impl=None, vectorized=False):
+    """Turn a function into a filter.
+
+    By default, the function is called with a `FilterState` for each pixel,
+    and returns its new color; it's compiled to C if at all possible.  Use
+    ``@image_filter(vectorized=True)`` to get a whole row at a time instead;
+    see `vectorized_image_filter`.
+    """
+    if impl is None:
+        return partial(image_filter, vectorized=vectorized)
+    if vectorized:
+        return vectorized_image_filter(impl)
+
     try:
         return compiled_image_filter(impl)
-    except Exception:
-        return python_image_filter(impl)
+    except FilterCompileError as e:
+        # Python filters are much slower, so say why this one didn't compile;
+        # the reason is also kept on the filter
+        warnings.warn(FilterCompileWarning(
+            "Running filter {0} in Python: {1}".format(
+                getattr(impl, '__name__', impl), e)))
+        ret = python_image_filter(impl)
+        ret.compile_error = e
+        return ret
 
 
 # ------------------------------------------------------------------------------
@@ -120,6 +285,92 @@ def image_filter(impl):
 # every pixel in the image.  Not particularly speedy, but super flexible.
 # TODO docs
 
+def _lanes(value):
+    """Return a color or number as red, green, blue, and alpha, the way
+    compiled filters see it; or None if it's neither.
+    """
+    if isinstance(value, BaseColor):
+        rgb = value.rgb()
+        return (rgb._red, rgb._green, rgb._blue, rgb._opacity)
+    if isinstance(value, _number_types):
+        return (value,) * 4
+    return None
+
+
+def _lanewise_op(func, reflected=False):
+    def method(self, other):
+        other = _lanes(other)
+        if other is None:
+            return NotImplemented
+        lanes = zip(_lanes(self), other)
+        if reflected:
+            return _FilterColor(*[func(b, a) for a, b in lanes])
+        return _FilterColor(*[func(a, b) for a, b in lanes])
+    return method
+
+
+def _divide(a, b):
+    # Dividing by zero gives zero, as in compiled filters
+    if b == 0:
+        return 0.
+    return a / b
+
+
+def _pow(base, exponent):
+    # Give what C's pow() would, rather than raising
+    try:
+        return math.pow(base, exponent)
+    except OverflowError:
+        return float('inf')
+    except ValueError:
+        if base == 0:
+            return float('inf')
+        return float('nan')
+
+
+class _FilterColor(RGBColor):
+    """The colors a Python filter sees.  Unlike a plain `RGBColor`, arithmetic
+    works on every channel, alpha included, with a number applying to every
+    channel alike; this matches compiled filters, so the same filter gives the
+    same results when it has to run in Python.
+    """
+    @classmethod
+    def _from_pixel(cls, pixel):
+        array = ffi.new("double[]", 4)
+        lib.sanpera_pixel_to_doubles(pixel, array)
+        return cls._from_c_array(array)
+
+    __add__ = _lanewise_op(operator.add)
+    __radd__ = _lanewise_op(operator.add, reflected=True)
+    __sub__ = _lanewise_op(operator.sub)
+    __rsub__ = _lanewise_op(operator.sub, reflected=True)
+    __mul__ = _lanewise_op(operator.mul)
+    __rmul__ = _lanewise_op(operator.mul, reflected=True)
+    __truediv__ = __div__ = _lanewise_op(_divide)
+    __rtruediv__ = __rdiv__ = _lanewise_op(_divide, reflected=True)
+    __pow__ = _lanewise_op(_pow)
+    __rpow__ = _lanewise_op(_pow, reflected=True)
+
+    # Comparisons give 1.0 or 0.0 per channel, for use with select()
+    __lt__ = _lanewise_op(lambda a, b: float(a < b))
+    __le__ = _lanewise_op(lambda a, b: float(a <= b))
+    __gt__ = _lanewise_op(lambda a, b: float(a > b))
+    __ge__ = _lanewise_op(lambda a, b: float(a >= b))
+
+    def __neg__(self):
+        return _FilterColor(*[-lane for lane in _lanes(self)])
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return _FilterColor(*[abs(lane) for lane in _lanes(self)])
+
+    def clamped(self):
+        # Compiled filters clamp even with HDRI
+        return _FilterColor(*[min(max(lane, 0.), 1.) for lane in _lanes(self)])
+
+
 class FilterState(object):
     """Current state of filter execution.  Contains information about the
     current pixel, neighboring pixels, etc.
@@ -131,8 +382,42 @@ class FilterState(object):
     def color(self):
         return self._color
 
+    def at(self, dx, dy):
+        """Return the state of a neighboring pixel, `dx` pixels to the right
+        and `dy` pixels down.  Pixels beyond the edges of the image come from
+        its virtual pixel method.
+
+        Compiled filters can only look up to `MAX_NEIGHBOR_OFFSET` pixels away
+        in each direction.
+        """
+        return self._other(self._index, self._x + dx, self._y + dy)
+
+    def frame(self, n):
+        """Return the state of the same pixel in the `n`th frame passed to the
+        filter.  Frames smaller than the first are filled out with their
+        virtual pixel method.
+        """
+        return self._other(n, self._x, self._y)
+
+    def _other(self, index, x, y):
+        pixel = ffi.new("PixelPacket *")
+        with magick_try() as exc:
+            lib.GetOneCacheViewVirtualPixel(
+                self._views[index], x, y, pixel, exc.ptr)
+
+        other = FilterState()
+        other._views = self._views
+        other._index = index
+        other._x = x
+        other._y = y
+        other._color = _FilterColor._from_pixel(pixel)
+        return other
+
 
 class python_image_filter(object):
+    # Set by image_filter to the reason it couldn't compile this filter
+    compile_error = None
+
     def __init__(self, impl):
         self.impl = impl
 
@@ -171,61 +456,173 @@ class python_image_filter(object):
 
         out_view = lib.AcquireCacheView(new_stack)
 
-        # TODO i need to be a list
-        in_view = lib.AcquireCacheView(frame._frame)
+        in_views = [lib.AcquireCacheView(f._frame) for f in frames]
 
         state = FilterState()
+        state._views = in_views
+        state._index = 0
+
+        try:
+            for y in range(frame._frame.rows):
+
+                with magick_try() as exc:
+                    q = lib.GetCacheViewAuthenticPixels(out_view, 0, y, frame._frame.columns, 1, exc.ptr)
+                    exc.check(q == ffi.NULL)
+
+                # TODO is this useful who knows
+                #fx_indexes=GetCacheViewAuthenticIndexQueue(fx_view);
+
+                for x in range(frame._frame.columns):
+                    # TODO per-channel things
+                    # TODO for usage: see line 1453
+
+                    #GetMagickPixelPacket(image,&pixel);
+                    #(void) InterpolateMagickPixelPacket(image,fx_info->view[i],image->interpolate, point.x,point.y,&pixel,exception);
+
+                    # Set up state object
+                    # TODO document that this is reused, or somethin
+                    state._x = x
+                    state._y = y
+                    state._color = _FilterColor._from_pixel(q)
+                    ret = self.impl(state)
+
+                    #q.red = c_api.RoundToQuantum(<c_api.MagickRealType> ret.c_struct.red * c_api.QuantumRange)
+                    #q.green = c_api.RoundToQuantum(<c_api.MagickRealType> ret.c_struct.green * c_api.QuantumRange)
+                    #q.blue = c_api.RoundToQuantum(<c_api.MagickRealType> ret.c_struct.blue * c_api.QuantumRange)
+                    # TODO black, opacity?
+                    # TODO seems like this should apply to any set of channels, but
+                    # IM's -fx only understands RGB
+
+                    # TODO this is a little invasive, but given that this inner
+                    # loop runs for every fucking pixel, i'd like to avoid method
+                    # calls as much as possible.  even that rgb() can add up
+                    if isinstance(ret, _number_types):
+                        # Numbers apply to every channel alike, as when compiled
+                        ret = RGBColor(ret, ret, ret, ret)
+                    rgb = ret.rgb()
+                    lib.sanpera_pixel_from_doubles_channel(q, rgb._array, c_channel)
+
+                    # XXX this is actually black
+                    #  if (((channel & IndexChannel) != 0) && (fx_image->colorspace == CMYKColorspace)) {
+                    #      (void) FxEvaluateChannelExpression(fx_info[id],IndexChannel,x,y, &alpha,exception);
+                    #      SetPixelIndex(fx_indexes+x,RoundToQuantum((MagickRealType) QuantumRange*alpha));
+                    #    }
+
+                    q += 1  # q++
+
+                with magick_try() as exc:
+                    exc.check(not lib.SyncCacheViewAuthenticPixels(out_view, exc.ptr))
+        except Exception:
+            lib.DestroyImage(new_stack)
+            raise
+        finally:
+            for view in in_views:
+                lib.DestroyCacheView(view)
+            lib.DestroyCacheView(out_view)
 
-        for y in range(frame._frame.rows):
-
-            with magick_try() as exc:
-                q = lib.GetCacheViewAuthenticPixels(out_view, 0, y, frame._frame.columns, 1, exc.ptr)
-                exc.check(q == ffi.NULL)
+        return Image(new_stack)
 
-            # TODO is this useful who knows
-            #fx_indexes=GetCacheViewAuthenticIndexQueue(fx_view);
 
-            for x in range(frame._frame.columns):
-                # TODO per-channel things
-                # TODO for usage: see line 1453
+class vectorized_image_filter(object):
+    """A Python filter that's called once per row, rather than once per pixel.
 
-                #GetMagickPixelPacket(image,&pixel);
-                #(void) InterpolateMagickPixelPacket(image,fx_info->view[i],image->interpolate, point.x,point.y,&pixel,exception);
+    The function gets the current row of every frame passed to the filter, as
+    packed RGBA floats in [0.0, 1.0], and returns the new row in the same
+    form.  With NumPy, rows are arrays of shape ``(width, 4)``; without it,
+    they're flat ``array('d')``s of ``width * 4`` floats.  Either way, any
+    sequence of the right length is accepted in return.
 
-                # Set up state object
-                # TODO document that this is reused, or somethin
-                state._color = BaseColor._from_pixel(q)
-                ret = self.impl(state)
+    As with `FilterState`, the row buffers are reused, so don't keep them
+    around.  Modifying and returning them is fine.
 
-                #q.red = c_api.RoundToQuantum(<c_api.MagickRealType> ret.c_struct.red * c_api.QuantumRange)
-                #q.green = c_api.RoundToQuantum(<c_api.MagickRealType> ret.c_struct.green * c_api.QuantumRange)
-                #q.blue = c_api.RoundToQuantum(<c_api.MagickRealType> ret.c_struct.blue * c_api.QuantumRange)
-                # TODO black, opacity?
-                # TODO seems like this should apply to any set of channels, but
-                # IM's -fx only understands RGB
+    The output is the size of the first frame; rows of other frames are read
+    at the same coordinates, filled out with their virtual pixel method.
+    """
+    def __init__(self, impl):
+        self.impl = impl
 
-                # TODO this is a little invasive, but given that this inner
-                # loop runs for every fucking pixel, i'd like to avoid method
-                # calls as much as possible.  even that rgb() can add up
-                rgb = ret.rgb()
-                lib.sanpera_pixel_from_doubles_channel(q, rgb._array, c_channel)
+    def __call__(self, *frames, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+        c_channel = ffi.cast('ChannelType', channel)
 
-                # XXX this is actually black
-                #  if (((channel & IndexChannel) != 0) && (fx_image->colorspace == CMYKColorspace)) {
-                #      (void) FxEvaluateChannelExpression(fx_info[id],IndexChannel,x,y, &alpha,exception);
-                #      SetPixelIndex(fx_indexes+x,RoundToQuantum((MagickRealType) QuantumRange*alpha));
-                #    }
+        frame = frames[0]._frame
+        with magick_try() as exc:
+            # Same as compiled filters, which turns on alpha if it's asked for
+            new_frame = lib.sanpera_evaluate_filter_destination(
+                ffi.new("Image *[]", [frame, ffi.NULL]), c_channel, exc.ptr)
+            exc.check(new_frame == ffi.NULL)
 
-                q += 1  # q++
+        with magick_try() as exc:
+            in_views = [
+                lib.AcquireVirtualCacheView(f._frame, exc.ptr) for f in frames]
+            out_view = lib.AcquireAuthenticCacheView(new_frame, exc.ptr)
+
+        try:
+            self._run(in_views, out_view, frame.columns, frame.rows, c_channel)
+        except Exception:
+            lib.DestroyImage(new_frame)
+            raise
+        finally:
+            for view in in_views:
+                lib.DestroyCacheView(view)
+            lib.DestroyCacheView(out_view)
 
-            with magick_try() as exc:
-                lib.SyncCacheViewAuthenticPixels(in_view, exc.ptr)
-                # TODO check exception, return value
+        return Image(new_frame)
 
-        # XXX destroy in_view
-        # XXX destroy out_view s
+    def _run(self, in_views, out_view, columns, rows, c_channel):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
 
-        return Image(new_stack)
+        width = columns * 4
+        if numpy is None:
+            buffers = [array.array('d', [0.]) * width for _ in in_views]
+        else:
+            buffers = [numpy.empty((columns, 4)) for _ in in_views]
+        sources = [ffi.from_buffer(buf) for buf in buffers]
+        try:
+            buffer_ptrs = [ffi.cast("double *", source) for source in sources]
+            for y in range(rows):
+                with magick_try() as exc:
+                    for view, buffer_ptr in zip(in_views, buffer_ptrs):
+                        p = lib.GetCacheViewVirtualPixels(
+                            view, 0, y, columns, 1, exc.ptr)
+                        exc.check(p == ffi.NULL)
+                        lib.sanpera_pixels_to_doubles(p, columns, buffer_ptr)
+
+                ret = self.impl(*buffers)
+                if numpy is None:
+                    if not isinstance(ret, array.array) or ret.typecode != 'd':
+                        ret = array.array('d', ret)
+                    length = len(ret)
+                else:
+                    ret = numpy.ascontiguousarray(ret, dtype=numpy.float64)
+                    length = ret.size
+                if length != width:
+                    raise ValueError(
+                        "Filter returned {0} values for a row of {1} pixels; "
+                        "expected {2}".format(length, columns, width))
+
+                self._write_row(out_view, y, columns, ret, c_channel)
+        finally:
+            for source in sources:
+                ffi.release(source)
+
+    def _write_row(self, out_view, y, columns, row, c_channel):
+        result = ffi.from_buffer(row)
+        try:
+            with magick_try() as exc:
+                # The new frame is a copy, so channels that weren't asked for
+                # are already right
+                q = lib.GetCacheViewAuthenticPixels(
+                    out_view, 0, y, columns, 1, exc.ptr)
+                exc.check(q == ffi.NULL)
+                lib.sanpera_pixels_from_doubles_channel(
+                    q, columns, ffi.cast("double *", result), c_channel)
+                exc.check(not lib.SyncCacheViewAuthenticPixels(out_view, exc.ptr))
+        finally:
+            ffi.release(result)
 
 
 # ------------------------------------------------------------------------------
@@ -237,119 +634,1189 @@ class python_image_filter(object):
 def op_(op, **kwargs):
     ret = dict(
         op=op,
-        color=ffi.NULL,
-        number=0.,
+        value=(0., 0., 0., 0.),
+        addend=(0., 0., 0., 0.),
+        dx=0,
+        dy=0,
+        frame=0,
     )
 
     ret.update(**kwargs)
     return ret
 
 
-def op_source_color():
-    return op_(lib.SANPERA_OP_LOAD_SOURCE_COLOR)
+def op_source_color(dx=0, dy=0, frame=0):
+    return op_(lib.SANPERA_OP_LOAD_SOURCE_COLOR, dx=dx, dy=dy, frame=frame)
 
 
 def op_number(value):
-    return dict(
-        op=lib.SANPERA_OP_LOAD_NUMBER,
-        color=ffi.NULL,
-        number=ffi.cast("double", value),
-    )
+    # Numbers apply to every channel alike
+    value = float(value)
+    return op_(lib.SANPERA_OP_LOAD_NUMBER, value=(value,) * 4)
 
 
 def op_color(color):
-    _color = ffi.new("PixelPacket *")
-    color._populate_pixel(_color)
+    # RGBA, with alpha rather than opacity, same as the evaluator uses
+    return op_(lib.SANPERA_OP_LOAD_COLOR, value=tuple(color.rgb()._array))
+
+
+# How many values each op pops off the evaluation stack.  Every op then pushes
+# one value back, except DONE, which returns it instead
+_ARITY = {
+    lib.SANPERA_OP_LOAD_SOURCE_COLOR: 0,
+    lib.SANPERA_OP_LOAD_COLOR: 0,
+    lib.SANPERA_OP_LOAD_NUMBER: 0,
+    lib.SANPERA_OP_ADD: 2,
+    lib.SANPERA_OP_MULTIPLY: 2,
+    lib.SANPERA_OP_CLAMP: 1,
+    lib.SANPERA_OP_SUBTRACT: 2,
+    lib.SANPERA_OP_DIVIDE: 2,
+    lib.SANPERA_OP_MIN: 2,
+    lib.SANPERA_OP_MAX: 2,
+    lib.SANPERA_OP_POW: 2,
+    lib.SANPERA_OP_ABS: 1,
+    lib.SANPERA_OP_NEGATE: 1,
+    lib.SANPERA_OP_LESS: 2,
+    lib.SANPERA_OP_LESS_EQUAL: 2,
+    lib.SANPERA_OP_GREATER: 2,
+    lib.SANPERA_OP_GREATER_EQUAL: 2,
+    lib.SANPERA_OP_SELECT: 3,
+    lib.SANPERA_OP_SWIZZLE: 1,
+    lib.SANPERA_OP_COMBINE: 4,
+    lib.SANPERA_OP_LUMA: 1,
+    lib.SANPERA_OP_HSL: 1,
+    lib.SANPERA_OP_ADD_CONSTANT: 1,
+    lib.SANPERA_OP_MULTIPLY_CONSTANT: 1,
+    lib.SANPERA_OP_MULTIPLY_ADD: 3,
+    lib.SANPERA_OP_MULTIPLY_ADD_CONSTANT: 1,
+    lib.SANPERA_OP_DONE: 1,
+}
+
+# How each op changes the height of the evaluation stack
+_STACK_EFFECTS = dict((op, 1 - arity) for op, arity in _ARITY.items())
+
+
+def stack_depth(steps):
+    """Return the most values a compiled program ever has on the stack at
+    once, so the evaluator can allocate exactly that much.
+
+    Also sanity-checks the program, since the evaluator doesn't: it must never
+    pop more than it's pushed, and it must end with exactly one value left.
+    """
+    depth = max_depth = 0
+    for step in steps:
+        depth += _STACK_EFFECTS[step['op']]
+        if depth < 1:
+            raise ValueError("Compiled filter underflows its stack")
+        max_depth = max(max_depth, depth)
 
-    return dict(
-        op=lib.SANPERA_OP_LOAD_COLOR,
-        color=_color,
-        number=0.,
-    )
+    if depth != 1:
+        raise ValueError(
+            "Compiled filter leaves {0} values on its stack".format(depth))
+
+    return max_depth
+
+
+# ------------------------------------------------------------------------------
+# Optimizer.  FilterCompiler spits out ops exactly as the operators were
+# applied, so this turns them back into an expression tree, simplifies it, and
+# emits a shorter program that uses the fused ops where it can.
+
+_CONSTANT_OPS = frozenset([lib.SANPERA_OP_LOAD_COLOR, lib.SANPERA_OP_LOAD_NUMBER])
+# Ops that use the `value` field
+_VALUE_OPS = _CONSTANT_OPS | frozenset([
+    lib.SANPERA_OP_ADD_CONSTANT,
+    lib.SANPERA_OP_MULTIPLY_CONSTANT,
+    lib.SANPERA_OP_MULTIPLY_ADD_CONSTANT,
+    lib.SANPERA_OP_SWIZZLE,
+])
+_COMMUTATIVE_OPS = frozenset([lib.SANPERA_OP_ADD, lib.SANPERA_OP_MULTIPLY])
+
+# Python versions of the ops that can be folded away when all their arguments
+# are constants; each one works on a single lane
+_FOLDERS = {
+    lib.SANPERA_OP_ADD: operator.add,
+    lib.SANPERA_OP_MULTIPLY: operator.mul,
+    lib.SANPERA_OP_CLAMP: lambda value: min(max(value, 0.), 1.),
+    lib.SANPERA_OP_SUBTRACT: operator.sub,
+    lib.SANPERA_OP_DIVIDE: lambda a, b: a / b if b else 0.,
+    lib.SANPERA_OP_MIN: min,
+    lib.SANPERA_OP_MAX: max,
+    lib.SANPERA_OP_POW: math.pow,
+    lib.SANPERA_OP_ABS: abs,
+    lib.SANPERA_OP_NEGATE: operator.neg,
+    lib.SANPERA_OP_LESS: lambda a, b: float(a < b),
+    lib.SANPERA_OP_LESS_EQUAL: lambda a, b: float(a <= b),
+    lib.SANPERA_OP_GREATER: lambda a, b: float(a > b),
+    lib.SANPERA_OP_GREATER_EQUAL: lambda a, b: float(a >= b),
+    lib.SANPERA_OP_SELECT: lambda c, a, b: a if c else b,
+}
+
+
+class _Node(object):
+    __slots__ = ('step', 'args')
+
+    def __init__(self, step, args=()):
+        self.step = step
+        self.args = list(args)
+
+    @property
+    def op(self):
+        return self.step['op']
+
+    @property
+    def value(self):
+        return self.step['value']
+
+    def is_constant(self, value=None):
+        if self.op not in _CONSTANT_OPS:
+            return False
+        if value is None:
+            return True
+        return all(lane == value for lane in self.value)
+
+
+def _build_tree(steps):
+    stack = []
+    for step in steps:
+        if step['op'] == lib.SANPERA_OP_DONE:
+            break
+
+        arity = _ARITY[step['op']]
+        args = stack[len(stack) - arity:]
+        del stack[len(stack) - arity:]
+        stack.append(_Node(step, args))
+
+    root, = stack
+    return root
+
+
+def _simplify(node):
+    node.args = args = [_simplify(arg) for arg in node.args]
+    op = node.op
+
+    # Constant folding
+    folder = _FOLDERS.get(op)
+    if folder and all(arg.is_constant() for arg in args):
+        try:
+            lanes = tuple(
+                folder(*lane) for lane in zip(*[arg.value for arg in args]))
+        except (ValueError, OverflowError):
+            # e.g. pow of a negative number; leave it for the evaluator
+            return node
+        if all(arg.op == lib.SANPERA_OP_LOAD_NUMBER for arg in args):
+            return _Node(op_(lib.SANPERA_OP_LOAD_NUMBER, value=lanes))
+        return _Node(op_(lib.SANPERA_OP_LOAD_COLOR, value=lanes))
+
+    # Keep constants on the right, so the rest only has to check there.  This
+    # is exact, since + and * are commutative even in floating point.  (They
+    # aren't associative, so (x + a) + b is left alone.)
+    if op in _COMMUTATIVE_OPS and args[0].is_constant():
+        args.reverse()
+
+    # Identities
+    if op == lib.SANPERA_OP_ADD and args[1].is_constant(0.):
+        return args[0]
+    if op == lib.SANPERA_OP_MULTIPLY and args[1].is_constant(1.):
+        return args[0]
+    if op == lib.SANPERA_OP_SUBTRACT and args[1].is_constant(0.):
+        return args[0]
+    if op in (lib.SANPERA_OP_DIVIDE, lib.SANPERA_OP_POW) and args[1].is_constant(1.):
+        return args[0]
+    if op == lib.SANPERA_OP_NEGATE and args[0].op == lib.SANPERA_OP_NEGATE:
+        return args[0].args[0]
+    if op == lib.SANPERA_OP_CLAMP and args[0].op == lib.SANPERA_OP_CLAMP:
+        return args[0]
+
+    return node
+
+
+def _emit(node, out):
+    op = node.op
+    args = node.args
+
+    if op == lib.SANPERA_OP_MULTIPLY and args[1].is_constant():
+        _emit(args[0], out)
+        out.append(op_(lib.SANPERA_OP_MULTIPLY_CONSTANT, value=args[1].value))
+    elif op == lib.SANPERA_OP_ADD and args[1].is_constant():
+        product = args[0]
+        if product.op == lib.SANPERA_OP_MULTIPLY and product.args[1].is_constant():
+            _emit(product.args[0], out)
+            out.append(op_(
+                lib.SANPERA_OP_MULTIPLY_ADD_CONSTANT,
+                value=product.args[1].value, addend=args[1].value))
+        else:
+            _emit(product, out)
+            out.append(op_(lib.SANPERA_OP_ADD_CONSTANT, value=args[1].value))
+    elif op == lib.SANPERA_OP_ADD and lib.SANPERA_OP_MULTIPLY in (args[0].op, args[1].op):
+        if args[0].op == lib.SANPERA_OP_MULTIPLY:
+            product, addend = args
+        else:
+            addend, product = args
+
+        if product.args[1].is_constant():
+            # MULTIPLY_CONSTANT then ADD is just as short, and needs less
+            # stack
+            _emit(product, out)
+            _emit(addend, out)
+            out.append(node.step)
+        else:
+            _emit(product.args[0], out)
+            _emit(product.args[1], out)
+            _emit(addend, out)
+            out.append(op_(lib.SANPERA_OP_MULTIPLY_ADD))
+    else:
+        for arg in args:
+            _emit(arg, out)
+        out.append(node.step)
+
+
+def optimize_steps(steps):
+    """Return an equivalent, hopefully faster, version of a compiled program.
+
+    Folds expressions made entirely of constants, drops no-ops like ``x * 1``
+    and ``x + 0``, and fuses multiplies and adds into single ops.  Nothing is
+    reordered, so the results are exactly the same as the original program's.
+    """
+    # Catch broken programs before trying to make sense of them
+    stack_depth(steps)
+
+    out = []
+    _emit(_simplify(_build_tree(steps)), out)
+    out.append(op_(lib.SANPERA_OP_DONE))
+    return out
+
+
+# Ops that only ever combine the same lane of their arguments, so a program
+# made of nothing else computes each channel purely from the same channel of
+# the source pixel
+_POINTWISE_OPS = frozenset([
+    lib.SANPERA_OP_LOAD_SOURCE_COLOR,
+    lib.SANPERA_OP_LOAD_COLOR,
+    lib.SANPERA_OP_LOAD_NUMBER,
+    lib.SANPERA_OP_ADD,
+    lib.SANPERA_OP_MULTIPLY,
+    lib.SANPERA_OP_CLAMP,
+    lib.SANPERA_OP_SUBTRACT,
+    lib.SANPERA_OP_DIVIDE,
+    lib.SANPERA_OP_MIN,
+    lib.SANPERA_OP_MAX,
+    lib.SANPERA_OP_POW,
+    lib.SANPERA_OP_ABS,
+    lib.SANPERA_OP_NEGATE,
+    lib.SANPERA_OP_LESS,
+    lib.SANPERA_OP_LESS_EQUAL,
+    lib.SANPERA_OP_GREATER,
+    lib.SANPERA_OP_GREATER_EQUAL,
+    lib.SANPERA_OP_SELECT,
+    lib.SANPERA_OP_ADD_CONSTANT,
+    lib.SANPERA_OP_MULTIPLY_CONSTANT,
+    lib.SANPERA_OP_MULTIPLY_ADD,
+    lib.SANPERA_OP_MULTIPLY_ADD_CONSTANT,
+    lib.SANPERA_OP_DONE,
+])
+
+
+def is_pointwise(steps):
+    """Return whether a compiled program computes each channel from only the
+    same channel of the source pixel, e.g. a gamma curve.  Such programs can be
+    run through a lookup table instead.
+    """
+    return all(
+        step['op'] in _POINTWISE_OPS
+        and step['dx'] == step['dy'] == step['frame'] == 0
+        for step in steps)
+
+
+def window_radius(steps):
+    """Return how far a compiled program looks from the current pixel, in any
+    direction.
+    """
+    return max([0] + [
+        max(abs(step['dx']), abs(step['dy']))
+        for step in steps
+        if step['op'] == lib.SANPERA_OP_LOAD_SOURCE_COLOR])
+
+
+def frame_count(steps):
+    """Return how many input frames a compiled program reads.  It always reads
+    at least the first, which decides the size of the output.
+    """
+    return 1 + max([0] + [
+        step['frame']
+        for step in steps
+        if step['op'] == lib.SANPERA_OP_LOAD_SOURCE_COLOR])
+
+
+def _format_lanes(lanes):
+    if all(lane == lanes[0] for lane in lanes):
+        return "{0:g}".format(lanes[0])
+    return "({0:g}, {1:g}, {2:g}, {3:g})".format(*lanes)
+
+
+def _format_step(step):
+    op = step['op']
+    name = ffi.string(ffi.cast('sanpera_evaluate_op', op))
+    parts = [name[len('SANPERA_OP_'):]]
+    if step['frame']:
+        parts.append("#{0}".format(step['frame']))
+    if step['dx'] or step['dy']:
+        parts.append("@({0}, {1})".format(step['dx'], step['dy']))
+    if op in _VALUE_OPS:
+        parts.append(_format_lanes(step['value']))
+    if op == lib.SANPERA_OP_MULTIPLY_ADD_CONSTANT:
+        parts.append(_format_lanes(step['addend']))
+    return ' '.join(parts)
+
+
+def _operand(value):
+    """Coerce a value used in a compiled filter to a `FilterCompiler`, or
+    return None if it's not something a filter can work with.
+    """
+    if isinstance(value, FilterCompiler):
+        if value.type not in ('color', 'number'):
+            raise FilterCompileError(
+                "Can't do math with a {0}; pick one of its channels".format(
+                    value.type))
+        return value
+    elif isinstance(value, _number_types):
+        return FilterCompiler('number', [op_number(value)])
+    elif isinstance(value, BaseColor):
+        return FilterCompiler('color', [op_color(value)])
+    else:
+        return None
+
+
+def _apply(op, *operands, **kwargs):
+    """Apply an op to some operands, which must already have gone through
+    `_operand`.  The result is a number if all the operands were.
+    """
+    ops = []
+    for operand in operands:
+        ops.extend(operand.ops)
+    ops.append(op_(op, **kwargs))
+
+    if all(operand.type == 'number' for operand in operands):
+        return FilterCompiler('number', ops)
+    return FilterCompiler('color', ops)
+
+
+def _binary_op(op, reflected=False):
+    def method(self, other):
+        other = _operand(other)
+        if other is None:
+            return NotImplemented
+        if reflected:
+            return _apply(op, other, _operand(self))
+        return _apply(op, _operand(self), other)
+    return method
+
+
+# Furthest a compiled filter may look from the current pixel, in either
+# direction.  Every row of output reads a window of rows around it, so farther
+# neighbors cost more memory and time; filters that look farther than this run
+# in Python instead
+MAX_NEIGHBOR_OFFSET = 64
 
 
 class FilterCompiler(object):
-    def __init__(self, type='pixel', ops=None):
+    def __init__(self, type='pixel', ops=None, offset=(0, 0), source=0):
         self.type = type
         if ops:
             self.ops = ops
         else:
             self.ops = []
+        # Only used for pixels: which input frame, and where in it
+        self.offset = offset
+        self.source = source
 
     @classmethod
     def _finalize(cls, compiler):
         if isinstance(compiler, cls):
+            if compiler.type not in ('color', 'number'):
+                raise FilterCompileError(
+                    "Filter returned a {0}, not a color or number".format(
+                        compiler.type))
             ops = compiler.ops
-        elif isinstance(compiler, (int, long, float)):
+        elif isinstance(compiler, _number_types):
             ops = [op_number(compiler)]
         elif isinstance(compiler, BaseColor):
             ops = [op_color(compiler)]
         else:
-            raise TypeError
+            raise FilterCompileError(
+                "Filter returned {0!r}, not a color or number".format(compiler))
 
         return ops + [op_(lib.SANPERA_OP_DONE)]
 
+    def __bool__(self):
+        raise FilterCompileError(
+            "Compiled filters can't branch on pixel values; use select()")
+
+    __nonzero__ = __bool__
+
     @property
     def color(self):
-        assert self.type == 'pixel'
-        return FilterCompiler('color', self.ops + [op_source_color()])
+        if self.type != 'pixel':
+            raise FilterCompileError("Only the filter state has a color")
+        return FilterCompiler(
+            'color', self.ops + [op_source_color(*self.offset, frame=self.source)])
+
+    def at(self, dx, dy):
+        if self.type != 'pixel':
+            raise FilterCompileError("Only the filter state has neighbors")
+        if int(dx) != dx or int(dy) != dy:
+            raise FilterCompileError(
+                "Neighbor offsets must be whole numbers, not {0!r}".format((dx, dy)))
+        offset = (self.offset[0] + int(dx), self.offset[1] + int(dy))
+        if max(abs(offset[0]), abs(offset[1])) > MAX_NEIGHBOR_OFFSET:
+            raise FilterCompileError(
+                "Neighbor offset {0!r} is more than {1} pixels away".format(
+                    offset, MAX_NEIGHBOR_OFFSET))
+        return FilterCompiler(
+            'pixel', self.ops, offset=offset, source=self.source)
+
+    def frame(self, n):
+        if self.type != 'pixel':
+            raise FilterCompileError("Only the filter state has frames")
+        if int(n) != n or n < 0:
+            raise FilterCompileError(
+                "Frame numbers must be whole numbers, not {0!r}".format(n))
+        return FilterCompiler('pixel', self.ops, offset=self.offset, source=int(n))
+
+    # Arithmetic
+    __add__ = _binary_op(lib.SANPERA_OP_ADD)
+    __radd__ = _binary_op(lib.SANPERA_OP_ADD, reflected=True)
+    __sub__ = _binary_op(lib.SANPERA_OP_SUBTRACT)
+    __rsub__ = _binary_op(lib.SANPERA_OP_SUBTRACT, reflected=True)
+    __mul__ = _binary_op(lib.SANPERA_OP_MULTIPLY)
+    __rmul__ = _binary_op(lib.SANPERA_OP_MULTIPLY, reflected=True)
+    __truediv__ = __div__ = _binary_op(lib.SANPERA_OP_DIVIDE)
+    __rtruediv__ = __rdiv__ = _binary_op(lib.SANPERA_OP_DIVIDE, reflected=True)
+    __pow__ = _binary_op(lib.SANPERA_OP_POW)
+    __rpow__ = _binary_op(lib.SANPERA_OP_POW, reflected=True)
+
+    def __neg__(self):
+        return _apply(lib.SANPERA_OP_NEGATE, _operand(self))
+
+    def __pos__(self):
+        return _operand(self)
+
+    def __abs__(self):
+        return _apply(lib.SANPERA_OP_ABS, _operand(self))
+
+    # Comparisons produce 1.0 or 0.0, for use with select().  There's no == or
+    # != because they'd make compilers unhashable, and they're not much use
+    # with floats anyway.
+    __lt__ = _binary_op(lib.SANPERA_OP_LESS)
+    __le__ = _binary_op(lib.SANPERA_OP_LESS_EQUAL)
+    __gt__ = _binary_op(lib.SANPERA_OP_GREATER)
+    __ge__ = _binary_op(lib.SANPERA_OP_GREATER_EQUAL)
+
+    def clamped(self):
+        return _apply(lib.SANPERA_OP_CLAMP, _operand(self))
+
+    # Channels.  These mirror the properties and methods on RGBColor, so the
+    # same filter can run in Python too.
+    def _channel(self, lane):
+        if self.type != 'color':
+            raise FilterCompileError(
+                "Only colors have channels, not a {0}".format(self.type))
+        return FilterCompiler(
+            'number', self.ops + [op_(lib.SANPERA_OP_SWIZZLE, value=(float(lane),) * 4)])
+
+    red = property(lambda self: self._channel(0))
+    green = property(lambda self: self._channel(1))
+    blue = property(lambda self: self._channel(2))
+    alpha = property(lambda self: self._channel(3))
+
+    @property
+    def luma(self):
+        if self.type != 'color':
+            raise FilterCompileError(
+                "Only colors have a luma, not a {0}".format(self.type))
+        return FilterCompiler('number', self.ops + [op_(lib.SANPERA_OP_LUMA)])
+
+    def rgb(self):
+        return _operand(self)
+
+    def hsl(self):
+        if self.type != 'color':
+            raise FilterCompileError(
+                "Only colors can be converted to HSL, not a {0}".format(self.type))
+        return FilterCompiler('hsl', self.ops + [op_(lib.SANPERA_OP_HSL)])
+
+    def _hsl_channel(self, lane):
+        if self.type != 'hsl':
+            raise FilterCompileError("Call .hsl() first")
+        return FilterCompiler(
+            'number', self.ops + [op_(lib.SANPERA_OP_SWIZZLE, value=(float(lane),) * 4)])
+
+    hue = property(lambda self: self._hsl_channel(0))
+    saturation = property(lambda self: self._hsl_channel(1))
+    lightness = property(lambda self: self._hsl_channel(2))
+
+
+del _binary_op
+
+
+# ------------------------------------------------------------------------------
+# Functions that work in both compiled and Python filters.  Plain Python
+# values are handled lane-wise, like the compiled versions.
+
+def _compiling(values):
+    return any(isinstance(value, FilterCompiler) for value in values)
+
+
+def _compile_call(op, values):
+    operands = []
+    for value in values:
+        operand = _operand(value)
+        if operand is None:
+            raise FilterCompileError(
+                "Can't use {0!r} in a compiled filter".format(value))
+        operands.append(operand)
+    return _apply(op, *operands)
 
-    def __mul__(self, other):
-        assert self.type in ('color', 'number')
 
-        if isinstance(other, FilterCompiler):
-            assert other.type in ('color', 'number')
-            ops = self.ops + other.ops
-        elif isinstance(other, (int, long, float)):
-            ops = self.ops + [op_number(other)]
+def _lanewise(func, values):
+    if all(isinstance(value, _number_types) for value in values):
+        return func(*values)
+
+    lanes = []
+    for value in values:
+        if isinstance(value, BaseColor):
+            rgb = value.rgb()
+            lanes.append((rgb.red, rgb.green, rgb.blue, rgb.alpha))
         else:
-            return NotImplemented
+            lanes.append((value,) * 4)
+    return _FilterColor(*[func(*lane) for lane in zip(*lanes)])
+
+
+def minimum(a, b):
+    """The smaller of two values, channel by channel for colors."""
+    if _compiling((a, b)):
+        return _compile_call(lib.SANPERA_OP_MIN, (a, b))
+    return _lanewise(min, (a, b))
+
+
+def maximum(a, b):
+    """The larger of two values, channel by channel for colors."""
+    if _compiling((a, b)):
+        return _compile_call(lib.SANPERA_OP_MAX, (a, b))
+    return _lanewise(max, (a, b))
+
+
+def select(condition, if_true, if_false):
+    """``if_true`` where ``condition`` is true (nonzero), otherwise
+    ``if_false``.  Works like ``if_true if condition else if_false`` for
+    numbers.  Any of the arguments may be a color, in which case every channel
+    is picked separately: a color condition, such as ``state.color > 0.5``,
+    picks each channel of the result by the same channel of the condition.
+    """
+    values = (condition, if_true, if_false)
+    if _compiling(values):
+        return _compile_call(lib.SANPERA_OP_SELECT, values)
+    return _lanewise(lambda c, t, f: t if c else f, values)
 
-        return FilterCompiler('number', ops + [op_(lib.SANPERA_OP_MULTIPLY)])
 
-    def __add__(self, other):
-        assert self.type in ('color', 'number')
+def rgba(red, green, blue, alpha=1.0):
+    """Build a color out of separate channels, e.g., to swap them around."""
+    values = (red, green, blue, alpha)
+    if _compiling(values):
+        return _compile_call(lib.SANPERA_OP_COMBINE, values)
+    return _FilterColor(red, green, blue, alpha)
 
-        if isinstance(other, FilterCompiler):
-            assert other.type in ('color', 'number')
-            ops = self.ops + other.ops
-        elif isinstance(other, (int, long, float)):
-            ops = self.ops + [op_number(other)]
+
+def _trace(impl, optimize):
+    """Compile a filter function to a program."""
+    # Pass a dummy state object into the callable to try to compile it.
+    # Anything that goes wrong means the function can't be compiled.
+    compiler = FilterCompiler()
+    try:
+        output = impl(compiler)
+        # The output might be a constant, which we can definitely do
+        # super fast; ask the compiler class to figure it out
+        steps = FilterCompiler._finalize(output)
+    except FilterCompileError:
+        raise
+    except Exception as e:
+        raise FilterCompileError(
+            "{0}: {1}".format(type(e).__name__, e))
+    if optimize:
+        steps = optimize_steps(steps)
+    return steps
+
+
+class _CompiledProgram(object):
+    """Everything worked out ahead of time for a compiled filter: the program
+    itself, ready to hand to C, and what's known about it.  Shared by every
+    filter compiled from the same function; see `_compile`.
+    """
+    def __init__(self, steps, backend):
+        self.steps = steps
+        # Only ever read, so every call (and thread) can share it
+        self.c_steps = ffi.new("sanpera_evaluate_step[]", steps)
+        # Each call allocates a stack of its own, so multiple threads can run
+        # the same filter at the same time
+        self.stack_depth = stack_depth(steps)
+        self.radius = window_radius(steps)
+        self.frame_count = frame_count(steps)
+        self.pointwise = is_pointwise(steps)
+        self.lut = None
+
+        if backend == 'vm':
+            self.kernel_module = None
+            self.kernel = ffi.NULL
+        elif backend == 'native':
+            from sanpera import _filter_native
+            try:
+                self.kernel_module, self.kernel = _filter_native.load_kernel(
+                    steps, _ARITY)
+            except Exception as e:
+                raise FilterCompileError(
+                    "Can't build native filter: {0}: {1}".format(
+                        type(e).__name__, e))
         else:
-            return NotImplemented
+            raise ValueError("Unknown filter backend {0!r}".format(backend))
 
-        return FilterCompiler('number', ops + [op_(lib.SANPERA_OP_ADD)])
+    def lookup_table(self):
+        # Built on first use, then kept.  If two threads race to build it,
+        # they just do the same work twice.
+        if self.lut is None:
+            table = ffi.new("char[]", lib.sanpera_filter_lut_size())
+            stack = ffi.new("double[][4]", self.stack_depth)
+            lib.sanpera_filter_lut_build(self.c_steps, stack, table)
+            self.lut = table
+        return self.lut
 
 
-    def clamped(self):
-        # TODO .clamped() only actually works on colors, not numbers
-        assert self.type in ('color', 'number')
-        return FilterCompiler('color', self.ops + [op_(lib.SANPERA_OP_CLAMP)])
+# Compiled programs, most recently used last, keyed by _compile_cache_key
+_compile_cache = OrderedDict()
+_compile_cache_lock = threading.Lock()
+_compile_cache_maxsize = 128
+_compile_cache_hits = 0
+_compile_cache_misses = 0
+
+CompileCacheInfo = namedtuple(
+    'CompileCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+# Modules whose functions and classes can be trusted to stay the same: sanpera's
+# own filter helpers and colors, and Python's builtins.  Anything else a filter
+# refers to is looked into, or the filter isn't cached at all
+_TRUSTED_MODULES = frozenset([
+    'sanpera.filters', 'sanpera.color', 'builtins', '__builtin__'])
+
+
+def _cache_key_part(value, active=()):
+    """Reduce a value a filter function refers to to something hashable that
+    changes whenever the value would compile differently.
+    """
+    if value is None or isinstance(value, _number_types + (str, bytes)):
+        return value
+    if isinstance(value, BaseColor):
+        return ('color',) + tuple(value.rgb()._array)
+    if isinstance(value, tuple):
+        return tuple(_cache_key_part(item, active) for item in value)
+    if isinstance(value, (types.FunctionType, type)) and (
+            getattr(value, '__module__', None) in _TRUSTED_MODULES):
+        return value
+    if isinstance(value, types.BuiltinFunctionType) and (
+            value.__self__ is None or
+            isinstance(value.__self__, types.ModuleType)):
+        # e.g. abs or math.sqrt, but not a method bound to some object
+        return value
+    if isinstance(value, types.FunctionType):
+        # A helper; what it does depends on what it refers to in turn
+        return _function_key(value, active)
+    # Everything else, including modules and classes, can change without
+    # changing identity
+    raise _Uncacheable
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def _function_key(func, active=()):
+    """Return a key for a function: its code, and the values of every closure
+    variable, default, and global it uses.  `active` is the functions whose
+    keys are already being worked out, to cope with recursion.
+    """
+    if func in active:
+        # Whatever it refers to is already part of the outer key
+        return ('recursive', func.__code__)
+    active = active + (func,)
+
+    code = func.__code__
+    closure = tuple(
+        _cache_key_part(cell.cell_contents, active)
+        for cell in func.__closure__ or ())
+    defaults = _cache_key_part(func.__defaults__, active)
+    # Python 3 only
+    kwdefaults = _cache_key_part(
+        tuple(sorted((getattr(func, '__kwdefaults__', None) or {}).items())),
+        active)
+    globals_ = tuple(
+        (name, _cache_key_part(func.__globals__[name], active))
+        for name in sorted(_code_names(code))
+        if name in func.__globals__)
+    return (code, closure, defaults, kwdefaults, globals_)
+
+
+def _compile_cache_key(impl, optimize, backend):
+    """Return a key identifying everything that goes into compiling `impl`,
+    including any helper functions it calls.  Returns None if it can't be
+    cached, e.g. because it's not a plain function or it refers to something
+    mutable, like a module or a class.
+    """
+    if not isinstance(impl, types.FunctionType):
+        return None
+
+    try:
+        key = _function_key(impl)
+    except (_Uncacheable, ValueError):
+        # ValueError is from an empty cell, i.e. a closure variable that
+        # hasn't been assigned yet
+        return None
+
+    return key + (optimize, backend)
+
+
+def _compile(impl, optimize, backend):
+    """Return a `_CompiledProgram` for a filter function, reusing a cached one
+    if the same function has been compiled before.
+    """
+    global _compile_cache_hits, _compile_cache_misses
+
+    key = _compile_cache_key(impl, optimize, backend)
+    if key is not None:
+        with _compile_cache_lock:
+            program = _compile_cache.pop(key, None)
+            if program is not None:
+                _compile_cache[key] = program
+                _compile_cache_hits += 1
+                return program
+            _compile_cache_misses += 1
+
+    # Compiling happens outside the lock, since it can take a while (or even
+    # run a C compiler); two threads racing on the same function just both
+    # compile it
+    program = _CompiledProgram(_trace(impl, optimize), backend)
+
+    if key is not None:
+        with _compile_cache_lock:
+            _compile_cache[key] = program
+            while len(_compile_cache) > _compile_cache_maxsize:
+                _compile_cache.popitem(last=False)
+
+    return program
+
+
+def compile_cache_info():
+    """Return statistics about the cache of compiled filters, as a
+    `CompileCacheInfo` with ``hits``, ``misses``, ``maxsize``, and
+    ``currsize``, like `functools.lru_cache`.
+
+    Filters made from the same function (with the same closure variables,
+    defaults, and globals, and likewise for any helper functions it calls)
+    share one compiled program, so creating them over and over, e.g. once per
+    request, only compiles once.  Functions that refer to anything that could
+    change without being replaced, such as a module, a class, or a list, are
+    compiled every time.
+    """
+    with _compile_cache_lock:
+        return CompileCacheInfo(
+            _compile_cache_hits, _compile_cache_misses,
+            _compile_cache_maxsize, len(_compile_cache))
+
+
+def clear_compile_cache(maxsize=None):
+    """Empty the cache of compiled filters and reset its statistics.  Pass
+    `maxsize` to also change how many programs it holds; 0 disables it.
+    """
+    global _compile_cache_hits, _compile_cache_misses, _compile_cache_maxsize
+
+    with _compile_cache_lock:
+        _compile_cache.clear()
+        _compile_cache_hits = _compile_cache_misses = 0
+        if maxsize is not None:
+            if maxsize < 0:
+                raise ValueError(
+                    "maxsize must be at least 0, not {0!r}".format(maxsize))
+            _compile_cache_maxsize = maxsize
 
 
 class compiled_image_filter(object):
-    def __init__(self, impl):
-        # This will throw all kinds of exceptions if the function can't be
-        # compiled
-        # TODO wrap them?
-        # Pass a dummy state object into the callable to try to compile it
-        compiler = FilterCompiler()
-        output = impl(compiler)
-        # The output might be a constant, which we can definitely do super
-        # fast; ask the compiler class to figure it out
-        self.compiled_steps = FilterCompiler._finalize(output)
+    """A filter compiled to a program for a small VM, written in C.
+
+    Pass ``backend='native'`` to instead turn the program into C and build it
+    into a real function, which is faster still.  That needs a C compiler the
+    first time each filter is used; the results are cached on disk.  See
+    `sanpera._filter_native`.
+
+    Compiled programs are also cached in memory, so making a new filter from
+    the same function is cheap; see `compile_cache_info`.
+    """
+    def __init__(self, impl, optimize=True, backend='vm'):
+        self._set_program(_compile(impl, optimize, backend), backend)
+
+    @classmethod
+    def _from_steps(cls, steps, backend='vm'):
+        """Make a filter straight from a compiled program."""
+        self = cls.__new__(cls)
+        self._set_program(_CompiledProgram(steps, backend), backend)
+        return self
+
+    def _set_program(self, program, backend):
+        self._program = program
+        self.compiled_steps = program.steps
+        self.stack_depth = program.stack_depth
+        self.radius = program.radius
+        self.frame_count = program.frame_count
+        self.pointwise = program.pointwise
+        self.backend = backend
+
+    def dump(self):
+        """Return a listing of the compiled program, one op per line, as it'll
+        actually be run.
+        """
+        return '\n'.join(_format_step(step) for step in self.compiled_steps)
 
     def __call__(self, *frames, **kwargs):
+        """Run the filter.
+
+        In addition to ``channel``, accepts ``threads``: how many threads to
+        split the image across, by bands of rows.  The default is however many
+        ImageMagick itself would use, which is normally one per core.  Pass 1
+        to run in the calling thread only.
+
+        The output is the size of the first frame.  Filters that read other
+        frames (with ``state.frame(n)``) see them lined up at the top left
+        corner; anything sticking out past the first frame is ignored, and
+        anything missing comes from that frame's virtual pixel method.
+
+        Pointwise filters (see `is_pointwise`) are run through a lookup table
+        when the image has more pixels than the table has entries.  Pass
+        ``lut=True`` or ``lut=False`` to force the matter.
+        """
         channel = kwargs.get('channel', lib.DefaultChannels)
         c_channel = ffi.cast('ChannelType', channel)
+        threads = kwargs.get('threads')
+        if threads is None:
+            threads = _default_threads()
+        elif threads < 1:
+            raise ValueError("threads must be at least 1, not {0!r}".format(threads))
+
+        if len(frames) < self.frame_count:
+            raise ValueError(
+                "This filter reads {0} frames, but only got {1}".format(
+                    self.frame_count, len(frames)))
+
+        program = self._program
+        steps = program.c_steps
+        # Only pass along the frames the program actually reads, so the C side
+        # doesn't fetch pixels from the others
+        c_frames = ffi.new(
+            "Image *[]",
+            [f._frame for f in frames[:self.frame_count]] + [ffi.NULL])
+
+        use_lut = kwargs.get('lut')
+        if use_lut is None:
+            # Building the table runs the program once per entry, so it only
+            # pays off for big images -- but once built, it's free
+            frame = frames[0]._frame
+            use_lut = self.pointwise and (
+                program.lut is not None or
+                frame.columns * frame.rows > lib.sanpera_filter_lut_length())
+        elif use_lut and not self.pointwise:
+            raise ValueError(
+                "Only pointwise filters can use a lookup table")
+
+        if use_lut:
+            lut = program.lookup_table()
+        else:
+            lut = ffi.NULL
 
-        steps = ffi.new("sanpera_evaluate_step[]", self.compiled_steps)
-        c_frames = ffi.new("Image *[]", [f._frame for f in frames] + [ffi.NULL])
+        # There's no point in giving a thread less than a handful of rows
+        threads = max(1, min(threads, frames[0]._frame.rows // _MIN_BAND_ROWS))
 
-        with magick_try() as exc:
-            # TODO can this raise an exception /but also/ return a new value?
-            # is that a thing i should be handling better
-            new_frame = lib.sanpera_evaluate_filter(
-                c_frames, steps, c_channel, exc.ptr)
+        if threads == 1 or lib.SANPERA_HAVE_OPENMP:
+            with magick_try() as exc:
+                new_frame = lib.sanpera_evaluate_filter(
+                    c_frames, steps, self.stack_depth, self.radius,
+                    program.kernel, lut, c_channel, threads, exc.ptr)
+                exc.check(new_frame == ffi.NULL)
+        else:
+            new_frame = self._evaluate_in_threads(
+                c_frames, steps, lut, c_channel, threads)
 
         return Image(new_frame)
+
+    def _evaluate_in_threads(self, c_frames, steps, lut, c_channel, threads):
+        # Without OpenMP, do the same thing sanpera_evaluate_filter would, but
+        # with Python threads.  cffi releases the GIL around the band calls, so
+        # they really do run in parallel.
+        with magick_try() as exc:
+            destination = lib.sanpera_evaluate_filter_destination(
+                c_frames, c_channel, exc.ptr)
+            exc.check(destination == ffi.NULL)
+
+        rows = destination.rows
+        contexts = [MagickExceptionContext() for _ in range(threads)]
+        results = [lib.MagickFalse] * threads
+
+        def run_band(band):
+            results[band] = lib.sanpera_evaluate_filter_band(
+                c_frames, destination,
+                rows * band // threads, rows * (band + 1) // threads,
+                steps, self.stack_depth, self.radius, self._program.kernel,
+                lut, c_channel, contexts[band].ptr)
+
+        workers = [
+            threading.Thread(target=run_band, args=(band,))
+            for band in range(threads)
+        ]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            for context, result in zip(contexts, results):
+                context.check(result == lib.MagickFalse)
+        except Exception:
+            lib.DestroyImage(destination)
+            raise
+
+        return destination
+
+
+# Smallest band of rows worth handing to a thread of its own
+_MIN_BAND_ROWS = 16
+
+
+def _default_threads():
+    return max(1, int(lib.GetMagickResourceLimit(lib.ThreadResource)))
+
+
+# ------------------------------------------------------------------------------
+# Filter chains.  Consecutive compiled filters are fused into a single program
+# by splicing each one in wherever the next reads its source pixel, so the
+# whole run takes one pass over the image and one new frame.
+
+# Fused programs can grow quickly when a filter reads its source several
+# times, since the previous filter is repeated for each read; past this many
+# steps, just run them separately
+_MAX_FUSED_STEPS = 512
+
+
+def _channel_lanes(channel):
+    return tuple(
+        1. if channel & mask else 0.
+        for mask in (lib.RedChannel, lib.GreenChannel, lib.BlueChannel,
+            lib.AlphaChannel))
+
+
+def _fuse(first, second, channel):
+    """Return a program that does the same as running the program `first`,
+    then the program `second` on its output, with the given channels.  Returns
+    None if that can't be done in one pass.
+    """
+    loads = [
+        step for step in second
+        if step['op'] == lib.SANPERA_OP_LOAD_SOURCE_COLOR]
+    if any(step['dx'] or step['dy'] or step['frame'] for step in loads):
+        # Neighbors of the intermediate image would need the first program
+        # run at other pixels, and edges would come out differently
+        return None
+
+    # What `second` sees as its source pixel: the output of `first`, clamped
+    # as if it had been written to an image, in the channels `first` writes;
+    # and the original pixel in the others.  (Anything else `second` computes
+    # on the original pixel is thrown away when the result is written.)
+    # HDRI images don't clamp what's written to them, so neither does this.
+    lanes = _channel_lanes(channel)
+    intermediate = list(first[:-1])
+    if not HAS_HDRI:
+        intermediate.append(op_(lib.SANPERA_OP_CLAMP))
+    if not all(lanes):
+        intermediate = (
+            [op_(lib.SANPERA_OP_LOAD_COLOR, value=lanes)] + intermediate +
+            [op_source_color(), op_(lib.SANPERA_OP_SELECT)])
+
+    fused = []
+    for step in second:
+        if step['op'] == lib.SANPERA_OP_LOAD_SOURCE_COLOR:
+            fused.extend(intermediate)
+        else:
+            fused.append(step)
+
+    if len(fused) > _MAX_FUSED_STEPS:
+        return None
+    return optimize_steps(fused)
+
+
+class chain(object):
+    """A filter that runs several filters one after another:
+
+        new_image = chain(Colorize(red, 0.5), gamma, clamp)(*old_image)
+
+    The first filter gets all the frames passed to the chain; every filter
+    after that gets the output of the one before.  Any keyword arguments
+    (e.g. ``channel``) are passed to every filter, except that only compiled
+    filters get anything but ``channel``.
+
+    Runs of compiled filters are fused into a single program, which only
+    takes one pass over the image and only creates one new frame.  Other
+    filters, and compiled filters that read neighboring pixels of the
+    previous filter's output, run separately.  A fused run matches running
+    its filters separately, except that values passed between them aren't
+    quantized to the image's depth.  They're still clamped to [0, 1] in
+    between, as writing them to an image would, except in HDRI builds, where
+    neither does.
+    """
+    def __init__(self, *filters):
+        if not filters:
+            raise TypeError("chain() needs at least one filter")
+
+        self.filters = []
+        for f in filters:
+            if isinstance(f, chain):
+                self.filters.extend(f.filters)
+            else:
+                self.filters.append(f)
+
+        # Fused stages, by channel, since the channels change the program
+        self._stages = {}
+
+    def stages(self, channel=lib.DefaultChannels):
+        """Return the list of filters actually run, after fusing."""
+        channel = int(channel)
+        stages = self._stages.get(channel)
+        if stages is not None:
+            return stages
+
+        stages = []
+        # The run of compiled filters being fused: the filters themselves, and
+        # the fused program so far
+        run = []
+        run_steps = None
+
+        def finish_run():
+            if len(run) == 1:
+                stages.append(run[0])
+            elif run:
+                backend = 'native' if all(
+                    f.backend == 'native' for f in run) else 'vm'
+                stages.append(
+                    compiled_image_filter._from_steps(run_steps, backend))
+            del run[:]
+
+        for f in self.filters:
+            if not isinstance(f, compiled_image_filter):
+                finish_run()
+                stages.append(f)
+                continue
+
+            if run:
+                fused = _fuse(run_steps, f.compiled_steps, channel)
+                if fused is not None:
+                    run.append(f)
+                    run_steps = fused
+                    continue
+                finish_run()
+
+            run.append(f)
+            run_steps = f.compiled_steps
+        finish_run()
+
+        self._stages[channel] = stages
+        return stages
+
+    def __call__(self, *frames, **kwargs):
+        channel = kwargs.get('channel', lib.DefaultChannels)
+
+        image = None
+        for stage in self.stages(channel):
+            # Only hang onto the latest intermediate image
+            if isinstance(stage, compiled_image_filter):
+                image = stage(*frames, **kwargs)
+            else:
+                image = stage(*frames, channel=channel)
+            frames = tuple(image)
+
+        return image
+
+
+# ------------------------------------------------------------------------------
+# Applying filters to whole animations.
+
+def map_frames(filter, image, workers=None, **kwargs):
+    """Apply a filter to every frame of an image separately, and return a new
+    image of the results, in the same order.  Each frame keeps its canvas.
+
+    Frames are filtered concurrently by `workers` threads, by default however
+    many ImageMagick itself would use.  The C side of compiled filters and
+    ImageMagick's own filters release the GIL, so this really does run in
+    parallel; Python filters mostly won't benefit.  Any other keyword
+    arguments are passed along to the filter.  When there's more than one
+    worker, compiled filters default to one thread each, since the frames are
+    already split up.
+    """
+    frames = list(image)
+    if workers is None:
+        workers = _default_threads()
+    elif workers < 1:
+        raise ValueError("workers must be at least 1, not {0!r}".format(workers))
+    workers = max(1, min(workers, len(frames)))
+
+    if workers > 1 and isinstance(filter, (compiled_image_filter, chain)):
+        kwargs.setdefault('threads', 1)
+
+    results = [None] * len(frames)
+    errors = [None] * len(frames)
+
+    def run(worker):
+        for index in range(worker, len(frames), workers):
+            try:
+                results[index] = filter(frames[index], **kwargs)
+            except Exception as e:
+                errors[index] = e
+                return
+
+    if workers == 1:
+        run(0)
+    else:
+        threads = [
+            threading.Thread(target=run, args=(worker,))
+            for worker in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+
+    new_image = Image()
+    for frame, result in zip(frames, results):
+        new_frame, = result
+        page = frame._frame.page
+        new_frame._frame.page.x = page.x
+        new_frame._frame.page.y = page.y
+        new_frame._frame.page.width = page.width
+        new_frame._frame.page.height = page.height
+        new_image.append(new_frame)
+
+    return new_image
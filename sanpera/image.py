@@ -2,6 +2,9 @@ from __future__ import absolute_import
 from __future__ import division
 
 import contextlib
+import io
+import mmap
+import sys
 
 from sanpera._api import ffi, lib
 from sanpera.color import RGBColor
@@ -20,6 +23,162 @@ def blank_image_info():
         lib.DestroyImageInfo)
 
 
+@contextlib.contextmanager
+def borrowed_buffer(buf):
+    """Yields a `(pointer, length)` pair for the memory behind any object that
+    supports the buffer protocol -- `bytes`, `bytearray`, `memoryview`,
+    `mmap`, array types, etc.  No copy is made, so don't let ImageMagick
+    hold onto the pointer beyond the end of the block.
+    """
+    if isinstance(buf, bytes):
+        # cffi passes bytes through as char* directly anyway
+        yield buf, len(buf)
+        return
+
+    cbuf = ffi.from_buffer(buf)
+    try:
+        # Note that this is the length in bytes, even if the buffer claims to
+        # contain something bigger
+        yield cbuf, len(cbuf)
+    finally:
+        # Let go of the underlying buffer immediately, rather than whenever
+        # the cdata happens to be collected; mmaps, for one, refuse to close
+        # while they're still exported
+        ffi.release(cbuf)
+
+
+def apply_size_hint(image_info, size_hint):
+    """Tell decoders that the caller only needs an image of (roughly) the
+    given size, so those that can decode at a reduced scale may do so.
+    """
+    if size_hint is None:
+        return
+
+    size_hint = Size.coerce(size_hint)
+    # Only the JPEG decoder pays attention to this, and it only ever scales by
+    # a power of two, so the result is still at least as big as the hint.
+    # Note that the generic ImageInfo.size is NOT touched, since it means
+    # "the size of the image" to raw formats and pseudo-formats.
+    lib.SetImageOption(
+        image_info, b"jpeg:size",
+        "{0}x{1}".format(size_hint.width, size_hint.height).encode('ascii'))
+
+
+class _PythonFileCookie(object):
+    """State for a FILE* that reads from or writes to a Python file-like
+    object.  See `python_file_handle`.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.error = None
+
+    def fail(self):
+        # Only remember the first error; anything after that is probably just
+        # ImageMagick continuing to flail
+        if self.error is None:
+            self.error = sys.exc_info()[1]
+
+
+@ffi.def_extern(error=-1)
+def sanpera_python_read(handle, buf, size):
+    cookie = ffi.from_handle(handle)
+    try:
+        readinto = getattr(cookie.fileobj, 'readinto', None)
+        if readinto is not None:
+            count = readinto(ffi.buffer(buf, size))
+            return count or 0
+
+        data = cookie.fileobj.read(size)
+        ffi.memmove(buf, data, len(data))
+        return len(data)
+    except Exception:
+        cookie.fail()
+        return -1
+
+
+@ffi.def_extern(error=0)
+def sanpera_python_write(handle, buf, size):
+    cookie = ffi.from_handle(handle)
+    try:
+        count = cookie.fileobj.write(ffi.buffer(buf, size)[:])
+    except Exception:
+        cookie.fail()
+        return 0
+
+    # Python 2 files return None from write()
+    if count is None:
+        return size
+    return count
+
+
+@ffi.def_extern(error=-1)
+def sanpera_python_seek(handle, position, whence):
+    cookie = ffi.from_handle(handle)
+    try:
+        seekable = getattr(cookie.fileobj, 'seekable', None)
+        if seekable is not None and not seekable():
+            return -1
+        new_position = cookie.fileobj.seek(position[0], whence)
+        if new_position is None:
+            # Python 2 files return None from seek()
+            new_position = cookie.fileobj.tell()
+        position[0] = new_position
+        return 0
+    except (AttributeError, IOError, io.UnsupportedOperation):
+        # Not seekable; C callers are expected to cope
+        return -1
+    except Exception:
+        cookie.fail()
+        return -1
+
+
+@contextlib.contextmanager
+def python_file_handle(fileobj, mode):
+    """Yields a FILE* that reads from or writes to the given Python file-like
+    object.  Only works when `lib.SANPERA_HAVE_FOPENCOOKIE` is true.
+
+    The FILE* is closed (and thus flushed) at the end of the block.  If the
+    file-like raised an exception at any point, it's re-raised here in
+    preference to whatever ImageMagick complained about as a result.
+    """
+    cookie = _PythonFileCookie(fileobj)
+    handle = ffi.new_handle(cookie)
+    fh = lib.sanpera_fopen_python(handle, mode)
+    if fh == ffi.NULL:
+        raise IOError("Couldn't create a FILE* for {0!r}".format(fileobj))
+
+    try:
+        try:
+            yield fh
+        finally:
+            lib.fclose(fh)
+    except Exception:
+        if cookie.error is not None:
+            raise cookie.error
+        raise
+
+    if cookie.error is not None:
+        raise cookie.error
+
+
+# NumPy dtypes that ImageMagick can import and export directly.  Floating-point
+# types are scaled to [0.0, 1.0]; integer types to their full range
+_NUMPY_STORAGE_TYPES = dict(
+    uint8=lib.CharPixel,
+    uint16=lib.ShortPixel,
+    float32=lib.FloatPixel,
+    float64=lib.DoublePixel,
+)
+
+def _numpy_storage_type(dtype):
+    try:
+        return _NUMPY_STORAGE_TYPES[dtype.name]
+    except KeyError:
+        raise TypeError(
+            "Can't convert pixels to or from {0}; expected one of: {1}"
+            .format(dtype, ', '.join(sorted(_NUMPY_STORAGE_TYPES))))
+
+
 def blank_magick_pixel():
     magick_pixel = ffi.new("MagickPixelPacket *")
     lib.GetMagickPixelPacket(ffi.NULL, magick_pixel)
@@ -143,6 +302,91 @@ class ImageFrame(object):
     def pixels(self):
         return PixelView(self)
 
+    def to_array(self, channels='RGBA', dtype='uint8', region=None):
+        """Copy this frame's pixels into a new NumPy array, in a single pass.
+
+        `channels` is an ImageMagick channel map, i.e. a string of channel
+        letters in the order you want them: ``R``, ``G``, ``B``, ``A`` (alpha),
+        ``O`` (opacity), ``C``, ``M``, ``Y``, ``K``, ``I`` (intensity), or
+        ``P`` (padding).  `dtype` may be ``uint8``, ``uint16``, ``float32``, or
+        ``float64``; floats range from 0.0 to 1.0.
+
+        The result has shape ``(height, width, len(channels))``.  Pass a
+        `Rectangle` as `region` to export only part of the frame.
+
+        Requires NumPy, of course.
+        """
+        import numpy
+
+        dtype = numpy.dtype(dtype)
+        storage = _numpy_storage_type(dtype)
+
+        if region is None:
+            region = self.size.at(origin)
+
+        array = numpy.empty(
+            (region.height, region.width, len(channels)), dtype=dtype)
+        pixels = ffi.from_buffer(array)
+        try:
+            with magick_try() as exc:
+                ok = lib.ExportImagePixels(
+                    self._frame, region.left, region.top,
+                    region.width, region.height,
+                    channels.encode('ascii'), storage, pixels, exc.ptr)
+                exc.check(not ok)
+        finally:
+            ffi.release(pixels)
+
+        return array
+
+    @classmethod
+    def from_array(cls, array, channels=None):
+        """Create a new frame from a NumPy array, in a single pass.
+
+        The array should have shape ``(height, width, len(channels))``, or
+        just ``(height, width)`` for a single channel.  See `to_array` for the
+        supported channels and dtypes.  If `channels` isn't given, it's guessed
+        from the array's shape: ``I``, ``RGB``, or ``RGBA``.
+        """
+        import numpy
+
+        array = numpy.ascontiguousarray(array)
+        storage = _numpy_storage_type(array.dtype)
+
+        if array.ndim == 2:
+            height, width = array.shape
+            depth = 1
+        elif array.ndim == 3:
+            height, width, depth = array.shape
+        else:
+            raise ValueError(
+                "Expected a 2- or 3-dimensional array, got shape {0!r}"
+                .format(array.shape))
+
+        if channels is None:
+            try:
+                channels = {1: 'I', 3: 'RGB', 4: 'RGBA'}[depth]
+            except KeyError:
+                raise ValueError(
+                    "Can't guess channels for an array with {0} of them"
+                    .format(depth))
+        elif len(channels) != depth:
+            raise ValueError(
+                "Array has {0} channels, but channel map {1!r} has {2}"
+                .format(depth, channels, len(channels)))
+
+        pixels = ffi.from_buffer(array)
+        try:
+            with magick_try() as exc:
+                ptr = lib.ConstituteImage(
+                    width, height, channels.encode('ascii'), storage, pixels,
+                    exc.ptr)
+                exc.check(ptr == ffi.NULL)
+        finally:
+            ffi.release(pixels)
+
+        return cls(ptr)
+
     ### Whole-frame manipulation
 
     # TODO perhaps a mutating version of this would be useful for painting
@@ -236,10 +480,19 @@ class Image(object):
         return cls(ptr)
 
     @classmethod
-    def read(cls, filename):
+    def read(cls, filename, size_hint=None):
+        """Read an image from a file.
+
+        If you're going to shrink the image immediately anyway, pass the size
+        you want as `size_hint`.  Some decoders (currently JPEG) can then skip
+        most of the work of decoding at full size.  The result is NOT resized
+        to exactly the hint, and may be rather larger; you still need to call
+        `resized`.
+        """
         with open(filename, "rb") as fh:
             image_info = blank_image_info()
             image_info.file = ffi.cast("FILE *", fh)
+            apply_size_hint(image_info, size_hint)
 
             with magick_try() as exc:
                 ptr = lib.ReadImage(image_info, exc.ptr)
@@ -247,34 +500,120 @@ class Image(object):
 
         return cls(ptr)
 
-    # TODO: there's no way to read from an arbitrary python file-like, because
-    # ImageMagick doesn't support streaming, and I'd rather not have the caller
-    # believe there's some cool lazy API when I'd really just be buffering the
-    # whole thing and then throwing it away.
-    # there IS a workaround, sort of.  some platforms can make a FILE* that
-    # reads data from callbacks: funopen on BSD, fopencookie on linux.  it
-    # would be peachy-keen to use those when available, and fall back to
-    # buffering on other unixes and windows.
+    @classmethod
+    def read_stream(cls, fileobj, format=None, size_hint=None):
+        """Read an image from an arbitrary Python file-like object, which only
+        needs a `read` method.
+
+        On glibc, ImageMagick reads from the file-like a chunk at a time, so
+        the encoded image never has to exist in memory all at once.  Elsewhere,
+        this falls back to reading the whole thing into a buffer first.
+
+        If the file-like isn't seekable, it helps to pass the `format` (e.g.
+        ``'png'``), so ImageMagick doesn't need to sniff the first few bytes
+        and then rewind.  Formats whose decoders need to seek around will be
+        spooled to a temporary file by ImageMagick regardless.
+
+        See `Image.read` for the meaning of `size_hint`.
+        """
+        if not lib.SANPERA_HAVE_FOPENCOOKIE:
+            return cls.from_buffer(fileobj.read(), size_hint=size_hint)
+
+        image_info = blank_image_info()
+        apply_size_hint(image_info, size_hint)
+        if format:
+            # Make sure not to overflow the char[]
+            # TODO maybe just error out when this happens
+            image_info.magick = format.encode('ascii')[:lib.MaxTextExtent]
+            image_info.affirm = lib.MagickTrue
+
+        with python_file_handle(fileobj, b"rb") as fh:
+            image_info.file = fh
+
+            with magick_try() as exc:
+                ptr = lib.ReadImage(image_info, exc.ptr)
+                exc.check(ptr == ffi.NULL)
+
+        return cls(ptr)
 
     @classmethod
-    def from_buffer(cls, buf):
-        assert isinstance(buf, bytes)
+    def from_buffer(cls, buf, size_hint=None):
+        """Read an image from a buffer containing an encoded image.  See
+        `Image.read` for the meaning of `size_hint`.
 
+        The buffer may be anything supporting the buffer protocol, such as
+        `bytes`, `bytearray`, a `memoryview` slice, or an `mmap`; it's handed
+        to ImageMagick directly, without being copied.
+        """
         image_info = blank_image_info()
-        with magick_try() as exc:
-            ptr = lib.BlobToImage(image_info, buf, len(buf), exc.ptr)
-            exc.check(ptr == ffi.NULL)
+        apply_size_hint(image_info, size_hint)
+        with borrowed_buffer(buf) as (cbuf, length):
+            with magick_try() as exc:
+                ptr = lib.BlobToImage(image_info, cbuf, length, exc.ptr)
+                exc.check(ptr == ffi.NULL)
+
+        return cls(ptr)
+
+    @classmethod
+    def read_mmap(cls, filename, size_hint=None):
+        """Read an image from a file by mapping it into memory and decoding
+        straight from the mapping, rather than reading it through a FILE*.
+
+        See `Image.read` for the meaning of `size_hint`.
+        """
+        with open(filename, "rb") as fh:
+            mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            return cls.from_buffer(mapping, size_hint=size_hint)
+        finally:
+            mapping.close()
+
+    @classmethod
+    def ping(cls, filename):
+        """Read only the metadata of an image file, without decoding any pixel
+        data.
+
+        The returned `Image` has the right number of frames, and its size,
+        canvases, `original_format`, and `bit_depth` are all filled in, but the
+        frames have no pixels; reading or manipulating them is an error.  This
+        is much cheaper than `Image.read` when you only want to identify an
+        image.
+        """
+        with open(filename, "rb") as fh:
+            image_info = blank_image_info()
+            image_info.file = ffi.cast("FILE *", fh)
+
+            with magick_try() as exc:
+                ptr = lib.PingImage(image_info, exc.ptr)
+                exc.check(ptr == ffi.NULL)
 
         return cls(ptr)
 
     @classmethod
-    def from_magick(cls, name):
+    def ping_buffer(cls, buf):
+        """Like `Image.ping`, but examines an image that's already in memory.
+        As with `Image.from_buffer`, any buffer-like object will do.
+        """
+        image_info = blank_image_info()
+        with borrowed_buffer(buf) as (cbuf, length):
+            with magick_try() as exc:
+                ptr = lib.PingBlob(image_info, cbuf, length, exc.ptr)
+                exc.check(ptr == ffi.NULL)
+
+        return cls(ptr)
+
+    @classmethod
+    def from_magick(cls, name, size_hint=None):
         """Passes a filename specifier directly to ImageMagick.
 
         This allows reading from any of the magic pseudo-formats, like
         `clipboard` and `null`.  Use with care with user input!
+
+        See `Image.read` for the meaning of `size_hint`.
         """
         image_info = blank_image_info()
+        apply_size_hint(image_info, size_hint)
 
         # Make sure not to overflow the char[]
         # TODO maybe just error out when this happens
@@ -295,27 +634,94 @@ class Image(object):
             raise EmptyImageError
 
         with open(filename, "wb") as fh:
-            image_info = blank_image_info()
-            image_info.file = ffi.cast("FILE *", fh)
+            self._write_to_file_handle(ffi.cast("FILE *", fh), format)
+
+    def write_stream(self, fileobj, format=None):
+        """Write this image to an arbitrary Python file-like object, which only
+        needs a `write` method.
+
+        On glibc, ImageMagick writes to the file-like a chunk at a time, so the
+        encoded image never has to exist in memory all at once.  Elsewhere,
+        this falls back to encoding to a buffer and writing that.
+        """
+        if not self._frames:
+            raise EmptyImageError
 
-            # Force writing to a single file
-            image_info.adjoin = lib.MagickTrue
+        if not lib.SANPERA_HAVE_FOPENCOOKIE:
+            fileobj.write(self.to_buffer(format=format))
+            return
 
-            if format:
-                # If the caller provided an explicit format, pass it along
-                # Make sure not to overflow the char[]
-                # TODO maybe just error out when this happens
-                image_info.magick = format.encode('ascii')[:lib.MaxTextExtent]
-            elif self._frames[0]._frame.magick[0] == b'\0':
-                # Uhoh; no format provided and nothing given by caller
-                raise MissingFormatError
-            # TODO detect format from filename if explicitly asked to do so
+        with python_file_handle(fileobj, b"wb") as fh:
+            self._write_to_file_handle(fh, format)
 
-            with self._link_frames(self._frames) as ptr:
-                lib.WriteImage(image_info, ptr)
-                magick_raise(ptr.exception)
+    def _write_to_file_handle(self, fh, format):
+        image_info = blank_image_info()
+        image_info.file = fh
+
+        # Force writing to a single file
+        image_info.adjoin = lib.MagickTrue
+
+        if format:
+            # If the caller provided an explicit format, pass it along
+            # Make sure not to overflow the char[]
+            # TODO maybe just error out when this happens
+            image_info.magick = format.encode('ascii')[:lib.MaxTextExtent]
+        elif self._frames[0]._frame.magick[0] == b'\0':
+            # Uhoh; no format provided and nothing given by caller
+            raise MissingFormatError
+        # TODO detect format from filename if explicitly asked to do so
+
+        with self._link_frames(self._frames) as ptr:
+            lib.WriteImage(image_info, ptr)
+            magick_raise(ptr.exception)
 
     def to_buffer(self, format=None):
+        """Encode this image and return the result as a buffer object.
+
+        The buffer owns ImageMagick's own allocation and supports the buffer
+        protocol, so it can be handed directly to `socket.sendall`,
+        `file.write`, `memoryview`, etc. without any copying.  Slicing it with
+        ``[:]`` produces a `bytes` copy of the whole thing, so only do that if
+        you really need `bytes`.
+        """
+        cbuf, length = self._encode(format)
+        return ffi.buffer(cbuf, length)
+
+    def to_buffer_into(self, buf, format=None):
+        """Encode this image into an existing writable buffer, and return the
+        number of bytes written.  Handy for reusing a pool of buffers.
+
+        A `bytearray` is grown as necessary (but never shrunk); anything else,
+        e.g. a `memoryview`, must already be big enough, or `ValueError` is
+        raised.
+
+        Note that ImageMagick always encodes into memory of its own, so this
+        costs one copy; it's freed before this method returns.
+        """
+        cbuf, length = self._encode(format)
+        try:
+            if isinstance(buf, bytearray) and len(buf) < length:
+                buf.extend(b'\0' * (length - len(buf)))
+
+            # This raises TypeError for read-only buffers
+            dest = ffi.from_buffer(buf, require_writable=True)
+            try:
+                if len(dest) < length:
+                    raise ValueError(
+                        "Encoded image is {0} bytes, but buffer only has room "
+                        "for {1}".format(length, len(dest)))
+                ffi.memmove(dest, cbuf, length)
+            finally:
+                ffi.release(dest)
+        finally:
+            # Free ImageMagick's copy now, rather than whenever it's collected
+            ffi.release(cbuf)
+
+        return length
+
+    def _encode(self, format):
+        # Returns the encoded image as a pointer that owns ImageMagick's
+        # allocation, plus its length
         if not self._frames:
             raise EmptyImageError
 
@@ -345,7 +751,7 @@ class Image(object):
                     lib.ImagesToBlob(image_info, ptr, length, exc.ptr),
                     lib.RelinquishMagickMemory)
 
-        return ffi.buffer(cbuf, length[0])
+        return cbuf, length[0]
 
 
 
@@ -538,6 +944,10 @@ class Image(object):
     # ...or does IM do this already?  what's the diff between the resize functions?
 
     def resized(self, size, filter=None):
+        """Returns a resized image.  `filter` may be ``'box'`` or ``'point'``,
+        which use ImageMagick's faster ``ScaleImage`` and ``SampleImage``
+        respectively; otherwise ImageMagick picks a filter.
+        """
         size = Size.coerce(size)
 
         # TODO allow picking a filter
@@ -548,6 +958,8 @@ class Image(object):
 
         if filter == 'box':
             c_filter = lib.BoxFilter
+        elif filter == 'point':
+            c_filter = lib.PointFilter
         else:
             c_filter = lib.UndefinedFilter
 
@@ -577,6 +989,10 @@ class Image(object):
                     # Use the faster ScaleImage in this special case
                     new_frame = lib.ScaleImage(
                         inputImage, frame_width, frame_height, exc.ptr)
+                elif c_filter == lib.PointFilter:
+                    # Likewise SampleImage, which doesn't blend at all
+                    new_frame = lib.SampleImage(
+                        inputImage, frame_width, frame_height, exc.ptr)
                 else:
                     new_frame = lib.ResizeImage(
                         inputImage, frame_width, frame_height,
@@ -655,6 +1071,14 @@ class Image(object):
         return new
 
 
+    def lazy(self):
+        """Returns a `sanpera.lazy.LazyImage` that records operations on this
+        image instead of running them, so they can be rearranged into
+        something cheaper first.
+        """
+        from sanpera.lazy import LazyImage
+        return LazyImage(self)
+
     def coalesced(self):
         """Returns an image with each frame composited over previous frames."""
         with magick_try() as exc:
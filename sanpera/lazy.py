@@ -0,0 +1,270 @@
+"""Lazy image pipelines.
+
+Every `Image` method runs immediately and produces a whole new image, which is
+wasteful for a recipe like "resize this huge photo, then crop out the middle":
+most of the resizing work is thrown away.  A `LazyImage` instead records the
+operations, and only runs them when asked, after rearranging them into
+something cheaper:
+
+    thumbnail = img.lazy().resized((800, 600)).cropped(rect).collect()
+
+The rearranged plan is available from `LazyImage.plan`.  Rewrites include:
+
+- Crops move ahead of ``'box'`` and ``'point'`` resizes (see
+  `Image.resized`), so only the part that's kept gets resized; and ahead of
+  filters that work on each pixel independently.
+- Consecutive crops become one crop.
+- Crops that don't remove anything, and resizes to the same size, are dropped.
+
+None of these change the result.  Crops are only moved when they map exactly
+onto whole pixels of the original, and never ahead of other resize filters,
+which blend in neighboring pixels that a crop would take away.  ImageMagick
+already returns an untouched copy for a resize to the same size.  Consecutive
+resizes are left alone, since the first one can throw away detail the second
+would have kept.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from sanpera.geometry import Rectangle
+from sanpera.geometry import Size
+from sanpera.geometry import origin
+
+
+class Resize(object):
+    def __init__(self, size, filter=None):
+        self.size = Size.coerce(size)
+        self.filter = filter
+
+    def apply(self, image):
+        return image.resized(self.size, filter=self.filter)
+
+    def __repr__(self):
+        return "Resize({0!r}, filter={1!r})".format(
+            tuple(self.size), self.filter)
+
+
+class Crop(object):
+    def __init__(self, rect, preserve_canvas=False):
+        self.rect = rect
+        self.preserve_canvas = preserve_canvas
+
+    def apply(self, image):
+        return image.cropped(self.rect, preserve_canvas=self.preserve_canvas)
+
+    def __repr__(self):
+        rect = self.rect
+        return "Crop(({0!r}, {1!r}, {2!r}, {3!r}), preserve_canvas={4!r})".format(
+            rect.x1, rect.y1, rect.x2, rect.y2, self.preserve_canvas)
+
+
+class Coalesce(object):
+    def apply(self, image):
+        return image.coalesced()
+
+    def __repr__(self):
+        return "Coalesce()"
+
+
+class Filter(object):
+    def __init__(self, filter, kwargs):
+        self.filter = filter
+        self.kwargs = kwargs
+
+    def apply(self, image):
+        return self.filter(*image, **self.kwargs)
+
+    def __repr__(self):
+        return "Filter({0!r})".format(self.filter)
+
+
+def _filter_info(f):
+    """Return ``(keeps_size, per_pixel)`` for a filter: whether its output is
+    the same size as its first frame, and whether each output pixel depends
+    only on the same input pixel, so it can be swapped with a crop.  Anything
+    unrecognized is assumed to do neither.
+    """
+    # Lazy import; filters imports image, which imports this
+    from sanpera import filters
+
+    if isinstance(f, filters.compiled_image_filter):
+        return True, f.radius == 0 and f.frame_count == 1
+    if isinstance(f, filters.chain):
+        infos = [_filter_info(stage) for stage in f.filters]
+        return (
+            all(keeps for keeps, _ in infos),
+            all(per_pixel for _, per_pixel in infos))
+    if isinstance(f, (
+            filters.Colorize, filters.Gamma, filters.Level, filters.Modulate,
+            filters.Negate)):
+        return True, True
+    if isinstance(f, (filters.Blur, filters.Sharpen, filters.ContrastStretch)):
+        return True, False
+    return False, False
+
+
+def _after(op, size, plain):
+    """Return the canvas size after `op`, or None if unknown; and whether the
+    image is still "plain", i.e. every frame covers its whole canvas with no
+    offset.
+    """
+    if isinstance(op, Coalesce):
+        return size, True
+    if size is None:
+        if isinstance(op, Resize):
+            return op.size, plain
+        return None, False
+
+    if isinstance(op, Resize):
+        return op.size, plain
+    if isinstance(op, Crop):
+        bounds = size.at(origin)
+        if op.preserve_canvas:
+            return size, False
+        return op.rect.intersection(bounds).size, plain and op.rect in bounds
+    if isinstance(op, Filter):
+        keeps_size, _ = _filter_info(op.filter)
+        if keeps_size:
+            return size, plain
+        return None, False
+    return None, False
+
+
+# Resize filters where each output pixel only depends on the input pixels it
+# covers, so resizing part of an image gives exactly that part of the result
+_EXACT_FILTERS = frozenset(['box', 'point'])
+
+
+def _scale_exactly(value, numerator, denominator):
+    """Return ``value * numerator / denominator`` if it's a whole number, or
+    None.
+    """
+    if (value * numerator) % denominator:
+        return None
+    return value * numerator // denominator
+
+
+def _rewrite(first, second, size, plain):
+    """Return a cheaper replacement for the pair of ops `first` and `second`,
+    given the canvas size and plainness before `first`; or None.
+    """
+    if isinstance(second, Crop) and not second.preserve_canvas:
+        if isinstance(first, Filter) and _filter_info(first.filter)[1]:
+            return [second, first]
+
+        if size is None or not plain:
+            return None
+        mid_size, _ = _after(first, size, plain)
+        if second.rect not in mid_size.at(origin):
+            return None
+
+        if isinstance(first, Crop) and not first.preserve_canvas and (
+                first.rect in size.at(origin)):
+            rect = second.rect
+            return [Crop(Rectangle(
+                rect.x1 + first.rect.x1, rect.y1 + first.rect.y1,
+                rect.x2 + first.rect.x1, rect.y2 + first.rect.y1))]
+
+        if isinstance(first, Resize) and first.filter in _EXACT_FILTERS:
+            rect = second.rect
+            coords = [
+                _scale_exactly(rect.x1, size.width, mid_size.width),
+                _scale_exactly(rect.y1, size.height, mid_size.height),
+                _scale_exactly(rect.x2, size.width, mid_size.width),
+                _scale_exactly(rect.y2, size.height, mid_size.height),
+            ]
+            if None in coords:
+                return None
+            return [Crop(Rectangle(*coords)), Resize(rect.size, first.filter)]
+
+    return None
+
+
+def _is_noop(op, size, plain):
+    if size is None:
+        return False
+    if isinstance(op, Resize):
+        return op.size == size
+    if isinstance(op, Crop):
+        # Frames can stick out past the canvas, in which case even a crop
+        # covering the whole canvas trims them
+        return plain and size.at(origin) in op.rect
+    return False
+
+
+def optimize_plan(ops, size, plain):
+    """Rearrange a list of ops into a cheaper equivalent, given the canvas
+    size and plainness of the image they start from.
+    """
+    ops = list(ops)
+    changed = True
+    while changed:
+        changed = False
+
+        current_size = size
+        current_plain = plain
+        for i, op in enumerate(ops):
+            if _is_noop(op, current_size, current_plain):
+                del ops[i]
+                changed = True
+                break
+
+            if i + 1 < len(ops):
+                replacement = _rewrite(
+                    op, ops[i + 1], current_size, current_plain)
+                if replacement is not None:
+                    ops[i:i + 2] = replacement
+                    changed = True
+                    break
+
+            current_size, current_plain = _after(op, current_size, current_plain)
+
+    return ops
+
+
+class LazyImage(object):
+    """An image with operations recorded on it but not yet run.  Get one from
+    `Image.lazy`.  Every method returns a new `LazyImage`; nothing happens
+    until `collect`.
+    """
+    def __init__(self, image, ops=()):
+        self._image = image
+        self._ops = tuple(ops)
+
+    def _then(self, op):
+        return type(self)(self._image, self._ops + (op,))
+
+    def resized(self, size, filter=None):
+        return self._then(Resize(size, filter))
+
+    def cropped(self, rect, preserve_canvas=False):
+        return self._then(Crop(rect, preserve_canvas))
+
+    def coalesced(self):
+        return self._then(Coalesce())
+
+    def filter(self, filter, **kwargs):
+        """Apply a filter, as ``filter(*image, **kwargs)``."""
+        return self._then(Filter(filter, kwargs))
+
+    @property
+    def ops(self):
+        """The operations as recorded."""
+        return list(self._ops)
+
+    def plan(self):
+        """The operations that will actually run."""
+        return optimize_plan(
+            self._ops, self._image.size, not self._image.has_canvas)
+
+    def collect(self):
+        """Run the plan and return the resulting `Image`."""
+        image = self._image
+        for op in self.plan():
+            # Only the latest intermediate image is kept around
+            image = op.apply(image)
+        return image
+
+    def __repr__(self):
+        return "<{0} {1!r}>".format(type(self).__name__, list(self._ops))
@@ -8,10 +8,53 @@
 # TODO really, really want to be able to dump out an image or info struct.  really.
 from __future__ import print_function
 
+import array
+
 from sanpera._api import ffi, lib
 from sanpera.color import RGBColor
 from sanpera.exception import magick_try
 from sanpera.geometry import Vector
+from sanpera.geometry import origin
+from sanpera.imagemagick import HAS_HDRI
+
+
+def _get_pixel_layout():
+    indices = ffi.new("size_t[]", 4)
+    quantum_size = lib.sanpera_pixel_packet_layout(indices)
+
+    channels = [None] * 4
+    for channel, index in zip('RGBO', indices):
+        channels[index] = channel
+
+    # Quantum is an unsigned integer, except in HDRI builds, where it's a float
+    if HAS_HDRI:
+        formats = {4: 'f', 8: 'd'}
+    else:
+        formats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+    return ''.join(channels), formats[quantum_size]
+
+PIXEL_CHANNELS, QUANTUM_FORMAT = _get_pixel_layout()
+"""Channel order of pixels in the pixel cache, as a string of ``R``, ``G``,
+``B``, and ``O`` (opacity, where 0 is opaque), and the `struct` format of each
+channel.  Both vary by platform and ImageMagick build.
+"""
+
+# Packed formats supported by `PixelView.get_region` and `set_region`, as
+# `struct` codes.  Maps to (C type, C function to export, C function to import)
+_BULK_FORMATS = {
+    'd': ("double *", lib.sanpera_pixels_to_doubles, lib.sanpera_pixels_from_doubles),
+    'B': ("unsigned char *", lib.sanpera_pixels_to_bytes, lib.sanpera_pixels_from_bytes),
+}
+
+
+def _bulk_format(format):
+    try:
+        return _BULK_FORMATS[format]
+    except KeyError:
+        raise ValueError(
+            "Unsupported pixel format {0!r}; expected 'd' or 'B'".format(format))
+
 
 ### Frame
 
@@ -44,6 +87,13 @@ class PixelViewPixel(object):
         return Vector(self._x, self._y)
 
 
+class ReadOnlyPixelViewPixel(PixelViewPixel):
+    """Transient pixel access object, produced by iterating over a
+    `ReadOnlyPixelView`.  Can be used to examine a single pixel's color.
+    """
+    color = property(PixelViewPixel.color.fget)
+
+
 def _cache_view_destructor(cache_view):
     with magick_try() as exc:
         # TODO bool return value as well
@@ -51,15 +101,165 @@ def _cache_view_destructor(cache_view):
         lib.DestroyCacheView(cache_view)
 
 
-class PixelView(object):
-    """Can view and manipulate individual pixels of a frame."""
+class PixelRegion(object):
+    """Direct access to a rectangular block of a frame's pixel cache, with no
+    copying whatsoever.  Use as a context manager, which yields a writable
+    `memoryview` of shape ``(height, width, 4)``:
 
-    def __init__(self, frame):
+        with frame.pixels.region(rect) as pixels:
+            array = numpy.asarray(pixels)
+            ...
+
+    Each channel is a raw ImageMagick quantum, in the order given by
+    `PIXEL_CHANNELS`, with the format given by `QUANTUM_FORMAT`.  Note in
+    particular that the fourth channel is opacity, not alpha.
+
+    Any changes are written back to the frame at the end of the block, after
+    which the memory is no longer valid.  Anything still referring to it at
+    that point (e.g. a NumPy array) causes a `BufferError`, rather than being
+    left dangling.
+
+    Python 2's `memoryview` can't do any of this, so there, entering the
+    block raises `NotImplementedError`.
+    """
+    channels = PIXEL_CHANNELS
+    format = QUANTUM_FORMAT
+
+    def __init__(self, frame, rect):
         self._frame = frame
+        self.rect = rect
+        self._ptr = None
+        self._memory = None
+
+    def __enter__(self):
+        if self._memory is not None:
+            raise RuntimeError("Pixel region is already in use")
+        if not hasattr(memoryview, 'cast'):
+            # Python 2's memoryview can't be reshaped or released, so there's
+            # no safe way to hand out the pixel cache directly
+            raise NotImplementedError(
+                "Pixel regions need Python 3; use get_region() and "
+                "set_region() instead")
+
+        rect = self.rect
+        # Use a separate cache view from the parent PixelView, so they don't
+        # step on each other
         self._ptr = ffi.gc(
-            lib.AcquireCacheView(frame._frame),
+            lib.AcquireCacheView(self._frame._frame),
             _cache_view_destructor)
 
+        with magick_try() as exc:
+            q = lib.GetCacheViewAuthenticPixels(
+                self._ptr, rect.left, rect.top, rect.width, rect.height,
+                exc.ptr)
+            exc.check(q == ffi.NULL)
+
+        raw = memoryview(ffi.buffer(
+            q, rect.width * rect.height * ffi.sizeof("PixelPacket")))
+        self._memory = raw.cast(QUANTUM_FORMAT, (rect.height, rect.width, 4))
+        return self._memory
+
+    def __exit__(self, *exc_info):
+        memory = self._memory
+        self._memory = None
+
+        try:
+            with magick_try() as exc:
+                ok = lib.SyncCacheViewAuthenticPixels(self._ptr, exc.ptr)
+                exc.check(not ok)
+        finally:
+            # If anything still has hold of the memory, this raises, and the
+            # cache view is kept alive for as long as this object is
+            memory.release()
+
+            lib.DestroyCacheView(ffi.gc(self._ptr, None))
+            self._ptr = None
+
+
+class PixelBatch(object):
+    """Collects writes to individual pixels, and applies them all at once at
+    the end of a ``with`` block:
+
+        with frame.pixels.batch() as pixels:
+            for point in points:
+                pixels[point] = color
+
+    Each row that was touched is fetched and synced just once, rather than
+    once per pixel.  Reading a pixel sees pending writes.  If the block exits
+    with an exception, pending writes are discarded.
+    """
+
+    def __init__(self, view):
+        self._view = view
+        # y => { x => (r, g, b, a) }
+        self._rows = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._rows.clear()
+
+    def __getitem__(self, point):
+        point = Vector.coerce(point)
+        try:
+            return RGBColor(*self._rows[point.y][point.x])
+        except KeyError:
+            return self._view[point]
+
+    def __setitem__(self, point, color):
+        point = Vector.coerce(point)
+        rgb = color.rgb()
+
+        row = self._rows.get(point.y)
+        if row is None:
+            row = self._rows[point.y] = {}
+        row[point.x] = (rgb._red, rgb._green, rgb._blue, rgb._opacity)
+
+    def flush(self):
+        """Apply all pending writes now."""
+        view_ptr = self._view._ptr
+
+        for y, row in self._rows.items():
+            left = min(row)
+            right = max(row) + 1
+
+            offsets = ffi.new("size_t[]", [x - left for x in row])
+            values = ffi.new("double[]", [
+                channel for color in row.values() for channel in color])
+
+            with magick_try() as exc:
+                q = lib.GetCacheViewAuthenticPixels(
+                    view_ptr, left, y, right - left, 1, exc.ptr)
+                exc.check(q == ffi.NULL)
+
+            lib.sanpera_pixels_scatter_doubles(q, len(row), offsets, values)
+
+            with magick_try() as exc:
+                ok = lib.SyncCacheViewAuthenticPixels(view_ptr, exc.ptr)
+                exc.check(not ok)
+
+        self._rows.clear()
+
+
+class ReadOnlyPixelView(object):
+    """Can view, but not manipulate, individual pixels of a frame.
+
+    Unlike `PixelView`, this never asks for writable access to the pixel
+    cache, so it never forces a lazy copy of a frame (see `ImageFrame.copy`)
+    to actually be copied, and never writes anything back.
+    """
+
+    def __init__(self, frame):
+        self._frame = frame
+        with magick_try() as exc:
+            ptr = lib.AcquireVirtualCacheView(frame._frame, exc.ptr)
+            exc.check(ptr == ffi.NULL)
+        self._ptr = ffi.gc(ptr, lib.DestroyCacheView)
+
     def __getitem__(self, point):
         point = Vector.coerce(point)
 
@@ -67,12 +267,101 @@ class PixelView(object):
 
         # TODO retval is t/f
         with magick_try() as exc:
-            lib.GetOneCacheViewAuthenticPixel(self._ptr, point.x, point.y, px, exc.ptr)
+            lib.GetOneCacheViewVirtualPixel(self._ptr, point.x, point.y, px, exc.ptr)
 
         array = ffi.new("double[]", 4)
         lib.sanpera_pixel_to_doubles(px, array)
         return RGBColor(*array)
 
+    def get_region(self, rect=None, format='d'):
+        """Copy out an entire block of pixels within the given `Rectangle` (by
+        default, the whole frame) in one go.
+
+        Returns a flat sequence of packed RGBA values, in row-major order:
+        an ``array('d')`` of floats in [0.0, 1.0] if `format` is ``'d'``, or a
+        `bytearray` of values in [0, 255] if `format` is ``'B'``.  Both can be
+        handed to NumPy et al. without copying.
+        """
+        if rect is None:
+            rect = self._frame.size.at(origin)
+        ctype, export, _ = _bulk_format(format)
+
+        count = rect.width * rect.height
+        if format == 'd':
+            out = array.array('d', [0.]) * (count * 4)
+        else:
+            out = bytearray(count * 4)
+
+        with magick_try() as exc:
+            p = lib.GetCacheViewVirtualPixels(
+                self._ptr, rect.left, rect.top, rect.width, rect.height,
+                exc.ptr)
+            exc.check(p == ffi.NULL)
+
+        dest = ffi.from_buffer(out)
+        try:
+            export(p, count, ffi.cast(ctype, dest))
+        finally:
+            ffi.release(dest)
+
+        return out
+
+    def __iter__(self):
+        rect = self._frame.canvas
+
+        pixel = ReadOnlyPixelViewPixel.__new__(ReadOnlyPixelViewPixel)
+        # This is needed so that the pixel cannot exist after the view is
+        # destroyed -- it's a wrapper around a bare pointer!
+        pixel.owner = self
+
+        for y in range(rect.top, rect.bottom):
+            with magick_try() as exc:
+                p = lib.GetCacheViewVirtualPixels(
+                    self._ptr, rect.left, y, rect.width, 1, exc.ptr)
+                exc.check(p == ffi.NULL)
+
+            for x in range(rect.left, rect.right):
+                try:
+                    pixel._pixel = p
+                    pixel._x = x
+                    pixel._y = y
+                    yield pixel
+                finally:
+                    pixel._pixel = ffi.NULL
+
+                p += 1
+
+
+class PixelView(ReadOnlyPixelView):
+    """Can view and manipulate individual pixels of a frame."""
+
+    def __init__(self, frame):
+        self._frame = frame
+        self._ptr = ffi.gc(
+            lib.AcquireCacheView(frame._frame),
+            _cache_view_destructor)
+
+    def batch(self):
+        """Return a `PixelBatch`, for setting lots of individual pixels much
+        faster than `__setitem__` can.
+        """
+        return PixelBatch(self)
+
+    def readonly(self):
+        """Return a `ReadOnlyPixelView` of the same frame.  Prefer this for
+        passes that only inspect pixels.
+        """
+        return ReadOnlyPixelView(self._frame)
+
+    def region(self, rect=None):
+        """Return a `PixelRegion` for direct access to the pixel cache within
+        the given `Rectangle`, or the whole frame by default.
+        """
+        if rect is None:
+            rect = self._frame.size.at(origin)
+
+        return PixelRegion(self._frame, rect)
+
     def __setitem__(self, point, color):
         """Set a single pixel to a given color.
 
@@ -93,13 +382,51 @@ class PixelView(object):
 
         array = ffi.new("double[]", [rgb._red, rgb._green, rgb._blue, rgb._opacity])
         lib.sanpera_pixel_from_doubles(px, array)
-        #print(repr(ffi.buffer(ffi.cast("char*", ffi.cast("void*", px)), 16)[:]))
 
         with magick_try() as exc:
             assert lib.SyncCacheViewAuthenticPixels(self._ptr, exc.ptr)
 
 
 
+    def set_region(self, rect, data, format=None):
+        """Overwrite an entire block of pixels within the given `Rectangle` in
+        one go.  `data` is anything supporting the buffer protocol, in the same
+        packed RGBA layout that `get_region` returns.
+
+        `format` is ``'d'`` or ``'B'``, as for `get_region`; if omitted, it's
+        taken from the buffer itself, so e.g. a `bytearray` is assumed to
+        contain bytes.
+        """
+        if format is None:
+            format = memoryview(data).format
+        ctype, _, import_ = _bulk_format(format)
+
+        count = rect.width * rect.height
+        source = ffi.from_buffer(data)
+        try:
+            expected = count * 4 * ffi.sizeof(ffi.typeof(ctype).item)
+            if len(source) != expected:
+                raise ValueError(
+                    "Expected {0} bytes of pixel data for a {1}x{2} region, "
+                    "got {3}".format(
+                        expected, rect.width, rect.height, len(source)))
+
+            # Everything is being overwritten, so there's no need to fetch
+            # the existing pixels first
+            with magick_try() as exc:
+                q = lib.QueueCacheViewAuthenticPixels(
+                    self._ptr, rect.left, rect.top, rect.width, rect.height,
+                    exc.ptr)
+                exc.check(q == ffi.NULL)
+
+            import_(q, count, ffi.cast(ctype, source))
+        finally:
+            ffi.release(source)
+
+        with magick_try() as exc:
+            ok = lib.SyncCacheViewAuthenticPixels(self._ptr, exc.ptr)
+            exc.check(not ok)
+
     def __iter__(self):
         rect = self._frame.canvas
 
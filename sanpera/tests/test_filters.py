@@ -0,0 +1,597 @@
+"""Test image filters, both built-in and user-defined."""
+
+import array
+import threading
+import types
+
+import pytest
+
+from sanpera import _filter_native
+from sanpera.color import RGBColor
+from sanpera.constants import Channel
+from sanpera.exception import FilterCompileError
+from sanpera.exception import FilterCompileWarning
+from sanpera.filters import Blur
+from sanpera.filters import ContrastStretch
+from sanpera.filters import Gamma
+from sanpera.filters import Level
+from sanpera.filters import Modulate
+from sanpera.filters import Negate
+from sanpera.filters import MAX_NEIGHBOR_OFFSET
+from sanpera.filters import Sharpen
+from sanpera.filters import chain
+from sanpera.filters import clear_compile_cache
+from sanpera.filters import compile_cache_info
+from sanpera.filters import compiled_image_filter
+from sanpera.filters import image_filter
+from sanpera.filters import is_pointwise
+from sanpera.filters import map_frames
+from sanpera.filters import maximum
+from sanpera.filters import minimum
+from sanpera.filters import python_image_filter
+from sanpera.filters import rgba
+from sanpera.filters import select
+from sanpera.filters import stack_depth
+from sanpera.filters import vectorized_image_filter
+from sanpera.image import Image
+from sanpera.image import builtins
+from sanpera.imagemagick import HAS_HDRI
+from sanpera.tests import util
+
+
+def halve_and_brighten(state):
+    return (state.color * 0.5 + 0.25).clamped()
+
+
+def test_filter_compiles():
+    assert isinstance(image_filter(halve_and_brighten), compiled_image_filter)
+
+
+def test_stack_depth():
+    f = compiled_image_filter(halve_and_brighten, optimize=False)
+    assert f.stack_depth == stack_depth(f.compiled_steps) == 2
+
+    f = compiled_image_filter(
+        lambda state: state.color * (state.color + (state.color * 0.5)),
+        optimize=False)
+    assert f.stack_depth == 4
+
+    # The optimizer fuses the multiplies by constants away
+    f = compiled_image_filter(halve_and_brighten)
+    assert f.stack_depth == stack_depth(f.compiled_steps) == 1
+
+    f = compiled_image_filter(
+        lambda state: state.color * (state.color + (state.color * 0.5)))
+    assert f.stack_depth == 3
+
+
+def test_optimizer():
+    f = compiled_image_filter(lambda state: (state.color - 0) * 1 + 0)
+    assert f.dump() == "LOAD_SOURCE_COLOR\nDONE"
+
+    # Floating-point math isn't associative, so this can't become x + 0.3
+    f = compiled_image_filter(lambda state: (state.color + 0.1) + 0.2)
+    assert f.dump() == (
+        "LOAD_SOURCE_COLOR\n"
+        "ADD_CONSTANT 0.1\n"
+        "ADD_CONSTANT 0.2\n"
+        "DONE"
+    )
+
+    f = compiled_image_filter(halve_and_brighten)
+    assert f.dump() == (
+        "LOAD_SOURCE_COLOR\n"
+        "MULTIPLY_ADD_CONSTANT 0.5 0.25\n"
+        "CLAMP\n"
+        "DONE"
+    )
+
+    f = compiled_image_filter(lambda state: state.color * state.color + state.color)
+    assert f.dump().endswith("MULTIPLY_ADD\nDONE")
+
+
+def test_optimizer_preserves_results():
+    img = builtins.rose
+    for impl in (
+            halve_and_brighten,
+            lambda state: (state.color + 0.125) + 0.125,
+            lambda state: (state.color + 0.1) + 0.2,
+            lambda state: (state.color * 0.1) * 3,
+            lambda state: state.color * state.color + state.color * 0.25,
+            lambda state: state.color * 0.5 + RGBColor(0.25, 0.25, 0.25)):
+        util.assert_identical(
+            compiled_image_filter(impl)(*img),
+            compiled_image_filter(impl, optimize=False)(*img))
+
+
+def test_compiled_filter_threads():
+    """Running the same compiled filter in several threads at once should give
+    the same result as running it in one.
+    """
+    img = builtins.rose
+    f = compiled_image_filter(halve_and_brighten)
+    expected = f(*img)
+
+    results = []
+    def worker():
+        for _ in range(10):
+            results.append(f(*img))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 80
+    for result in results:
+        util.assert_identical(result, expected)
+
+
+def test_compiled_filter_row_bands():
+    """Splitting the image into bands of rows shouldn't change the result."""
+    img = builtins.rose
+    f = compiled_image_filter(halve_and_brighten)
+    expected = f(*img, threads=1)
+
+    for threads in (2, 3, 7, 1000):
+        util.assert_identical(f(*img, threads=threads), expected)
+
+    with pytest.raises(ValueError):
+        f(*img, threads=0)
+
+
+def test_compiled_filter_all_channels():
+    """A compiled filter should see and produce every channel of a pixel in
+    one go, including alpha when asked for it.
+    """
+    img = builtins.rose
+    f = compiled_image_filter(
+        lambda state: state.color * RGBColor(0.5, 1.0, 0.0, 0.25))
+
+    before = img[0].pixels[10, 10].color
+    after = f(*img)[0].pixels[10, 10].color
+    assert after.red == pytest.approx(before.red * 0.5, abs=1e-3)
+    assert after.green == pytest.approx(before.green, abs=1e-3)
+    assert after.blue == 0.
+    # Alpha isn't one of the default channels
+    assert after.alpha == 1.
+
+    translucent = f(*img, channel=Channel.alpha)[0]
+    assert translucent.translucent
+    after = translucent.pixels[10, 10].color
+    assert after.red == before.red
+    assert after.alpha == pytest.approx(0.25, abs=1e-3)
+
+    # Luma is only a color's brightness; it leaves alpha alone
+    every_channel = Channel.red | Channel.green | Channel.blue | Channel.alpha
+    gray = compiled_image_filter(lambda state: state.color.luma)
+    after = gray(translucent, channel=every_channel)[0].pixels[10, 10].color
+    assert after.red == pytest.approx(before.luma, abs=1e-3)
+    assert after.alpha == pytest.approx(0.25, abs=1e-3)
+
+
+def test_compiled_filter_math():
+    img = builtins.rose
+    before = img[0].pixels[10, 10].color
+
+    def check(impl, expected):
+        f = image_filter(impl)
+        assert isinstance(f, compiled_image_filter)
+        after = f(*img)[0].pixels[10, 10].color
+        for channel in ('red', 'green', 'blue'):
+            assert getattr(after, channel) == pytest.approx(
+                getattr(expected, channel), abs=1e-3)
+
+    check(lambda state: 1 - state.color,
+        RGBColor(1 - before.red, 1 - before.green, 1 - before.blue))
+    check(lambda state: state.color / 2,
+        RGBColor(before.red / 2, before.green / 2, before.blue / 2))
+    check(lambda state: rgba(state.color.blue, state.color.green, state.color.red),
+        RGBColor(before.blue, before.green, before.red))
+    check(lambda state: state.color.luma,
+        RGBColor(before.luma, before.luma, before.luma))
+
+    lightness = before.hsl().lightness
+    check(lambda state: state.color.hsl().lightness,
+        RGBColor(lightness, lightness, lightness))
+
+    threshold = 1. if before.red > 0.5 else 0.
+    check(lambda state: select(state.color.red > 0.5, 1, 0),
+        RGBColor(threshold, threshold, threshold))
+
+
+def test_python_filter_matches_compiled():
+    img = builtins.rose
+    # Everything compiled filters can do, which Python has to be able to do as
+    # well, for filters that fall back to it
+    impls = [
+        lambda state: 1 - state.color,
+        lambda state: state.color / 2,
+        lambda state: 0.5 / (state.color + 0.5),
+        lambda state: -state.color + 1,
+        lambda state: +state.color,
+        lambda state: abs(state.color - 0.5),
+        lambda state: state.color ** 2.2,
+        lambda state: 0.5 ** state.color,
+        lambda state: state.color * state.color + state.color / 4,
+        lambda state: state.color.red,
+        lambda state: state.color.luma,
+        lambda state: state.color.hsl().lightness,
+        # Out of range going into the HSL conversion
+        lambda state: (state.color * 3 - 1).hsl().saturation,
+        lambda state: select(state.color.red > .5, 1, 0),
+        lambda state: select(state.color < 0.5, state.color * 2, 1 - state.color),
+        lambda state: (state.color >= 0.75) + (state.color <= 0.25),
+        lambda state: minimum(state.color, 0.5),
+        lambda state: maximum(state.color, rgba(0.2, 0.4, 0.6)),
+        lambda state: rgba(state.color.blue, state.color.green, state.color.red),
+        lambda state: (state.color * 2 - 0.5).clamped(),
+    ]
+
+    for impl in impls:
+        compiled = compiled_image_filter(impl)(*img)
+        python = python_image_filter(impl)(*img)
+        for a, b in zip(python[0].pixels, compiled[0].pixels):
+            assert a.color.red == pytest.approx(b.color.red, abs=1e-3)
+            assert a.color.green == pytest.approx(b.color.green, abs=1e-3)
+            assert a.color.blue == pytest.approx(b.color.blue, abs=1e-3)
+            assert a.color.alpha == b.color.alpha
+
+
+def test_color_arithmetic_outside_filters():
+    # Only the colors Python filters see work on alpha too; plain colors keep
+    # their alpha, as they always have
+    red = RGBColor(1., 0., 0.)
+    assert (red * 0.5).alpha == 1.
+    assert (red + 0.25).alpha == 1.
+    assert (red - 0.25).alpha == 1.
+
+    seen = []
+
+    def impl(state):
+        seen.append((state.color * 0.5).alpha)
+        return state.color
+
+    python_image_filter(impl)(*builtins.rose)
+    assert seen[0] == 0.5
+
+
+def test_neighborhood():
+    img = builtins.rose
+    blur = compiled_image_filter(
+        lambda state: (state.at(-1, 0).color + state.color + state.at(1, 0).color) / 3)
+    assert blur.radius == 1
+    assert not is_pointwise(blur.compiled_steps)
+
+    left = img[0].pixels[9, 10].color
+    middle = img[0].pixels[10, 10].color
+    right = img[0].pixels[11, 10].color
+    after = blur(*img)[0].pixels[10, 10].color
+    for channel in ('red', 'green', 'blue'):
+        expected = (getattr(left, channel) + getattr(middle, channel)
+            + getattr(right, channel)) / 3
+        assert getattr(after, channel) == pytest.approx(expected, abs=1e-3)
+
+    # Bands need to see the rows around them, too
+    edges = compiled_image_filter(
+        lambda state: abs(state.at(0, -2).color - state.at(0, 2).color))
+    assert edges.radius == 2
+    expected = edges(*img, threads=1)
+    for threads in (2, 7, 1000):
+        util.assert_identical(edges(*img, threads=threads), expected)
+
+    # Too far away to compile, even when it only adds up that far
+    far = MAX_NEIGHBOR_OFFSET + 1
+    with pytest.raises(FilterCompileError):
+        compiled_image_filter(lambda state: state.at(0, -far).color)
+    with pytest.raises(FilterCompileError):
+        compiled_image_filter(
+            lambda state: state.at(MAX_NEIGHBOR_OFFSET, 0).at(1, 0).color)
+    compiled_image_filter(lambda state: state.at(MAX_NEIGHBOR_OFFSET, 0).color)
+
+    # Which image_filter runs in Python instead
+    with pytest.warns(FilterCompileWarning):
+        shifted = image_filter(lambda state: state.at(far, 0).color)
+    assert isinstance(shifted, python_image_filter)
+
+
+def test_multiple_frames():
+    img = builtins.rose
+    inverted = compiled_image_filter(lambda state: 1 - state.color)(*img)
+    average = compiled_image_filter(
+        lambda state: (state.color + state.frame(1).color) / 2)
+    assert average.frame_count == 2
+
+    result = average(img[0], inverted[0])
+    for x, y in ((0, 0), (10, 10), (20, 30)):
+        after = result[0].pixels[x, y].color
+        for channel in ('red', 'green', 'blue'):
+            assert getattr(after, channel) == pytest.approx(0.5, abs=1e-3)
+
+    # The first frame decides the size
+    small = img.resized((35, 23))
+    assert average(img[0], small[0]).size == img.size
+    assert average(small[0], img[0]).size == small.size
+
+    with pytest.raises(ValueError):
+        average(img[0])
+
+
+def test_vectorized_filter():
+    @image_filter(vectorized=True)
+    def invert(row):
+        # NumPy array if available, array('d') otherwise
+        if isinstance(row, array.array):
+            return array.array('d', (1 - value for value in row))
+        return 1 - row
+
+    assert isinstance(invert, vectorized_image_filter)
+
+    img = builtins.rose
+    expected = compiled_image_filter(lambda state: 1 - state.color)(*img)
+    result = invert(*img, channel=Channel.red | Channel.green | Channel.blue)
+    for a, b in zip(result[0].pixels, expected[0].pixels):
+        assert a.color.red == pytest.approx(b.color.red, abs=1e-4)
+        assert a.color.green == pytest.approx(b.color.green, abs=1e-4)
+        assert a.color.blue == pytest.approx(b.color.blue, abs=1e-4)
+        assert a.color.alpha == b.color.alpha
+
+    # Alpha is written when asked for, even if the image didn't have any
+    @vectorized_image_filter
+    def fade(row):
+        if isinstance(row, array.array):
+            return array.array('d', (
+                0.25 if i % 4 == 3 else value for i, value in enumerate(row)))
+        row[:, 3] = 0.25
+        return row
+
+    assert not img[0].translucent
+    translucent = fade(*img, channel=Channel.alpha)[0]
+    assert translucent.translucent
+    assert translucent.pixels[10, 10].color.alpha == pytest.approx(0.25, abs=1e-3)
+
+    bogus = vectorized_image_filter(lambda row: [0.5])
+    with pytest.raises(ValueError):
+        bogus(*img)
+
+
+def test_compile_cache():
+    clear_compile_cache()
+
+    def make_filter(amount):
+        return compiled_image_filter(lambda state: state.color * amount)
+
+    first = make_filter(0.5)
+    second = make_filter(0.5)
+    assert second._program is first._program
+    other = make_filter(0.25)
+    assert other._program is not first._program
+
+    info = compile_cache_info()
+    assert info.hits == 1
+    assert info.misses == 2
+    assert info.currsize == 2
+
+    # Mutable closure variables can't be trusted to stay the same
+    amounts = [0.5]
+    compiled_image_filter(lambda state: state.color * amounts[0])
+    assert compile_cache_info().currsize == 2
+
+    clear_compile_cache(maxsize=1)
+    try:
+        make_filter(0.5)
+        make_filter(0.25)
+        assert compile_cache_info().currsize == 1
+        # Evicted, so compiled again
+        make_filter(0.5)
+        assert compile_cache_info().misses == 3
+    finally:
+        clear_compile_cache(maxsize=128)
+
+
+_settings = types.ModuleType('_settings')
+_settings.GAIN = 0.5
+_helper_gain = 0.5
+
+
+def _scale(color):
+    return color * _helper_gain
+
+
+def test_compile_cache_notices_changes():
+    global _helper_gain
+    img = builtins.rose
+    before = img[0].pixels[10, 10].color.red
+
+    def red_after(impl):
+        return compiled_image_filter(impl)(*img)[0].pixels[10, 10].color.red
+
+    # Modules can change without being replaced, so this isn't cached at all
+    clear_compile_cache()
+    from_module = lambda state: state.color * _settings.GAIN
+    assert red_after(from_module) == pytest.approx(before * 0.5, abs=1e-3)
+    _settings.GAIN = 0.25
+    try:
+        assert red_after(from_module) == pytest.approx(before * 0.25, abs=1e-3)
+    finally:
+        _settings.GAIN = 0.5
+    assert compile_cache_info().currsize == 0
+
+    # Helper functions are cached, but only as long as what they refer to
+    # stays the same
+    from_helper = lambda state: _scale(state.color)
+    assert red_after(from_helper) == pytest.approx(before * 0.5, abs=1e-3)
+    assert red_after(from_helper) == pytest.approx(before * 0.5, abs=1e-3)
+    assert compile_cache_info().hits == 1
+    _helper_gain = 0.25
+    try:
+        assert red_after(from_helper) == pytest.approx(before * 0.25, abs=1e-3)
+    finally:
+        _helper_gain = 0.5
+    assert compile_cache_info().misses == 2
+
+
+def test_chain():
+    img = builtins.rose
+    gamma = compiled_image_filter(lambda state: state.color ** 0.8)
+    brighten = compiled_image_filter(lambda state: state.color * 1.5 - 0.1)
+    invert = python_image_filter(
+        lambda state: RGBColor(
+            1 - state.color.red, 1 - state.color.green, 1 - state.color.blue))
+
+    fused = chain(gamma, brighten)
+    assert len(fused.stages()) == 1
+    expected = brighten(*gamma(*img))
+    for a, b in zip(fused(*img)[0].pixels, expected[0].pixels):
+        assert a.color.red == pytest.approx(b.color.red, abs=1e-3)
+        assert a.color.green == pytest.approx(b.color.green, abs=1e-3)
+        assert a.color.blue == pytest.approx(b.color.blue, abs=1e-3)
+        assert a.color.alpha == b.color.alpha
+
+    # Going out of range in the middle is clamped (or not, in HDRI builds)
+    # just as it is between separate filters
+    stretch = compiled_image_filter(lambda state: state.color * 3 - 1)
+    squash = compiled_image_filter(lambda state: state.color * 0.5 + 0.25)
+    fused = chain(stretch, squash)
+    assert len(fused.stages()) == 1
+    expected = squash(*stretch(*img))
+    for a, b in zip(fused(*img)[0].pixels, expected[0].pixels):
+        assert a.color.red == pytest.approx(b.color.red, abs=1e-3)
+        assert a.color.green == pytest.approx(b.color.green, abs=1e-3)
+        assert a.color.blue == pytest.approx(b.color.blue, abs=1e-3)
+
+    # Python filters can't be fused, so they split the chain
+    staged = chain(gamma, invert, brighten, gamma)
+    assert [type(stage) for stage in staged.stages()] == [
+        compiled_image_filter, python_image_filter, compiled_image_filter]
+
+    # Neither can filters that look at neighbors of the previous output
+    blur = compiled_image_filter(
+        lambda state: (state.at(-1, 0).color + state.at(1, 0).color) / 2)
+    assert len(chain(gamma, blur).stages()) == 2
+    assert len(chain(blur, gamma).stages()) == 1
+
+
+def test_map_frames():
+    animation = Image()
+    for n in range(5):
+        frame = builtins.rose[0].copy()
+        frame._frame.page.x = n * 10
+        animation.append(frame)
+
+    invert = compiled_image_filter(lambda state: 1 - state.color)
+    for workers in (1, 3):
+        result = map_frames(invert, animation, workers=workers)
+        assert len(result) == len(animation)
+        for before, after in zip(animation, result):
+            assert after.canvas == before.canvas
+            single = Image()
+            single.append(after)
+            util.assert_identical(single, invert(before))
+
+    with pytest.raises(ValueError):
+        map_frames(invert, animation, workers=0)
+
+
+def test_builtin_filters():
+    img = builtins.rose
+    before = img[0].pixels[10, 10].color
+
+    # Everything produces a new image the same size, and leaves the original
+    # alone
+    for f in (Blur(1.5), Sharpen(1.5), Level(0.1, 0.9), Gamma(1.5),
+            Modulate(1.2, 0.5, 1.1), Negate(), ContrastStretch(0.02, 0.01)):
+        new = f(*img)
+        assert new.size == img.size
+        assert img[0].pixels[10, 10].color == before
+
+    after = Negate()(*img)[0].pixels[10, 10].color
+    assert after.red == pytest.approx(1 - before.red, abs=1e-3)
+    assert after.green == pytest.approx(1 - before.green, abs=1e-3)
+    assert after.blue == pytest.approx(1 - before.blue, abs=1e-3)
+
+    after = Gamma(2.0)(*img)[0].pixels[10, 10].color
+    assert after.red == pytest.approx(before.red ** 0.5, abs=1e-3)
+
+    # Only the given channel changes
+    after = Negate()(*img, channel=Channel.red)[0].pixels[10, 10].color
+    assert after.red == pytest.approx(1 - before.red, abs=1e-3)
+    assert after.green == before.green
+    assert after.blue == before.blue
+
+    after = Modulate()(*img)[0].pixels[10, 10].color
+    assert after.red == pytest.approx(before.red, abs=1e-3)
+    assert after.green == pytest.approx(before.green, abs=1e-3)
+    assert after.blue == pytest.approx(before.blue, abs=1e-3)
+
+
+def test_filter_compile_error():
+    """A filter that can't be compiled should say why, then run in Python."""
+    def branchy(state):
+        if state.color.red > 0.5:
+            return state.color
+        return RGBColor(0., 0., 0.)
+
+    with pytest.warns(FilterCompileWarning):
+        f = image_filter(branchy)
+
+    assert isinstance(f, python_image_filter)
+    assert 'select' in str(f.compile_error)
+
+
+def test_pointwise_lookup_table():
+    gamma = compiled_image_filter(
+        lambda state: state.color ** RGBColor(0.5, 1.0, 2.2))
+    assert gamma.pointwise
+    assert is_pointwise(gamma.compiled_steps)
+    assert not compiled_image_filter(lambda state: state.color.luma).pointwise
+
+    img = builtins.rose
+    with_lut = gamma(*img, lut=True)
+    without_lut = gamma(*img, lut=False)
+    if HAS_HDRI:
+        # The table is sampled, so it's only close
+        for a, b in zip(with_lut[0].pixels, without_lut[0].pixels):
+            assert a.color.red == pytest.approx(b.color.red, abs=1e-4)
+            assert a.color.blue == pytest.approx(b.color.blue, abs=1e-4)
+    else:
+        util.assert_identical(with_lut, without_lut)
+
+    with pytest.raises(ValueError):
+        compiled_image_filter(lambda state: state.color.luma)(*img, lut=True)
+
+
+def test_native_backend(tmpdir, monkeypatch):
+    monkeypatch.setenv('SANPERA_CACHE_DIR', str(tmpdir))
+    # Start from nothing, so the kernel really gets built into tmpdir
+    clear_compile_cache()
+    monkeypatch.setattr(_filter_native, '_loaded', {})
+
+    impl = lambda state: select(
+        state.color.luma > 0.5, state.color ** 2, (state.color * 0.5 + 0.25).clamped())
+    vm = compiled_image_filter(impl)
+    native = compiled_image_filter(impl, backend='native')
+    assert native.backend == 'native'
+
+    img = builtins.rose
+    for a, b in zip(vm(*img)[0].pixels, native(*img)[0].pixels):
+        assert a.color.red == pytest.approx(b.color.red, abs=1e-4)
+        assert a.color.green == pytest.approx(b.color.green, abs=1e-4)
+        assert a.color.blue == pytest.approx(b.color.blue, abs=1e-4)
+
+    built = tmpdir.listdir()
+    assert built
+
+    # A fresh process finds the built module on disk rather than building it
+    # again; forget everything held in memory to act like one
+    def no_build(*args):
+        raise AssertionError("Kernel was rebuilt instead of loaded from disk")
+
+    clear_compile_cache()
+    monkeypatch.setattr(_filter_native, '_loaded', {})
+    monkeypatch.setattr(_filter_native, '_build', no_build)
+    reloaded = compiled_image_filter(impl, backend='native')
+    assert reloaded._program is not native._program
+    assert tmpdir.listdir() == built
+    util.assert_identical(reloaded(*img), native(*img))
@@ -19,3 +19,19 @@ def test_identify_size():
     assert frame.canvas.size == img.size, "virtual canvas size is image size"
     assert not frame.has_canvas, "frame isn't using a virtual canvas"
     assert not img.has_canvas, "image isn't using a virtual canvas"
+
+def test_ping():
+    img = Image.ping(util.find_image('anim_bgnd.gif'))
+
+    assert len(img) == 4, "all four frames are found"
+    assert img.original_format == b'GIF', "image is a gif"
+    assert img.size == Size(100, 100), "dimensions are 100x100"
+    assert img[1].canvas.position == Vector(35, 30), "canvas offsets survive"
+
+def test_ping_buffer():
+    with open(util.find_image('eye.gif'), 'rb') as fh:
+        img = Image.ping_buffer(fh.read())
+
+    assert len(img) == 1, "one frame"
+    assert img.original_format == b'GIF', "image is a gif"
+    assert img.size == Size(32, 32), "dimensions are 32x32"
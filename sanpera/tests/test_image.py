@@ -1,5 +1,11 @@
+import io
+
+import pytest
+
 from sanpera.geometry import Size, origin
 from sanpera.image import Image, builtins
+from sanpera.imagemagick import IMAGE_FORMATS
+from sanpera.tests import util
 
 
 def test_cropped_canvas_fixing():
@@ -26,3 +32,166 @@ def test_appending_to_an_empty_image():
     img.append(builtins.rose[0])
 
     assert img.size == builtins.rose.size
+
+
+def test_size_hint_is_only_a_hint():
+    # GIF has no reduced-scale decoding, so this should change nothing
+    img = Image.read(util.find_image('eye.gif'), size_hint=(8, 8))
+    assert img.size == Size(32, 32)
+
+
+@pytest.mark.skipif(
+    'jpeg' not in IMAGE_FORMATS, reason="ImageMagick built without JPEG")
+def test_size_hint_jpeg():
+    buf = builtins.rose.resized((400, 400)).to_buffer(format='jpeg')
+    img = Image.from_buffer(buf[:], size_hint=(100, 100))
+
+    # libjpeg only scales by powers of two, and never below the hint
+    assert 100 <= img.size.width < 400
+    assert 100 <= img.size.height < 400
+
+
+class OnlyReadable(object):
+    """A file-like that can't seek, like a socket or a decompressor."""
+    def __init__(self, buf):
+        self._stream = io.BytesIO(buf)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+
+def test_read_stream():
+    with open(util.find_image('anim_bgnd.gif'), 'rb') as fh:
+        img = Image.read_stream(fh)
+
+    assert len(img) == 4
+    assert img.size == Size(100, 100)
+
+
+def test_read_stream_unseekable():
+    with open(util.find_image('eye.gif'), 'rb') as fh:
+        stream = OnlyReadable(fh.read())
+
+    img = Image.read_stream(stream, format='gif')
+    util.assert_identical(img, util.get_image('eye.gif'))
+
+
+def test_write_stream():
+    img = util.get_image('eye.gif')
+    out = io.BytesIO()
+    img.write_stream(out, format='png')
+
+    out.seek(0)
+    written = Image.read_stream(out)
+    assert written.original_format == b'PNG'
+    util.assert_identical(written, img)
+
+
+def test_from_buffer_accepts_buffer_likes():
+    with open(util.find_image('eye.gif'), 'rb') as fh:
+        data = fh.read()
+    expected = util.get_image('eye.gif')
+
+    util.assert_identical(Image.from_buffer(bytearray(data)), expected)
+
+    # A slice out of the middle of a larger buffer, without copying it out
+    padded = bytearray(b'junk') + bytearray(data) + bytearray(b'junk')
+    view = memoryview(padded)[4:-4]
+    util.assert_identical(Image.from_buffer(view), expected)
+
+
+def test_read_mmap():
+    img = Image.read_mmap(util.find_image('anim_bgnd.gif'))
+    assert len(img) == 4
+    assert img.size == Size(100, 100)
+
+
+def test_to_buffer_into():
+    img = util.get_image('eye.gif')
+    expected = img.to_buffer(format='png')[:]
+
+    # Starts out too small, so should be grown
+    buf = bytearray(16)
+    length = img.to_buffer_into(buf, format='png')
+    assert length == len(expected)
+    assert buf[:length] == expected
+
+    # Reusing a buffer that's already too big is fine too
+    buf = bytearray(len(expected) * 2)
+    length = img.to_buffer_into(memoryview(buf), format='png')
+    assert buf[:length] == expected
+
+    with pytest.raises(ValueError):
+        img.to_buffer_into(memoryview(bytearray(16)), format='png')
+
+
+def test_lazy_plan():
+    img = builtins.rose.resized((200, 200))
+    middle = Size(100, 100).at((50, 50))
+
+    # Crop moves ahead of the resize, at the original scale; the crop that
+    # keeps everything disappears, and so does the last resize, since the
+    # moved one already produces that size
+    plan = (img.lazy()
+        .cropped(Size(200, 200).at(origin))
+        .resized((400, 400), filter='box')
+        .cropped(Size(200, 200).at((100, 100)))
+        .resized((200, 200), filter='box')
+        .plan())
+    assert len(plan) == 2
+    assert plan[0].rect == middle
+    assert plan[1].size == Size(200, 200)
+    assert plan[1].filter == 'box'
+
+    # Consecutive crops are merged
+    plan = (img.lazy()
+        .cropped(Size(150, 150).at((25, 25)))
+        .cropped(middle)
+        .plan())
+    assert len(plan) == 1
+    assert plan[0].rect == Size(100, 100).at((75, 75))
+
+    # Crops that don't land on whole pixels stay where they are
+    plan = (img.lazy()
+        .resized((300, 300), filter='box')
+        .cropped(Size(7, 7).at((1, 1)))
+        .plan())
+    assert [type(op).__name__ for op in plan] == ['Resize', 'Crop']
+
+    # So do crops after resizes that blend neighboring pixels together
+    plan = img.lazy().resized((400, 400)).cropped(middle).plan()
+    assert [type(op).__name__ for op in plan] == ['Resize', 'Crop']
+
+    # Frames of an image with a canvas might stick out past it, so even a
+    # full-canvas crop isn't a no-op
+    offset = img.cropped(Size(150, 150).at((25, 25)), preserve_canvas=True)
+    assert offset.has_canvas
+    plan = offset.lazy().cropped(Size(200, 200).at(origin)).plan()
+    assert [type(op).__name__ for op in plan] == ['Crop']
+
+
+def test_lazy_collect_matches_eager():
+    img = builtins.rose.resized((200, 200))
+    rect = Size(100, 50).at((40, 20))
+
+    lazy = img.lazy().resized((400, 400), filter='point').cropped(rect)
+    assert [type(op).__name__ for op in lazy.plan()] == ['Crop', 'Resize']
+    util.assert_identical(
+        lazy.collect(),
+        img.resized((400, 400), filter='point').cropped(rect))
+
+    # And the original image is untouched
+    assert img.size == Size(200, 200)
+
+    # Resizing down and back up loses detail, so it can't be skipped or
+    # merged into a single resize
+    lazy = (img.lazy()
+        .resized((20, 20), filter='point')
+        .resized(img.size, filter='point'))
+    assert [type(op).__name__ for op in lazy.plan()] == ['Resize', 'Resize']
+    pixelated = lazy.collect()
+    util.assert_identical(
+        pixelated,
+        img.resized((20, 20), filter='point').resized(img.size, filter='point'))
+    assert (pixelated.to_buffer(format='rgba')[:]
+        != img.to_buffer(format='rgba')[:])
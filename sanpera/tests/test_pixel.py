@@ -1,8 +1,11 @@
 """Does individual pixel access/manipulation work?"""
 
+import pytest
+
 from sanpera.color import RGBColor
-from sanpera.geometry import Vector
-from sanpera.image import Image
+from sanpera.geometry import Rectangle, Size, Vector
+from sanpera.image import Image, ImageFrame
+from sanpera.pixel_view import PIXEL_CHANNELS
 
 from sanpera.tests import util
 
@@ -27,3 +30,108 @@ def test_pixel_get():
     assert img[0].pixels[11, 6] == RGBColor(1., 0., 0.)
 
 # TODO: implement, test pixel assignment (both iter and random)
+
+def test_to_array():
+    numpy = pytest.importorskip('numpy')
+
+    img = Image.read(util.find_image('terminal.gif'))
+    array = img[0].to_array()
+    assert array.shape == (img[0].size.height, img[0].size.width, 4)
+    assert array.dtype == numpy.uint8
+    assert tuple(array[6, 11]) == (255, 0, 0, 255)
+    assert tuple(array[0, 0]) == (255, 255, 255, 255)
+
+    # Region export should match the same slice of the whole thing
+    region = img[0].to_array(
+        channels='RGB', dtype='float32', region=Rectangle(10, 5, 14, 8))
+    assert region.shape == (3, 4, 3)
+    assert tuple(region[1, 1]) == (1., 0., 0.)
+
+def test_from_array():
+    numpy = pytest.importorskip('numpy')
+
+    array = numpy.zeros((4, 6, 3), dtype=numpy.uint8)
+    array[2, 3] = (0, 255, 0)
+    frame = ImageFrame.from_array(array)
+
+    assert frame.size == Size(6, 4)
+    assert frame.pixels[3, 2] == RGBColor(0., 1., 0.)
+    assert frame.pixels[0, 0] == RGBColor(0., 0., 0.)
+    assert (frame.to_array(channels='RGB') == array).all()
+
+def test_pixel_region():
+    img = Image.read(util.find_image('terminal.gif'))
+    frame = img[0]
+    red = PIXEL_CHANNELS.index('R')
+    green = PIXEL_CHANNELS.index('G')
+
+    with frame.pixels.region(Rectangle(10, 5, 14, 8)) as pixels:
+        assert pixels.shape == (3, 4, 4)
+        # (11, 6) is red
+        assert pixels[1, 1, green] == 0
+        full = pixels[1, 1, red]
+        assert full > 0
+
+        # Modify in place
+        pixels[1, 1, green] = full
+
+    assert frame.pixels[11, 6] == RGBColor(1., 1., 0.)
+
+def test_get_region():
+    img = Image.read(util.find_image('terminal.gif'))
+    rect = Rectangle(10, 5, 14, 8)
+
+    doubles = img[0].pixels.get_region(rect)
+    assert len(doubles) == 3 * 4 * 4
+    # (11, 6) is red; that's row 1, column 1
+    offset = (1 * 4 + 1) * 4
+    assert list(doubles[offset:offset + 4]) == [1., 0., 0., 1.]
+
+    octets = img[0].pixels.get_region(rect, format='B')
+    assert list(octets[offset:offset + 4]) == [255, 0, 0, 255]
+
+def test_set_region():
+    img = Image.new((4, 4))
+    rect = Rectangle(1, 1, 3, 3)
+
+    img[0].pixels.set_region(rect, bytearray([0, 0, 255, 255] * 4))
+    assert img[0].pixels[1, 2] == RGBColor(0., 0., 1.)
+    assert img[0].pixels[0, 0] == RGBColor(0., 0., 0., 0.)
+
+    img[0].pixels.set_region(
+        Rectangle(0, 0, 1, 1), img[0].pixels.get_region(rect)[:4])
+    assert img[0].pixels[0, 0] == RGBColor(0., 0., 1.)
+
+def test_readonly_pixels():
+    img = Image.read(util.find_image('terminal.gif'))
+    frame = img[0].copy()
+    pixels = frame.pixels.readonly()
+
+    assert pixels[11, 6] == RGBColor(1., 0., 0.)
+
+    pixel_iter = iter(pixels)
+    px = next(pixel_iter)
+    assert px.point == Vector(0, 0)
+    assert px.color == RGBColor(1., 1., 1.)
+
+    with pytest.raises(AttributeError):
+        px.color = RGBColor(0., 0., 0.)
+
+def test_pixel_batch():
+    img = Image.new((10, 10))
+    red = RGBColor(1., 0., 0.)
+    blue = RGBColor(0., 0., 1.)
+
+    with img[0].pixels.batch() as pixels:
+        pixels[1, 2] = red
+        pixels[8, 2] = blue
+        pixels[5, 7] = red
+        # Pending writes are visible, but not yet applied
+        assert pixels[8, 2] == blue
+        assert img[0].pixels[8, 2] == RGBColor(0., 0., 0., 0.)
+
+    assert img[0].pixels[1, 2] == red
+    assert img[0].pixels[8, 2] == blue
+    assert img[0].pixels[5, 7] == red
+    # Pixels between writes in the same row are untouched
+    assert img[0].pixels[4, 2] == RGBColor(0., 0., 0., 0.)
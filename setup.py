@@ -29,9 +29,14 @@ setup(
 
     packages=['sanpera'],
     install_requires=BACKPORTS + [
-        'cffi>=1.0.0',
+        'cffi>=1.12.0',
     ],
 
-    setup_requires=['cffi>=1.0.0'],
+    extras_require={
+        # For ImageFrame.to_array and friends
+        'numpy': ['numpy'],
+    },
+
+    setup_requires=['cffi>=1.12.0'],
     cffi_modules=['sanpera/_api_build.py:ffi'],
 )